@@ -0,0 +1,85 @@
+import struct
+
+# Internet checksum (RFC 1071) for IPv4 headers and TCP/UDP packets.
+# The whole data is read as one big endian integer N = sum(word(i) * 2^(16*k)). Since 2^16 = 1 mod 0xFFFF, N mod 0xFFFF is the
+# one's complement sum of the 16 bit words (with 0xFFFF instead of 0 for non zero data), so the sum is done in C by
+# int.from_bytes and a single modulo instead of one python operation per byte pair (about 3x faster than summing array('H')).
+
+
+def ones_complement_sum(data, cksum = 0): #16 bit one's complement sum of data (big endian words), added to cksum
+    if len(data) % 2 == 1:
+        data = bytes(data) + b'\x00'
+    number = int.from_bytes(data, 'big')
+    total = number % 0xFFFF
+    if total == 0 and number != 0: total = 0xFFFF
+    cksum += total
+    cksum = (cksum >> 16) + (cksum & 0xFFFF)
+    return (cksum >> 16) + (cksum & 0xFFFF)
+
+
+def checksum(data, cksum = 0): #returns the checksum as int
+    return (~ones_complement_sum(data, cksum)) & 0xFFFF
+
+
+def ip_checksum(ip_header): #returns 2 bytes. odd length data (TCP/UDP) is always padded with zero
+    return struct.pack("!H", checksum(ip_header))
+
+
+def pseudo_header(source_address, destination_address, protocol, length): #IPv4 pseudo header for TCP/UDP checksum (addresses in bytes)
+    return source_address + destination_address + bytes([0, protocol]) + struct.pack("!H", length)
+
+
+def pseudo_header_sum(source_address, destination_address, protocol, length):
+    return ones_complement_sum(pseudo_header(source_address, destination_address, protocol, length))
+
+
+def checksum_update(old_checksum, old_word, new_word): #RFC 1624 eqn. 3: HC' = ~(~HC + ~m + m'), for one 16 bit field changed from old_word to new_word
+    cksum = ((~old_checksum) & 0xFFFF) + ((~old_word) & 0xFFFF) + new_word
+    cksum = (cksum >> 16) + (cksum & 0xFFFF)
+    cksum = (cksum >> 16) + (cksum & 0xFFFF)
+    return (~cksum) & 0xFFFF
+
+
+#-------------------------------------------------------------------------------
+# Name:        checksum.py
+#
+# Author:      Grant Curell
+#
+# Created:     16 Sept 2012
+#
+# Description: Calculates the checksum for an IP header
+#-------------------------------------------------------------------------------
+def legacy_ip_checksum(ip_header, tcp_udp = False): #previous implementation, kept for benchmark comparison
+    if tcp_udp == True:
+        if len(ip_header) % 2 == 1:
+            ip_header += b'\x00'
+
+    cksum = 0
+    pointer = 0
+    size = len(ip_header)
+    while size > 1:
+        cksum += int((str("%02x" % (ip_header[pointer],)) +
+                      str("%02x" % (ip_header[pointer+1],))), 16)
+        size -= 2
+        pointer += 2
+    if size:
+        cksum += ip_header[pointer]
+
+    cksum = (cksum >> 16) + (cksum & 0xffff)
+    cksum += (cksum >>16)
+
+    return struct.pack("!H",(~cksum) & 0xFFFF)
+
+
+def benchmark(size = 1500, number = 2000):
+    import timeit
+    data = bytes(range(256)) * (size // 256) + bytes(range(size % 256))
+    assert ip_checksum(data) == legacy_ip_checksum(data, tcp_udp=True)
+    for name, function in (('legacy_ip_checksum', lambda data: legacy_ip_checksum(data, True)), ('ip_checksum', ip_checksum)):
+        elapsed = timeit.timeit(lambda: function(data), number = number)
+        print('%-20s %d bytes: %8.2f us' % (name, size, elapsed * 1000000 / number))
+
+
+if __name__ == '__main__':
+    benchmark()
+    benchmark(20, 20000)
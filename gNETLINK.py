@@ -0,0 +1,332 @@
+import ctypes
+import socket
+import errno
+import os
+import struct
+
+# rtnetlink (AF_NETLINK, NETLINK_ROUTE) and network namespaces without ip/ifconfig/route processes. The operations are queued
+# in an rtnetlink object and sent in one datagram with commit(): the kernel processes them in order and acks each one.
+# An rtnetlink object can be opened in a named network namespace (as created by "ip netns add"), the socket stays in it.
+
+NLMSG_HEADER = struct.Struct('=IHHII') # length, type, flags, sequence, port id
+NLMSG_ERROR_CODE = struct.Struct('=i')
+RTATTR = struct.Struct('=HH')          # length, type
+IFINFOMSG = struct.Struct('=BxHiII')   # family, type, index, flags, change
+IFADDRMSG = struct.Struct('=BBBBi')    # family, prefix length, flags, scope, index
+RTMSG = struct.Struct('=BBBBBBBBI')    # family, dst length, src length, tos, table, protocol, scope, type, flags
+FIB_RULE_HDR = struct.Struct('=BBBBBxxBI') # family, dst length, src length, tos, table, action, flags
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_NEWRULE = 32
+RTM_DELRULE = 33
+
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_NET_NS_FD = 28
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+FRA_SRC = 2
+
+IFF_UP = 0x1
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_NOWHERE = 255 # in deletes: any scope
+RTN_UNICAST = 1
+FR_ACT_TO_TBL = 1
+
+NETLINK_BUFFER_SIZE = 65536
+
+# network namespaces, as in iproute2: a namespace is kept by a bind mount of /proc/<tid>/ns/net in NETNS_RUN_DIR/<name>
+NETNS_RUN_DIR = '/var/run/netns'
+CLONE_NEWNET = 0x40000000
+MS_BIND = 0x1000
+MS_REC = 0x4000
+MS_SHARED = 0x100000
+MNT_DETACH = 0x2
+
+libc_netns = ctypes.CDLL('libc.so.6', use_errno=True)
+
+
+def raise_errno():
+    e = ctypes.get_errno()
+    raise OSError(e, os.strerror(e))
+
+
+def check_libc(result):
+    if result != 0:
+        raise_errno()
+
+
+def netns_path(name):
+    return os.path.join(NETNS_RUN_DIR, name)
+
+
+def setns(fd):
+    check_libc(libc_netns.setns(fd, CLONE_NEWNET))
+
+
+def add_netns(name): # same as "ip netns add". Nothing is done if it already exists
+    path = netns_path(name)
+    if os.path.exists(path):
+        return
+    os.makedirs(NETNS_RUN_DIR, exist_ok = True)
+    run_dir = NETNS_RUN_DIR.encode()
+    if libc_netns.mount(b'none', run_dir, None, MS_SHARED | MS_REC, None) != 0: # the mounts must propagate to other mount namespaces
+        if ctypes.get_errno() != errno.EINVAL: # EINVAL: not a mount point yet
+            raise_errno()
+        check_libc(libc_netns.mount(run_dir, run_dir, b'none', MS_BIND | MS_REC, None))
+        check_libc(libc_netns.mount(b'none', run_dir, None, MS_SHARED | MS_REC, None))
+    os.close(os.open(path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0))
+    current = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+    try:
+        check_libc(libc_netns.unshare(CLONE_NEWNET))
+        try:
+            check_libc(libc_netns.mount(b'/proc/thread-self/ns/net', path.encode(), b'none', MS_BIND, None))
+        finally:
+            setns(current)
+    except OSError:
+        os.unlink(path)
+        raise
+    finally:
+        os.close(current)
+
+
+def delete_netns(name): # same as "ip netns del": devices in the namespace are deleted when nothing else uses it
+    path = netns_path(name)
+    check_libc(libc_netns.umount2(path.encode(), MNT_DETACH))
+    os.unlink(path)
+
+
+def rtattr(attribute_type, data):
+    length = RTATTR.size + len(data)
+    return RTATTR.pack(length, attribute_type) + data + b'\x00' * (-length % 4)
+
+
+def parse_rtattrs(data, position): # attributes from position to the end of data: type -> value
+    attributes = {}
+    while position + RTATTR.size <= len(data):
+        length, attribute_type = RTATTR.unpack_from(data, position)
+        if length < RTATTR.size:
+            break
+        attributes[attribute_type] = data[position + RTATTR.size:position + length]
+        position += (length + 3) & ~3
+    return attributes
+
+
+def address_family(address):
+    return socket.AF_INET6 if ':' in address else socket.AF_INET
+
+
+class rtnetlink():
+
+    def __init__(self, netns = None): # socket in the named network namespace, or in the current one
+        if netns is None:
+            self.sock = self.open_socket()
+        else:
+            current = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+            target = os.open(netns_path(netns), os.O_RDONLY)
+            try:
+                setns(target)
+                try:
+                    self.sock = self.open_socket()
+                finally:
+                    setns(current)
+            finally:
+                os.close(target)
+                os.close(current)
+        self.sequence = 0
+        self.queue = []    # (sequence, message, description)
+        self.fd_list = []  # network namespace fds used by the queued messages
+        self.index_of = {} # device name -> index
+
+
+    def open_socket(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        sock.bind((0, 0))
+        return sock
+
+
+    def close(self):
+        self.sock.close()
+        for fd in self.fd_list:
+            os.close(fd)
+        self.fd_list = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def message(self, message_type, flags, payload):
+        self.sequence += 1
+        return self.sequence, NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), message_type, flags | NLM_F_REQUEST, self.sequence, 0) + payload
+
+
+    def add(self, message_type, flags, payload, description):
+        sequence, message = self.message(message_type, flags | NLM_F_ACK, payload)
+        self.queue.append((sequence, message, description))
+
+
+    def commit(self): # sends the queued operations in one datagram. Returns (description, errno) of each one that failed
+        if self.queue == []:
+            return []
+        description_of = {sequence: description for sequence, message, description in self.queue}
+        self.sock.sendto(b''.join(message for sequence, message, description in self.queue), (0, 0))
+        self.queue = []
+        error_list = []
+        while len(description_of) > 0:
+            for sequence, message_type, payload in self.receive():
+                if message_type == NLMSG_ERROR and sequence in description_of:
+                    error = -NLMSG_ERROR_CODE.unpack_from(payload, 0)[0]
+                    if error != 0:
+                        error_list.append((description_of[sequence], error))
+                    del description_of[sequence]
+        for fd in self.fd_list:
+            os.close(fd)
+        self.fd_list = []
+        return error_list
+
+
+    def receive(self): # list of (sequence, type, payload) of one datagram
+        data = self.sock.recv(NETLINK_BUFFER_SIZE)
+        message_list = []
+        position = 0
+        while position + NLMSG_HEADER.size <= len(data):
+            length, message_type, flags, sequence, port_id = NLMSG_HEADER.unpack_from(data, position)
+            if length < NLMSG_HEADER.size:
+                break
+            message_list.append((sequence, message_type, data[position + NLMSG_HEADER.size:position + length]))
+            position += (length + 3) & ~3
+        return message_list
+
+
+    def link_index(self, name): # index of a device in the namespace of the socket (sent at once, not queued)
+        if name not in self.index_of:
+            sequence, message = self.message(RTM_GETLINK, 0, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + rtattr(IFLA_IFNAME, name.encode() + b'\x00'))
+            self.sock.sendto(message, (0, 0))
+            while name not in self.index_of:
+                for answer_sequence, message_type, payload in self.receive():
+                    if answer_sequence != sequence:
+                        continue
+                    if message_type == NLMSG_ERROR:
+                        error = -NLMSG_ERROR_CODE.unpack_from(payload, 0)[0]
+                        raise OSError(error, os.strerror(error) + ': ' + name)
+                    if message_type == RTM_NEWLINK:
+                        self.index_of[name] = IFINFOMSG.unpack_from(payload, 0)[2]
+        return self.index_of[name]
+
+
+    def addresses(self, name): # (address, prefix length) of the addresses of a device (sent at once, not queued)
+        index = self.link_index(name)
+        sequence, message = self.message(RTM_GETADDR, NLM_F_DUMP, IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+        self.sock.sendto(message, (0, 0))
+        address_list = []
+        while True:
+            for answer_sequence, message_type, payload in self.receive():
+                if answer_sequence != sequence:
+                    continue
+                if message_type in (NLMSG_DONE, NLMSG_ERROR):
+                    return address_list
+                family, prefix_length, flags, scope, address_index = IFADDRMSG.unpack_from(payload, 0)
+                if message_type == RTM_NEWADDR and address_index == index:
+                    attributes = parse_rtattrs(payload, IFADDRMSG.size)
+                    address = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+                    if address is not None:
+                        address_list.append((socket.inet_ntop(family, address), prefix_length))
+
+
+    def set_link(self, name, up = None, mtu = None, netns = None): # "ip link set dev name up/down mtu mtu netns netns"
+        flags, change, attributes, description = 0, 0, b'', 'link ' + name
+        if up is not None:
+            flags, change = (IFF_UP if up else 0), IFF_UP
+            description += ' up' if up else ' down'
+        if mtu is not None:
+            attributes += rtattr(IFLA_MTU, struct.pack('=I', int(mtu)))
+            description += ' mtu ' + str(mtu)
+        if netns is not None:
+            fd = os.open(netns_path(netns), os.O_RDONLY)
+            self.fd_list.append(fd)
+            attributes += rtattr(IFLA_NET_NS_FD, struct.pack('=I', fd))
+            description += ' netns ' + netns
+        self.add(RTM_NEWLINK, 0, IFINFOMSG.pack(socket.AF_UNSPEC, 0, self.link_index(name), flags, change) + attributes, description)
+        if netns is not None:
+            del self.index_of[name] # no longer in this namespace
+
+
+    def add_address(self, name, address, prefix_length): # "ip addr add address/prefix_length dev name"
+        family = address_family(address)
+        address_bytes = socket.inet_pton(family, address)
+        self.add(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, IFADDRMSG.pack(family, prefix_length, 0, RT_SCOPE_UNIVERSE, self.link_index(name)) +
+            rtattr(IFA_LOCAL, address_bytes) + rtattr(IFA_ADDRESS, address_bytes), 'address ' + address + '/' + str(prefix_length) + ' dev ' + name)
+
+
+    def delete_address(self, name, address, prefix_length): # "ip addr del address/prefix_length dev name"
+        family = address_family(address)
+        address_bytes = socket.inet_pton(family, address)
+        self.add(RTM_DELADDR, 0, IFADDRMSG.pack(family, prefix_length, 0, RT_SCOPE_UNIVERSE, self.link_index(name)) +
+            rtattr(IFA_LOCAL, address_bytes) + rtattr(IFA_ADDRESS, address_bytes), 'address del ' + address + '/' + str(prefix_length) + ' dev ' + name)
+
+
+    def flush_link(self, name): # "ip addr flush dev name" and link down, which also removes the routes through the device
+        for address, prefix_length in self.addresses(name):
+            self.delete_address(name, address, prefix_length)
+        self.set_link(name, up = False)
+
+
+    def route(self, message_type, destination, prefix_length, gateway = None, device = None, table = RT_TABLE_MAIN):
+        family = address_family(destination)
+        if message_type == RTM_DELROUTE: # any protocol, scope and type, as iproute2
+            protocol, scope, route_type = 0, RT_SCOPE_NOWHERE, 0
+        else: # device routes without gateway are link scope in ipv4
+            protocol, scope, route_type = RTPROT_BOOT, RT_SCOPE_LINK if gateway is None and family == socket.AF_INET else RT_SCOPE_UNIVERSE, RTN_UNICAST
+        attributes = rtattr(RTA_DST, socket.inet_pton(family, destination))
+        if gateway is not None:
+            attributes += rtattr(RTA_GATEWAY, socket.inet_pton(family, gateway))
+        if device is not None:
+            attributes += rtattr(RTA_OIF, struct.pack('=I', self.link_index(device)))
+        return RTMSG.pack(family, prefix_length, 0, 0, table, protocol, scope, route_type, 0) + attributes
+
+
+    def add_route(self, destination, prefix_length, gateway = None, device = None, table = RT_TABLE_MAIN): # "ip route add destination/prefix_length via gateway dev device table table"
+        description = 'route add ' + destination + '/' + str(prefix_length) + (' via ' + gateway if gateway is not None else '') + (' dev ' + device if device is not None else '') + (' table ' + str(table) if table != RT_TABLE_MAIN else '')
+        self.add(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, self.route(RTM_NEWROUTE, destination, prefix_length, gateway, device, table), description)
+
+
+    def delete_route(self, destination, prefix_length): # "ip route del destination/prefix_length"
+        self.add(RTM_DELROUTE, 0, self.route(RTM_DELROUTE, destination, prefix_length), 'route del ' + destination + '/' + str(prefix_length))
+
+
+    def rule(self, source, prefix_length, table):
+        family = address_family(source)
+        return FIB_RULE_HDR.pack(family, 0, prefix_length, 0, table, FR_ACT_TO_TBL, 0) + rtattr(FRA_SRC, socket.inet_pton(family, source))
+
+
+    def add_rule(self, source, prefix_length, table): # "ip rule add from source/prefix_length lookup table"
+        self.add(RTM_NEWRULE, NLM_F_CREATE | NLM_F_EXCL, self.rule(source, prefix_length, table), 'rule add from ' + source + '/' + str(prefix_length) + ' lookup ' + str(table))
+
+
+    def delete_rule(self, source, prefix_length, table): # "ip rule del from source/prefix_length lookup table"
+        self.add(RTM_DELRULE, 0, self.rule(source, prefix_length, table), 'rule del from ' + source + '/' + str(prefix_length) + ' lookup ' + str(table))
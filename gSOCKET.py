@@ -0,0 +1,562 @@
+import ctypes
+import socket
+import select
+import errno
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+# Batched datagram I/O (recvmmsg/sendmmsg) through ctypes, used by the ESP encoder/decoder processes
+# to move several packets per syscall instead of one select + recvfrom/sendto per packet.
+
+MSG_DONTWAIT = 0x40
+
+# UDP segmentation offload (linux >= 4.18) and UDP GRO (linux >= 5.0)
+SOL_UDP = 17
+UDP_SEGMENT = 103
+UDP_GRO = 104
+UDP_MAX_SEGMENTS = 64    # kernel limit of segments per send
+UDP_MAX_PAYLOAD = 65000  # below 64KB minus IP/UDP headers
+
+DEFAULT_MMSG_BUFFER_SIZE = 2048
+
+libc_mmsg = ctypes.CDLL('libc.so.6', use_errno=True)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t)
+    ]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int)
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint)
+    ]
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_uint16),
+        ('sin_addr', ctypes.c_uint8 * 4),
+        ('sin_zero', ctypes.c_uint8 * 8)
+    ]
+
+
+def return_sockaddr_in(address): #address = (ip, port)
+    sockaddr = sockaddr_in()
+    sockaddr.sin_family = socket.AF_INET
+    sockaddr.sin_port = socket.htons(address[1])
+    sockaddr.sin_addr = (ctypes.c_uint8 * 4)(*socket.inet_aton(address[0]))
+    return sockaddr
+
+
+def raise_errno():
+    e = ctypes.get_errno()
+    raise OSError(e, os.strerror(e))
+
+
+class mmsg_receiver():
+
+    def __init__(self, sock, batch_size, buffer_size = DEFAULT_MMSG_BUFFER_SIZE, zero_copy = False):
+        self.fd = sock.fileno()
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.zero_copy = zero_copy # True: packets are memoryviews of the receive buffer, only valid till the next recv
+        
+        # one contiguous buffer, each message gets a fixed slot of buffer_size bytes
+        self.buffers = ctypes.create_string_buffer(batch_size * buffer_size)
+        self.buffers_address = ctypes.addressof(self.buffers)
+        self.iovecs = (iovec * batch_size)()
+        self.msgs = (mmsghdr * batch_size)()
+        for i in range(batch_size):
+            self.iovecs[i].iov_base = self.buffers_address + i * buffer_size
+            self.iovecs[i].iov_len = buffer_size
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+        self.view = memoryview(self.buffers).cast('B')
+
+
+    def recv(self): #one recvmmsg, returns a list with up to batch_size packets (empty list if nothing to read)
+        n = libc_mmsg.recvmmsg(self.fd, self.msgs, self.batch_size, MSG_DONTWAIT, None)
+        if n < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise_errno()
+        if self.zero_copy:
+            return [self.view[i * self.buffer_size:i * self.buffer_size + self.msgs[i].msg_len] for i in range(n)]
+        return [ctypes.string_at(self.buffers_address + i * self.buffer_size, self.msgs[i].msg_len) for i in range(n)]
+
+
+    def drain(self): #yields packets until the socket queue is empty (EAGAIN)
+        while True:
+            packet_list = self.recv()
+            for packet in packet_list:
+                yield packet
+            if len(packet_list) < self.batch_size:
+                return
+
+
+class mmsg_sender():
+
+    def __init__(self, sock, address, batch_size):
+        self.fd = sock.fileno()
+        self.batch_size = batch_size
+
+        # all packets go to the same destination (ePDG/N3IWF)
+        self.address = return_sockaddr_in(address)
+        self.iovecs = (iovec * batch_size)()
+        self.msgs = (mmsghdr * batch_size)()
+        for i in range(batch_size):
+            self.msgs[i].msg_hdr.msg_name = ctypes.addressof(self.address)
+            self.msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+
+    def send(self, packet_list):
+        for position in range(0, len(packet_list), self.batch_size):
+            self.send_batch(packet_list[position:position + self.batch_size])
+
+
+    def send_batch(self, packet_list):
+        buffer_list = [] # keeps the buffers referenced while the kernel reads them
+        for i, packet in enumerate(packet_list):
+            if type(packet) is bytes:
+                buffer = ctypes.c_char_p(packet)
+            else: # writable buffer (memoryview of a bytearray), no copy
+                buffer = (ctypes.c_char * len(packet)).from_buffer(packet)
+            buffer_list.append(buffer)
+            self.iovecs[i].iov_base = ctypes.cast(buffer, ctypes.c_void_p)
+            self.iovecs[i].iov_len = len(packet)
+            
+        sent = 0
+        while sent < len(packet_list):
+            n = libc_mmsg.sendmmsg(self.fd, ctypes.byref(self.msgs, sent * ctypes.sizeof(mmsghdr)), len(packet_list) - sent, 0)
+            if n < 0:
+                if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): # socket buffer full (socket with timeout is non blocking)
+                    select.select([], [self.fd], [])
+                    continue
+                raise_errno()
+            sent += n
+
+
+def udp_gso_supported(sock): # getsockopt fails with ENOPROTOOPT if the kernel has no UDP_SEGMENT
+    try:
+        sock.getsockopt(SOL_UDP, UDP_SEGMENT)
+        return True
+    except OSError:
+        return False
+
+
+def enable_udp_gro(sock):
+    try:
+        sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+        return True
+    except OSError:
+        return False
+
+
+def non_blocking_socket(sock):
+    # same socket through a duplicated fd, without timeout. With a timeout, python waits for the socket to be readable/writable
+    # before each call (so MSG_DONTWAIT is ignored), and raises TimeoutError instead of BlockingIOError
+    nb_sock = socket.socket(fileno = os.dup(sock.fileno()))
+    nb_sock.setblocking(False)
+    return nb_sock
+
+
+class udp_gso_sender():
+    # consecutive packets with the same size (the last one of a group can be shorter) are sent in one sendmsg with UDP_SEGMENT,
+    # and the kernel splits them in datagrams. fallback (mmsg_sender or None for sendto) is used for single packets and if GSO fails
+
+    def __init__(self, sock, address, fallback = None):
+        self.sock = non_blocking_socket(sock)
+        self.address = address
+        self.fallback = fallback
+        self.enabled = True
+
+
+    def send(self, packet_list):
+        if self.enabled == False:
+            return self.send_fallback(packet_list)
+        position = 0
+        while position < len(packet_list):
+            size = len(packet_list[position])
+            end = position + 1
+            max_end = min(len(packet_list), position + UDP_MAX_SEGMENTS, position + UDP_MAX_PAYLOAD // size)
+            while end < max_end and len(packet_list[end]) == size:
+                end += 1
+            if end < max_end and len(packet_list[end]) < size: # shorter packet can close the group
+                end += 1
+            if end - position == 1:
+                self.send_fallback(packet_list[position:end])
+            elif self.send_segments(packet_list[position:end], size) == False:
+                self.enabled = False
+                return self.send_fallback(packet_list[position:])
+            position = end
+
+
+    def send_segments(self, packet_list, size):
+        while True:
+            try:
+                self.sock.sendmsg(packet_list, [(SOL_UDP, UDP_SEGMENT, struct.pack('H', size))], 0, self.address)
+                return True
+            except (BlockingIOError, InterruptedError): # socket buffer full
+                select.select([], [self.sock], [])
+            except OSError: # EIO if the device cannot do checksum offload, EINVAL for unsupported kernels
+                return False
+
+
+    def send_fallback(self, packet_list):
+        if self.fallback is not None:
+            self.fallback.send(packet_list)
+        else:
+            for packet in packet_list:
+                while True:
+                    try:
+                        self.sock.sendto(packet, self.address)
+                        break
+                    except (BlockingIOError, InterruptedError):
+                        select.select([], [self.sock], [])
+
+
+class udp_gro_receiver():
+    # with UDP_GRO the kernel coalesces datagrams of the same flow in one receive, the segment size comes in a control message
+
+    def __init__(self, sock, zero_copy = False):
+        self.sock = non_blocking_socket(sock)
+        self.zero_copy = zero_copy # True: packets are memoryviews of the received data
+        self.ancillary_size = socket.CMSG_SPACE(4)
+
+
+    def recv(self): # one recvmsg, returns a list of datagrams (empty list if nothing to read)
+        try:
+            data, ancillary_list, flags, address = self.sock.recvmsg(UDP_MAX_PAYLOAD + 1000, self.ancillary_size, MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return []
+        size = len(data)
+        for level, option, value in ancillary_list:
+            if level == SOL_UDP and option == UDP_GRO:
+                size = struct.unpack('i', value[0:4])[0]
+        if size >= len(data) or size <= 0:
+            return [data]
+        if self.zero_copy:
+            view = memoryview(data)
+            return [view[position:position + size] for position in range(0, len(data), size)]
+        return [data[position:position + size] for position in range(0, len(data), size)]
+
+
+    def drain(self): # yields datagrams until the socket queue is empty (EAGAIN)
+        while True:
+            packet_list = self.recv()
+            if packet_list == []:
+                return
+            for packet in packet_list:
+                yield packet
+
+
+# Single producer single consumer rings in shared memory for the messages between the IKE process and its worker processes
+# (instead of multiprocessing.Pipe, which pickles every message). A frame is a 4 byte length and the raw message. head (read
+# position, only written by the consumer) and tail (write position, only written by the producer) only grow, and frames wrap
+# around the end of the ring. An eventfd (a pipe if os.eventfd is not available) is readable while the ring may have frames,
+# so the receiving end can be used in select like a socket.
+
+DEFAULT_RING_SIZE = 256 * 1024
+RING_HEADER = struct.Struct('=QQ') # head, tail
+RING_POSITION = struct.Struct('=Q')
+RING_FRAME = struct.Struct('=I')   # message length
+RING_FULL_WAIT = 0.001             # seconds between checks while the ring is full
+
+
+class shm_ring():
+
+    def __init__(self, size = DEFAULT_RING_SIZE):
+        self.size = size
+        self.memory = shared_memory.SharedMemory(create = True, size = RING_HEADER.size + size)
+        self.memory.unlink() # the forked worker inherits the mapping, and nothing is left in /dev/shm when the processes exit
+        self.buffer = self.memory.buf # no other memoryview is kept, so that SharedMemory can be closed at exit
+        if hasattr(os, 'eventfd'):
+            self.read_fd = self.write_fd = os.eventfd(0, os.EFD_NONBLOCK)
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.read_fd, False)
+            os.set_blocking(self.write_fd, False)
+
+
+    def empty(self):
+        head, tail = RING_HEADER.unpack_from(self.buffer, 0)
+        return head == tail
+
+
+    def copy_in(self, position, data):
+        start = RING_HEADER.size + position % self.size
+        first = min(len(data), RING_HEADER.size + self.size - start)
+        self.buffer[start:start + first] = data[:first]
+        if first < len(data):
+            self.buffer[RING_HEADER.size:RING_HEADER.size + len(data) - first] = data[first:]
+
+
+    def copy_out(self, position, length):
+        start = RING_HEADER.size + position % self.size
+        end = RING_HEADER.size + self.size
+        if start + length <= end:
+            return bytes(self.buffer[start:start + length])
+        return bytes(self.buffer[start:end]) + bytes(self.buffer[RING_HEADER.size:RING_HEADER.size + length - (end - start)])
+
+
+    def put(self, message): # producer. Waits while there is no room for the frame
+        length = RING_FRAME.size + len(message)
+        if length > self.size:
+            raise ValueError('message larger than the ring')
+        head, tail = RING_HEADER.unpack_from(self.buffer, 0)
+        while self.size - (tail - head) < length:
+            select.select([], [], [], RING_FULL_WAIT)
+            head = RING_POSITION.unpack_from(self.buffer, 0)[0]
+        self.copy_in(tail, RING_FRAME.pack(len(message)))
+        self.copy_in(tail + RING_FRAME.size, message)
+        RING_POSITION.pack_into(self.buffer, 8, tail + length) # the frame is complete before the consumer can see it
+        self.signal()
+
+
+    def get(self): # consumer. Next message, or None if the ring is empty
+        head, tail = RING_HEADER.unpack_from(self.buffer, 0)
+        if head == tail:
+            return None
+        length = RING_FRAME.unpack(self.copy_out(head, RING_FRAME.size))[0]
+        message = self.copy_out(head + RING_FRAME.size, length)
+        RING_POSITION.pack_into(self.buffer, 0, head + RING_FRAME.size + length)
+        return message
+
+
+    def signal(self):
+        try:
+            os.write(self.write_fd, RING_POSITION.pack(1))
+        except BlockingIOError: # pipe full: already readable
+            pass
+
+
+    def clear_signal(self):
+        try:
+            while True:
+                os.read(self.read_fd, 4096)
+        except BlockingIOError:
+            pass
+
+
+class ring_connection():
+    # one end of a ring_pipe, with the send/recv/fileno of the multiprocessing.Connection it replaces
+
+    def __init__(self, send_ring, receive_ring):
+        self.send_ring = send_ring
+        self.receive_ring = receive_ring
+
+
+    def fileno(self):
+        return self.receive_ring.read_fd
+
+
+    def send(self, message):
+        self.send_ring.put(message)
+
+
+    def poll(self):
+        return not self.receive_ring.empty()
+
+
+    def recv(self): # waits for the next message. The fd stays readable while there are more
+        while True:
+            message = self.receive_ring.get()
+            if message is not None:
+                if self.receive_ring.empty():
+                    self.receive_ring.clear_signal()
+                    if not self.receive_ring.empty(): # put after the check: signal again
+                        self.receive_ring.signal()
+                return message
+            self.receive_ring.clear_signal()
+            if self.receive_ring.empty():
+                select.select([self.receive_ring.read_fd], [], [])
+
+
+def ring_pipe(size = DEFAULT_RING_SIZE): # same use as multiprocessing.Pipe(), for processes started with fork
+    ring_a, ring_b = shm_ring(size), shm_ring(size)
+    return ring_connection(ring_a, ring_b), ring_connection(ring_b, ring_a)
+
+
+# Classic BPF programs. Each instruction is (code, jt, jf, k), as in struct sock_filter. With SO_ATTACH_FILTER the program filters
+# the packets of one socket (0: drop). With SO_ATTACH_REUSEPORT_CBPF (linux >= 4.5) it chooses the socket of a SO_REUSEPORT group
+# for each datagram: the result is the index of the socket in bind order, and for UDP offset 0 is the start of the payload.
+
+SO_ATTACH_FILTER = 26
+SO_ATTACH_REUSEPORT_CBPF = 51
+BPF_LD_W_ABS = 0x20 # A = 32 bit word at offset k
+BPF_LD_W_LEN = 0x80 # A = packet length (UDP payload for SO_ATTACH_REUSEPORT_CBPF)
+BPF_JEQ_K = 0x15    # jump jt if A == k, else jf
+BPF_JGE_K = 0x35    # jump jt if A >= k, else jf
+BPF_RET_K = 0x06
+DROP_ALL_FILTER = [(BPF_RET_K, 0, 0, 0)] # every packet is dropped before it is queued in the socket
+
+# port 4500 (RFC 3948): IKE messages start with the 4 byte non-ESP marker (zero), ESP with the SPI. IKE to socket 0, ESP to socket 1.
+# Datagrams shorter than 4 bytes (NAT keepalives, 0xFF) go to socket 1, where the decoder ignores them as before the split
+NON_ESP_MARKER_STEERING = [
+    (BPF_LD_W_LEN, 0, 0, 0),
+    (BPF_JGE_K, 1, 0, 4),
+    (BPF_RET_K, 0, 0, 1),
+    (BPF_LD_W_ABS, 0, 0, 0),
+    (BPF_JEQ_K, 0, 1, 0),
+    (BPF_RET_K, 0, 0, 0),
+    (BPF_RET_K, 0, 0, 1)
+]
+
+
+def attach_socket_filter(sock, instructions, option = SO_ATTACH_FILTER):
+    program = ctypes.create_string_buffer(b''.join(struct.pack('HBBI', *instruction) for instruction in instructions))
+    sock.setsockopt(socket.SOL_SOCKET, option, struct.pack('HL', len(instructions), ctypes.addressof(program))) # struct sock_fprog, copied by the kernel
+
+
+def steered_udp_sockets(address, instructions, count = 2): # count UDP sockets bound to address in a SO_REUSEPORT group, with the steering program. None if not supported
+    sock_list = []
+    try:
+        for i in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock_list.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(address)
+            if i == 0:
+                attach_socket_filter(sock, instructions, SO_ATTACH_REUSEPORT_CBPF)
+        return sock_list
+    except OSError:
+        for sock in sock_list:
+            sock.close()
+        return None
+
+
+# ESP demultiplexer for several emulated UEs on the same host. Every raw ESP socket gets a copy of every ESP packet received by the host,
+# so with N UEs each packet is copied N times and wakes up N decoders. Instead one esp_demux_server reads all ESP once from its raw socket
+# and sends each packet to the UE that registered its SPI, through a unix datagram socket per UE (the per UE queue, read by its decoder).
+# The raw ESP socket of each UE is then only used to send, with DROP_ALL_FILTER. A UE registers by sending the list of its inbound SPIs
+# (4 bytes each, empty to unregister), and sends it again every time it changes. UEs that exit are removed when a packet can not be delivered.
+
+DEFAULT_ESP_DEMUX_BATCH_SIZE = 64
+DEFAULT_ESP_DEMUX_QUEUE_SIZE = 4 * 1024 * 1024 # receive buffer of each UE socket
+ESP_DEMUX_CLIENT_NAME = '\0nwu_emulator_esp_demux_' # abstract unix socket name, followed by the pid
+
+
+class esp_demux_server():
+
+    def __init__(self, path, batch_size = DEFAULT_ESP_DEMUX_BATCH_SIZE):
+        self.path = path
+        self.socket_esp = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ESP)
+        self.socket_control = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if os.path.exists(path): # left by a previous server
+            os.unlink(path)
+        self.socket_control.bind(path)
+        self.socket_control.setblocking(False)
+        self.receiver = mmsg_receiver(self.socket_esp, batch_size, zero_copy = True)
+        self.client_of = {}   # spi -> client address
+        self.spi_list_of = {} # client address -> spi list
+        self.unknown = 0      # packets with a SPI not registered
+        self.dropped = 0      # packets dropped because the queue of the UE was full
+
+
+    def update(self, client, spi_list):
+        for spi in self.spi_list_of.pop(client, []):
+            if self.client_of.get(spi) == client:
+                del self.client_of[spi]
+        if len(spi_list) > 0:
+            self.spi_list_of[client] = spi_list
+            for spi in spi_list:
+                self.client_of[spi] = client
+
+
+    def dispatch(self, packet): # packet with ip header, as received in the raw socket
+        header_length = (packet[0] % 16) * 4
+        client = self.client_of.get(bytes(packet[header_length:header_length + 4]))
+        if client is None:
+            self.unknown += 1
+            return
+        try:
+            self.socket_control.sendto(packet, client)
+        except BlockingIOError:
+            self.dropped += 1
+        except (ConnectionRefusedError, FileNotFoundError): # UE exited
+            self.update(client, [])
+
+
+    def receive_control(self):
+        while True:
+            try:
+                message, client = self.socket_control.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.update(client, [message[i:i + 4] for i in range(0, len(message) - len(message) % 4, 4)])
+
+
+    def run(self):
+        print('ESP demultiplexer listening in', self.path)
+        socket_list = [self.socket_esp, self.socket_control]
+        while True:
+            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [])
+            if self.socket_control in read_sockets:
+                self.receive_control()
+            if self.socket_esp in read_sockets:
+                for packet in self.receiver.drain():
+                    self.dispatch(packet)
+
+
+class esp_demux_client():
+
+    def __init__(self, path, queue_size = DEFAULT_ESP_DEMUX_QUEUE_SIZE):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) # ESP packets for this UE, with ip header
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, queue_size)
+        self.sock.bind(ESP_DEMUX_CLIENT_NAME + str(os.getpid()))
+        self.spi_list = []
+
+
+    def register(self, spi_list): # inbound SPIs of this UE. Only sent if they changed
+        spi_list = sorted(bytes(spi) for spi in spi_list)
+        if spi_list == self.spi_list:
+            return
+        self.spi_list = spi_list
+        try:
+            self.sock.sendto(b''.join(spi_list), self.path)
+        except OSError as e:
+            print('ESP demultiplexer not reachable in', self.path + ':', e)
+
+
+def test_udp_offload(): # GSO and GRO with sockets that have a timeout, as socket_nat: no TimeoutError, and GSO is not disabled by a full buffer
+    receiver_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_sock.bind(('127.0.0.1', 0))
+    receiver_sock.settimeout(2)
+    sender_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    sender_sock.settimeout(2)
+    if not udp_gso_supported(sender_sock) or not enable_udp_gro(receiver_sock):
+        print('UDP_SEGMENT/UDP_GRO not supported')
+        return
+    sender = udp_gso_sender(sender_sock, receiver_sock.getsockname())
+    for i in range(200):
+        sender.send([bytes([i]) * 1000] * 32)
+    assert sender.enabled == True
+    receiver = udp_gro_receiver(receiver_sock)
+    start = time.time()
+    received = sum(1 for packet in receiver.drain())
+    assert received > 0 and time.time() - start < 1
+    print('udp offload ok:', received, 'datagrams received')
+
+
+if __name__ == '__main__':
+    test_udp_offload()
@@ -0,0 +1,70 @@
+import sqlite3
+
+from Crypto.Cipher import AES
+from Crypto.Hash import HMAC
+from Crypto.Hash import SHA256
+from binascii import hexlify, unhexlify
+
+# Subscriber database for many UEs (option --subscriber-db): SQLite table indexed by IMSI, with Ki and the derived OPc,
+# so authentication does not depend on command line keys or cards, and OPc is not calculated again for each UE.
+# Ki and OPc are stored in hex digits, as given with -K and -C.
+
+
+def make_opc(ki, op): #OPc = E[OP]K xor OP (35.206 4.1). ki and op in bytes
+    return bytes(a ^ b for a, b in zip(AES.new(ki, AES.MODE_ECB).encrypt(op), op))
+
+
+def derive_ki(seed, imsi): #Ki of ranges generated from a seed: first 16 bytes of HMAC-SHA256(seed, imsi)
+    return HMAC.new(seed.encode('utf-8'), imsi.encode('utf-8'), digestmod = SHA256).digest()[0:16]
+
+
+class subscriber_database():
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS subscriber (imsi TEXT PRIMARY KEY, ki TEXT NOT NULL, opc TEXT NOT NULL) WITHOUT ROWID')
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def add(self, imsi, ki, opc): # existing IMSIs are replaced
+        self.add_list([(imsi, ki, opc)])
+
+
+    def add_list(self, subscriber_list): # (imsi, ki, opc) in one transaction
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO subscriber (imsi, ki, opc) VALUES (?, ?, ?)', subscriber_list)
+
+
+    def add_range(self, imsi, count, ki = None, op = None, opc = None, ki_seed = None):
+        # count IMSIs from imsi (same number of digits). Ki is the same for all, or derived from ki_seed. OPc is given, or
+        # calculated from op (once if Ki is the same for all)
+        subscriber_list = []
+        opc_of = {}
+        for n in range(count):
+            imsi_n = str(int(imsi) + n).zfill(len(imsi))
+            ki_n = hexlify(derive_ki(ki_seed, imsi_n)).decode('utf-8') if ki_seed is not None else ki
+            if opc is None and ki_n not in opc_of:
+                opc_of[ki_n] = hexlify(make_opc(unhexlify(ki_n), unhexlify(op))).decode('utf-8')
+            subscriber_list.append((imsi_n, ki_n, opc if opc is not None else opc_of[ki_n]))
+        self.add_list(subscriber_list)
+        return len(subscriber_list)
+
+
+    def get(self, imsi): # (ki, opc), or None if the IMSI is not in the database
+        return self.connection.execute('SELECT ki, opc FROM subscriber WHERE imsi = ?', (imsi,)).fetchone()
+
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM subscriber').fetchone()[0]
+
+
+    def close(self):
+        self.connection.close()
@@ -8,23 +8,30 @@ import sys
 import os
 import fcntl
 import subprocess
+import shutil
 import multiprocessing
+import collections
+import atexit
+import asyncio
+import copy
+import contextlib
 import requests
 
 from optparse import OptionParser
 from binascii import hexlify, unhexlify
+from multiprocessing import shared_memory
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import dh, padding
 from cryptography.hazmat.primitives import hashes, hmac
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
-from Crypto.Cipher import AES
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization
 from cryptography import exceptions
+from cryptography.hazmat.primitives import constant_time
 
 from smartcard.System import readers
 from smartcard.util import toHexString,toBytes
@@ -35,6 +42,10 @@ from CryptoMobile.Milenage import Milenage
 
 from gNAS import *
 from gSECURITY import *
+from gSOCKET import *
+from gNETLINK import *
+from gCHECKSUM import *
+from gSUBSCRIBER import *
 
 from datetime import datetime
 
@@ -70,6 +81,9 @@ INTER_PROCESS_TCP       = 5
 INTER_PROCESS_CREATE_SA_USERPLANE = 6
 INTER_PROCESS_UPDATE_SA_USERPLANE = 7
 INTER_PROCESS_DELETE_SA_USERPLANE = 8
+INTER_PROCESS_SA_USAGE = 9 #ESP worker -> IKE process: bytes and packets processed by an SA (for lifetimes in bytes/packets)
+INTER_PROCESS_RETIRE_SA = 10    #IKE process -> encoders: old SA of a rekey deleted by INFORMATIONAL exchange
+INTER_PROCESS_SA_CONFIRMED = 11 #decoder -> IKE process -> encoders: first packet authenticated with a new SA, the peer is using it
 
 
 INTER_PROCESS_IE_ENCR_ALG    = 1
@@ -84,6 +98,11 @@ INTER_PROCESS_IE_TCP_TERMINATE = 8
 INTER_PROCESS_IE_QFI = 9
 INTER_PROCESS_IE_USERPLANE_IP_ADDRESS = 10  #remote userplane ip address for GRE encapsulation received from N3IWF in Create_Child_SA
 INTER_PROCESS_IE_TUNNEL_IP_ADDRESS = 11     #local userplane ip address for GRE encapsulation
+INTER_PROCESS_IE_TUNNEL_MTU = 12            #userplane tun MTU (2 bytes), used by the encoder for TCP MSS clamping
+INTER_PROCESS_IE_ESN = 13                   #ESN transform negotiated for the SA (ESN_ESN: 64 bit sequence numbers)
+INTER_PROCESS_IE_BYTES = 14                 #8 bytes
+INTER_PROCESS_IE_PACKETS = 15               #8 bytes
+INTER_PROCESS_IE_WAIT_CONFIRMATION = 16     #1: rekey started by the peer, the encoders keep the old SA till the new one is confirmed
 
 ###################################################
 
@@ -119,9 +138,45 @@ TUNNEL_ID_NWU_USERPLANE_DATA = 3
 
 
 DEFAULT_TCP_SOCKET_NAMESPACE = 'tcp_socket_signalling'
+DEFAULT_USERPLANE_NAMESPACE = 'userplane' #userplane netns with the netns pool if there is no -n (name + '_<pid>')
+
+DEFAULT_USERPLANE_SWITCH_DEVICE = 'tun_userplane' #tun device shared by the UEs of the host in userplane switch mode
+DEFAULT_USERPLANE_SWITCH_TABLE = 100 #routing table with the default routes via the shared tun device, used by the UE addresses
+DEFAULT_USERPLANE_SWITCH_QUEUE_SIZE = 4 * 1024 * 1024 #receive buffer of each UE socket
+USERPLANE_SWITCH_CLIENT_NAME = '\0nwu_emulator_userplane_switch_' #abstract unix socket name, followed by the pid
+USERPLANE_SWITCH_HELLO = 0 #UE -> switch: answered with the fd of the shared tun device
+USERPLANE_SWITCH_ADDRESSES = 1 #UE -> switch: addresses of the UE, each one preceded by its length
 
 DEFAULT_NUMBER_OF_ITERATIONS = 1
 
+DEFAULT_UE_START_RATE = 0 #UEs started per second by the multi UE engine (0: all at once)
+
+DEFAULT_REPLAY_WINDOW_SIZE = 64 #anti-replay window of inbound ESP SAs (RFC 4303 3.4.3). Between 64 and 4096, or 0 to disable
+MIN_REPLAY_WINDOW_SIZE = 64
+MAX_REPLAY_WINDOW_SIZE = 4096
+
+DEFAULT_PATH_MTU = 1500 #used if the MTU of the route to the ePDG/N3IWF cannot be read
+IP_MTU = 14             #linux getsockopt option (current known path MTU of a connected socket)
+
+DEFAULT_FRAGMENT_TIMEOUT = 30        #seconds without new fragments before an incomplete packet is discarded
+DEFAULT_FRAGMENT_MEMORY = 4*1024*1024 #max bytes buffered for incomplete packets
+
+# zero copy mode: tun packets are read at ESP_BUFFER_HEADROOM in a preallocated buffer, so outer headers are written in place before them
+ESP_BUFFER_HEADROOM = 64 #outer IPv4 (20) + GRE (8) + ESP header (8) + IV (16), rounded up
+ESP_BUFFER_SIZE = 2048   #headroom + tun packet (1514) + padding + ICV + one block for update_into
+ESP_PADDING = bytes(range(1,256)) #RFC 4303 default padding: 1, 2, 3, ...
+
+DEFAULT_REKEY_MARGIN = 0.1  #SAs are rekeyed at their soft lifetime: 90% of the hard lifetime...
+DEFAULT_REKEY_JITTER = 0.1  #...minus a random 0 to 10%, so that the rekeys of many UEs are spread
+DEFAULT_USAGE_REPORT_INTERVAL = 1 #seconds between SA usage reports of the ESP workers, if there are lifetimes in bytes or packets
+DEFAULT_REKEY_DRAIN_WINDOW = 5 #seconds the ESP workers keep the old child SA after a rekey, if it is not deleted before (0: replaced at once)
+
+DEFAULT_SQN_BLOCK_SIZE = 32 #ESP sequence numbers reserved at a time by each uplink worker when there are several (should be far below the peer replay window)
+
+DEFAULT_SA_DATABASE_SLOTS = 64 #child SAs (inbound + outbound) in the shared memory SA database of the ESP workers
+SA_INBOUND = 0  #direction of the SAs in the SA database
+SA_OUTBOUND = 1
+
 #Interface type
 SWU = 0
 NWU = 1
@@ -186,6 +241,7 @@ ENCR_AES_CCM_16 = 16
 ENCR_AES_GCM_8 =  18
 ENCR_AES_GCM_12 = 19
 ENCR_AES_GCM_16 = 20
+ENCR_CHACHA20_POLY1305 = 28 #RFC 7634
 
 #Transform Type 2 - Pseudorandom Function Transform IDs
 PRF_HMAC_MD5 =          1
@@ -507,6 +563,7 @@ class nwu_swu():
 
         self.netns_name = netns
         self.userplane_tunnel_mtu = userplane_tunnel_mtu
+        self.userplane_tunnel_mtu_auto = userplane_tunnel_mtu is None #if not set with -U, the MTU is calculated from the negotiated child SA
         self.ca_certificate_pubkey = ca_certificate_pubkey
         self.handover = handover
         self.guti = guti
@@ -530,6 +587,36 @@ class nwu_swu():
         self.userplane_mode = ESP_PROTOCOL
 
         self.sk_ENCR_NULL_pad_length = 0 #[0 or 1 byte] SK payload is not defined for ENCR_NULL in RFC 5996 for IKEv2. Some vendors don't use pad length byte, others use.
+
+        self.batch_size = None #None: one packet per select wakeup in the ESP encoder/decoder. Otherwise max number of packets per recvmmsg/sendmmsg (batched I/O mode)
+        self.replay_window_size = DEFAULT_REPLAY_WINDOW_SIZE
+        self.udp_offload = False #True: UDP GSO (uplink) and UDP GRO (downlink) in the NAT-T socket, if the kernel supports them
+        self.zero_copy = False #True: ESP workers use preallocated buffers (read/recv into, headers packed and data encrypted in place)
+        self.tun_buffers = None
+        self.receive_buffer = None
+        self.decrypt_buffer = None
+        self.uplink_workers = 1 #number of encoder processes. If >1 the userplane tun device is multi queue and each encoder reads one queue
+        self.esn = False #True: ESN_ESN is chosen when offered in child SAs proposed by the N3IWF/ePDG
+        self.ike_lifetime = 0 #hard lifetimes of the SAs (0: no limit). SAs are rekeyed when their soft lifetime is reached
+        self.child_lifetime = 0
+        self.child_lifetime_bytes = 0
+        self.child_lifetime_packets = 0
+        self.ike_sa_lifetime = None   #sa_lifetime of the current IKE SA
+        self.child_sa_lifetime = None #sa_lifetime of the current child SA (SWU)
+        self.rekey_drain_window = DEFAULT_REKEY_DRAIN_WINDOW
+        self.spi_init_child_old = None #child SA replaced by the last rekey, till it is deleted
+        self.spi_resp_child_old = None
+        self.child_delete_pending = False #INFORMATIONAL delete of the old child SA sent, waiting for the response
+        self.shared_sqn_index = 0
+        self.shared_sqn_userplane_index = 0
+        self.sa_database = None #child SAs read by the ESP workers (sa_database)
+        self.sa_database_spi = {} #(direction, userplane) -> spi of the current SA in the SA database
+        self.socket_nat_esp = None #ESP in udp 4500, if the kernel splits it from IKE (set_ike_esp_split). Otherwise both arrive in socket_nat
+        self.esp_demux = None #esp_demux_client if inbound ESP is received from a shared esp_demux_server instead of the raw ESP socket
+        self.netns_pool = None #netns_tun_pool with the tun devices prepared before the first session
+        self.tun_name_suffix = '' #tun devices and signalling netns have unique names (pid) with the netns pool
+        self.tcp_socket_namespace = DEFAULT_TCP_SOCKET_NAMESPACE
+        self.userplane_switch = None #userplane_switch_client if the userplane tun device is shared with the other UEs of the host
         
     def set_variables(self):
         self.port = DEFAULT_IKE_PORT
@@ -716,6 +803,9 @@ class nwu_swu():
             encr_alg = "AES-CBC-128 [RFC3602]"
         elif key_size == 256 and self.negotiated_encryption_algorithm == ENCR_AES_CBC:
             encr_alg = "AES-CBC-256 [RFC3602]"
+        elif self.negotiated_encryption_algorithm in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16):
+            icv_size = {ENCR_AES_GCM_8 : 8, ENCR_AES_GCM_12 : 12, ENCR_AES_GCM_16 : 16}.get(self.negotiated_encryption_algorithm)
+            encr_alg = "AES-GCM-" + str(key_size) + " with " + str(icv_size) + " octet ICV [RFC5282]"
         elif self.negotiated_encryption_algorithm == ENCR_NULL:
             encr_alg = "NULL [RFC2410]"
         return encr_alg
@@ -741,6 +831,8 @@ class nwu_swu():
             encr_alg = "AES-GCM [RFC4106]"
         elif self.negotiated_encryption_algorithm_child == ENCR_AES_GCM_16:
             encr_alg = "AES-GCM [RFC4106]"            
+        elif self.negotiated_encryption_algorithm_child == ENCR_CHACHA20_POLY1305:
+            encr_alg = "ChaCha20 with Poly1305 [RFC7634]"
         elif self.negotiated_encryption_algorithm_child == ENCR_NULL:
             encr_alg = "NULL"
         return encr_alg    
@@ -781,6 +873,73 @@ class nwu_swu():
     def set_timeout(self,value):
         self.timeout = value
         
+    def set_batch_size(self,value):
+        self.batch_size = value
+
+    def set_replay_window_size(self,value):
+        self.replay_window_size = value
+
+    def set_udp_offload(self,value):
+        self.udp_offload = value
+
+    def set_zero_copy(self,value):
+        self.zero_copy = value
+
+    def set_uplink_workers(self,value):
+        self.uplink_workers = value
+
+    def set_esn(self,value):
+        self.esn = value
+
+    def set_ike_lifetime(self,value):
+        self.ike_lifetime = value
+
+    def set_child_lifetime(self,seconds,bytes,packets):
+        self.child_lifetime = seconds
+        self.child_lifetime_bytes = bytes
+        self.child_lifetime_packets = packets
+
+    def set_rekey_drain_window(self,value):
+        self.rekey_drain_window = value
+
+    def set_ike_esp_split(self,value): #IKE in udp 4500 is received in socket_nat by the IKE process, and ESP in socket_nat_esp by the decoder
+        if value == False: return
+        self.socket_nat.close()
+        sock_list = steered_udp_sockets(self.client_address_nat, NON_ESP_MARKER_STEERING)
+        if sock_list is None:
+            print('SO_ATTACH_REUSEPORT_CBPF not supported. IKE in udp 4500 is forwarded by the ESP decoder')
+            self.create_socket_nat(self.client_address_nat)
+            return
+        self.socket_nat, self.socket_nat_esp = sock_list
+        self.socket_nat.settimeout(self.timeout)
+
+    def set_netns_pool(self,value):
+        if value == False: return
+        self.netns_pool = netns_tun_pool()
+        self.tun_name_suffix = '_' + str(os.getpid())
+        self.tcp_socket_namespace = DEFAULT_TCP_SOCKET_NAMESPACE + self.tun_name_suffix
+        if self.userplane_switch is None: #the userplane tun device has its own netns, so the routes of several instances do not collide
+            self.netns_name = (self.netns_name or DEFAULT_USERPLANE_NAMESPACE) + self.tun_name_suffix
+        atexit.register(self.netns_pool.close)
+
+    def set_esp_demux(self,path): #the raw ESP socket is only used to send
+        self.esp_demux = esp_demux_client(path)
+        attach_socket_filter(self.socket_esp, DROP_ALL_FILTER)
+
+    def set_userplane_switch(self,path): #uplink is read from the switch socket, downlink is written to the shared tun device
+        if self.interface_type != NWU:
+            print('Userplane switch only used in NWU')
+            return
+        try:
+            self.userplane_switch = userplane_switch_client(path)
+        except OSError as e:
+            print('Userplane switch not reachable in', path + ':', e)
+            exit(1)
+        if self.netns_name:
+            print('Userplane switch: netns ignored, the shared tun device is in the default netns')
+            self.netns_name = None
+        self.uplink_workers = 1 #the switch sends the packets of this UE to one socket
+        
     def set_udp(self):
         self.socket_type = UDP
 
@@ -1175,20 +1334,9 @@ class nwu_swu():
         
             encrypted_data = data[16:len(data)-hash_size]
             
-            if self.ike_decoded_header['flags'][2] == ROLE_RESPONDER:
-                if self.old_ike_message_received == True:
-                    cipher = Cipher(algorithms.AES(self.SK_ER_old), modes.CBC(vector))                  
-                else:
-                    cipher = Cipher(algorithms.AES(self.SK_ER), modes.CBC(vector))  
-            else:
-                if self.old_ike_message_received == True:
-                    cipher = Cipher(algorithms.AES(self.SK_EI_old), modes.CBC(vector)) 
-                else:                
-                    cipher = Cipher(algorithms.AES(self.SK_EI), modes.CBC(vector))  
-                
-            decryptor = cipher.decryptor()
-            
-            uncipher_data = decryptor.update(encrypted_data) + decryptor.finalize()
+            sa = self.get_ike_sa_context(self.ike_decoded_header['flags'][2])
+            uncipher_data = sa.cbc_decrypt(vector, encrypted_data)
+            if uncipher_data is None: return
                        
             padding_length = uncipher_data[-1]
             ike_payload = uncipher_data[0:-padding_length-1]
@@ -1206,6 +1354,24 @@ class nwu_swu():
             (result_ok, decoded_payload) = self.decode_payload(ike_payload, self.current_next_payload,0)
             if result_ok == True:
                 return decoded_payload                
+
+        elif self.negotiated_encryption_algorithm in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16):
+            #RFC 5282: 8 bytes IV, no INTEG transform. AAD is the IKE header and the SK payload header (everything before the IV)
+            sa = self.get_ike_sa_context(self.ike_decoded_header['flags'][2])
+            vector = data[0:8]
+            encrypted_data = data[8:len(data)-sa.mac_length]
+            tag = data[len(data)-sa.mac_length:]
+            aad = self.current_packet_received[0:len(self.current_packet_received)-len(data)]
+
+            uncipher_data = sa.aead_decrypt(vector, encrypted_data, tag, aad)
+            if uncipher_data is None: return
+
+            padding_length = uncipher_data[-1]
+            ike_payload = uncipher_data[0:-padding_length-1]
+
+            (result_ok, decoded_payload) = self.decode_payload(ike_payload, self.current_next_payload,0)
+            if result_ok == True:
+                return decoded_payload
                 
                 
         
@@ -1366,6 +1532,7 @@ class nwu_swu():
         integrity_algorithm = None
         diffie_hellman_group = None
         esn = None
+        esn_list = []
 
         proposal_length = struct.unpack("!H", data[2:4])[0]
         protocol_id = data[5]
@@ -1387,8 +1554,16 @@ class nwu_swu():
             elif data[position+4] == D_H: 
                 diffie_hellman_group = struct.unpack("!H", data[position+6:position+8])[0]
             elif data[position+4] == ESN: 
-                esn = struct.unpack("!H", data[position+6:position+8])[0]
+                esn_list.append(struct.unpack("!H", data[position+6:position+8])[0])
             position += transform_length
+
+        if esn_list != []: #proposal may offer both ESN transforms: ESN_ESN if enabled
+            if self.esn == True and ESN_ESN in esn_list:
+                esn = ESN_ESN
+            elif ESN_NO_ESN in esn_list:
+                esn = ESN_NO_ESN
+            else:
+                esn = esn_list[0]
         
         sa_list = []
         sa_list.append([protocol_id, spi_size])
@@ -1403,6 +1578,13 @@ class nwu_swu():
         if esn is not None: sa_list.append([ESN,esn])     
         
         return [sa_list], spi
+
+
+    def decode_sa_child_proposal_esn(self,data): #ESN transform of the proposal (in an answer, the one chosen by the responder), or None
+        sa_list, spi = self.decode_sa_child_proposal(data)
+        for i in sa_list[0][1:]:
+            if i[0] == ESN: return i[1]
+        return None
     
  
 #######################################################################################################################
@@ -1645,6 +1827,8 @@ class nwu_swu():
     def encode_payload_type_sk(self,ike_packet):
 
         hash_size = self.integ_key_truncated_len_bytes.get(self.negotiated_integrity_algorithm)
+        flags_role = self.return_flags(ike_packet[19])[2]
+        sa = self.get_ike_sa_context(flags_role)
         
         if self.negotiated_encryption_algorithm in (ENCR_AES_CBC,):
             vector = self.return_random_bytes(16)
@@ -1656,44 +1840,14 @@ class nwu_swu():
             else:
                 data_to_encrypt += b'\x00'*(15+res) + bytes([15+res])
             
-            
-            flags_role = self.return_flags(ike_packet[19])[2]  
-            
-            if flags_role == ROLE_INITIATOR:    
-                if self.old_ike_message_received == True:            
-                    cipher = Cipher(algorithms.AES(self.SK_EI_old), modes.CBC(vector))                
-                else:
-                    cipher = Cipher(algorithms.AES(self.SK_EI), modes.CBC(vector))
-            else:
-                if self.old_ike_message_received == True:
-                    cipher = Cipher(algorithms.AES(self.SK_ER_old), modes.CBC(vector))                
-                else:
-                    cipher = Cipher(algorithms.AES(self.SK_ER), modes.CBC(vector))
-            
-            encryptor = cipher.encryptor()          
-            cipher_data = encryptor.update(data_to_encrypt) + encryptor.finalize()
+            cipher_data = sa.cbc_encrypt(vector, data_to_encrypt)
                       
             sk_payload = self.encode_generic_payload_header(ike_packet[16],0,vector + cipher_data + b'\x00'*hash_size) #add a dummy hash to calculate correct length    
             new_ike_packet = ike_packet[0:16] + bytes([SK]) + ike_packet[17:28] + sk_payload        
             new_ike_packet = self.set_ike_packet_length(new_ike_packet)
             new_ike_packet_to_integrity = new_ike_packet[0:-hash_size]           
-            hash = self.integ_function.get(self.negotiated_integrity_algorithm) 
-            
-            if flags_role == ROLE_INITIATOR:  
-                if self.old_ike_message_received == True:            
-                    h = hmac.HMAC(self.SK_AI_old,hash)                
-                else:    
-                    h = hmac.HMAC(self.SK_AI,hash)
-            else:
-                if self.old_ike_message_received == True:
-                    h = hmac.HMAC(self.SK_AR_old,hash) 
-                else:
-                    h = hmac.HMAC(self.SK_AR,hash)            
-                
-            h.update(new_ike_packet_to_integrity)
-            hash = h.finalize()[0:hash_size]         
             
-            return new_ike_packet_to_integrity + hash
+            return new_ike_packet_to_integrity + sa.integrity(new_ike_packet_to_integrity)
     
 
         elif self.negotiated_encryption_algorithm in (ENCR_NULL,):
@@ -1705,24 +1859,19 @@ class nwu_swu():
             new_ike_packet = ike_packet[0:16] + bytes([SK]) + ike_packet[17:28] + sk_payload        
             new_ike_packet = self.set_ike_packet_length(new_ike_packet)
             new_ike_packet_to_integrity = new_ike_packet[0:-hash_size]           
-            hash = self.integ_function.get(self.negotiated_integrity_algorithm) 
-            
-            flags_role = self.return_flags(ike_packet[19])[2]            
-            if flags_role == ROLE_INITIATOR:  
-                if self.old_ike_message_received == True:            
-                    h = hmac.HMAC(self.SK_AI_old,hash)                
-                else:    
-                    h = hmac.HMAC(self.SK_AI,hash)
-            else:
-                if self.old_ike_message_received == True:
-                    h = hmac.HMAC(self.SK_AR_old,hash) 
-                else:
-                    h = hmac.HMAC(self.SK_AR,hash)            
-                
-            h.update(new_ike_packet_to_integrity)
-            hash = h.finalize()[0:hash_size]         
             
-            return new_ike_packet_to_integrity + hash        
+            return new_ike_packet_to_integrity + sa.integrity(new_ike_packet_to_integrity)        
+
+        elif self.negotiated_encryption_algorithm in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16):
+            vector = self.return_random_bytes(8)
+            data_to_encrypt = ike_packet[28:] + b'\x00' #no alignment needed (RFC 5282), only the pad length
+
+            sk_payload = self.encode_generic_payload_header(ike_packet[16],0,vector + b'\x00'*(len(data_to_encrypt) + sa.mac_length)) #dummy data and tag to calculate correct length
+            new_ike_packet = ike_packet[0:16] + bytes([SK]) + ike_packet[17:28] + sk_payload
+            new_ike_packet = self.set_ike_packet_length(new_ike_packet)
+            aad = new_ike_packet[0:32] #IKE header + SK payload header
+
+            return aad + vector + sa.aead_encrypt(vector, data_to_encrypt, aad)
         
         
     def encode_5g_plmnid(self,mccmnc):
@@ -1776,13 +1925,42 @@ class nwu_swu():
 
 ### USER PLANE FUNCTIONS AND INTER PROCESS COMMUNICATION ####
 
-    def exec_in_netns(self, cmd, shell=True, signalling=False):
-        if self.netns_name and not signalling:
-            cmd = "ip netns exec %s %s" % (self.netns_name, cmd)
-        elif signalling:
-            cmd = "ip netns exec %s %s" % (DEFAULT_TCP_SOCKET_NAMESPACE, cmd)        
-        print("cmd: %s" % cmd)
-        subprocess.call(cmd, shell=shell)
+    def netlink_commit(self,nl): #sends the queued rtnetlink operations. Errors are printed, and the setup goes on
+        for description, error in nl.commit():
+            print('netlink error: ' + description + ': ' + os.strerror(error))
+
+    def move_to_netns(self,device,netns): #creates the netns if it does not exist. Moving to netns brings the device down again
+        add_netns(netns)
+        with rtnetlink() as nl:
+            nl.set_link(device, netns=netns)
+            self.netlink_commit(nl)
+
+    def tun_name(self,n):
+        return "tun%d" % n + self.tun_name_suffix
+
+    def prepare_netns_pool(self): #tun devices created, moved to their netns and up before the first session, so that the session setup only sets addresses and routes
+        if self.netns_pool is None: return
+        if self.interface_type == SWU:
+            tun_list = [(TUNNEL_ID_SWU, self.netns_name, self.uplink_workers > 1)]
+        else:
+            tun_list = [(TUNNEL_ID_NWU_USERPLANE_DATA, self.netns_name, self.uplink_workers > 1), (TUNNEL_ID_NWU_TCP, self.tcp_socket_namespace, False)]
+            if self.userplane_switch is not None: del tun_list[0]
+        for n, netns, multi_queue in tun_list:
+            tunnel = self.open_tun(n, multi_queue)
+            tunnel_queues = self.open_tun_queues(n) if multi_queue == True else [] #must be attached before moving the device to the netns
+            if netns:
+                if not os.path.exists(netns_path(netns)): self.netns_pool.netns_list.append(netns)
+                self.move_to_netns(self.tun_name(n), netns)
+                with rtnetlink(netns) as nl:
+                    nl.set_link(self.tun_name(n), up=True)
+                    self.netlink_commit(nl)
+            self.netns_pool.add(n, self.tun_name(n), netns, tunnel, tunnel_queues)
+
+    def delete_netns(self,netns):
+        try:
+            delete_netns(netns)
+        except OSError as e:
+            print('unable to delete netns ' + netns + ': ' + str(e))
 
     def add_dir(self):
         if not os.path.isdir('/etc/netns'):        
@@ -1790,76 +1968,177 @@ class nwu_swu():
         if not os.path.isdir('/etc/netns/' + self.netns_name):   
             os.mkdir('/etc/netns/'  + self.netns_name)
 
+    def get_path_mtu(self): #MTU of the route to the ePDG/N3IWF
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((self.source_address, 0))
+            sock.connect(self.server_address)
+            mtu = sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+            sock.close()
+            return mtu
+        except:
+            return DEFAULT_PATH_MTU
+
+
+    def get_userplane_tunnel_mtu(self): #largest inner packet that fits in one outer packet with the negotiated child SA
+        overhead = 20 + 8 #outer ipv4 header + ESP header (SPI + sequence number)
+        if self.userplane_mode == NAT_TRAVERSAL: overhead += 8 #UDP header
+        
+        encr_alg = self.negotiated_encryption_algorithm_child
+        if encr_alg in (ENCR_AES_CBC,):
+            overhead += 16 + self.integ_key_truncated_len_bytes.get(self.negotiated_integrity_algorithm_child, 0) #IV + ICV
+            block_size = 16
+        elif encr_alg in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16, ENCR_CHACHA20_POLY1305):
+            overhead += 8 + {ENCR_AES_GCM_8: 8, ENCR_AES_GCM_12: 12, ENCR_AES_GCM_16: 16, ENCR_CHACHA20_POLY1305: 16}[encr_alg] #IV + ICV
+            block_size = 4
+        else:
+            overhead += self.integ_key_truncated_len_bytes.get(self.negotiated_integrity_algorithm_child, 0) #ICV
+            block_size = 4
+        
+        mtu = ((self.get_path_mtu() - overhead) // block_size) * block_size - 2 #padding alignment + pad length + next header
+        if self.interface_type == NWU: mtu -= 20 + 8 #inner ipv4 header + GRE header (24.502, section 9.3.3)
+        return mtu
+
+
+    def set_userplane_tunnel_mtu(self):
+        if self.userplane_tunnel_mtu_auto == True:
+            self.userplane_tunnel_mtu = self.get_userplane_tunnel_mtu()
+            print('USERPLANE TUNNEL MTU', self.userplane_tunnel_mtu)
+
+
+    def add_tunnel_mtu_ie(self,inter_process_list): #so that the encoder clamps the MSS of TCP SYN packets
+        if self.userplane_tunnel_mtu is not None:
+            inter_process_list[1].append((INTER_PROCESS_IE_TUNNEL_MTU, struct.pack("!H", int(self.userplane_tunnel_mtu))))
+
+
+    def start_ike_sa_lifetime(self):
+        if self.ike_lifetime > 0:
+            self.ike_sa_lifetime = sa_lifetime(self.ike_lifetime)
+
+
+    def start_child_sa_lifetime(self): #SWU only, in NWU the child SAs are rekeyed by the N3IWF
+        if self.interface_type == NWU: return
+        if self.child_lifetime > 0 or self.child_lifetime_bytes > 0 or self.child_lifetime_packets > 0:
+            self.child_sa_lifetime = sa_lifetime(self.child_lifetime, self.child_lifetime_bytes, self.child_lifetime_packets, [self.spi_init_child, self.spi_resp_child])
+
+
+    def update_sa_usage(self,worker,decode_list): #INTER_PROCESS_SA_USAGE received from an ESP worker
+        if self.child_sa_lifetime is None: return
+        for i in decode_list[1]:
+            if i[0] == INTER_PROCESS_IE_SPI_INIT: spi = i[1]
+            if i[0] == INTER_PROCESS_IE_BYTES: bytes = struct.unpack("!Q", i[1])[0]
+            if i[0] == INTER_PROCESS_IE_PACKETS: packets = struct.unpack("!Q", i[1])[0]
+        self.child_sa_lifetime.update(worker, spi, bytes, packets)
+
+
+    def lifetime_timeout(self): #select timeout of the connected states
+        timeout_list = [i.timeout() for i in (self.ike_sa_lifetime, self.child_sa_lifetime) if i is not None]
+        timeout_list = [i for i in timeout_list if i is not None]
+        if timeout_list == []: return None
+        return min(timeout_list)
+
+
+    def check_lifetimes(self): #starts the rekey of an SA that reached its soft lifetime (one rekey at a time). If the hard lifetime is reached before the rekey is done, it is tried again
+        lifetime_list = [(self.ike_sa_lifetime, 'IKE SA', self.state_ue_create_sa), (self.child_sa_lifetime, 'CHILD SA', self.state_ue_create_sa_child)]
+        rekey_pending = False
+        for lifetime, name, rekey in lifetime_list:
+            if lifetime is not None and lifetime.soft_expired == True:
+                rekey_pending = True
+                if lifetime.hard_expired == False and lifetime.expired(lifetime.hard):
+                    lifetime.hard_expired = True
+                    print(name + ' HARD LIFETIME REACHED BEFORE REKEY. RETRYING')
+                    rekey()
+        if rekey_pending == True: return
+        for lifetime, name, rekey in lifetime_list:
+            if lifetime is not None and lifetime.expired(lifetime.soft):
+                lifetime.soft_expired = True
+                print(name + ' SOFT LIFETIME REACHED')
+                rekey()
+                return
+
+
     def set_routes(self):
     
+        self.set_userplane_tunnel_mtu()
         self.tunnel_userplane = None #Not used in SWU Mode
-        self.tunnel = self.open_tun(TUNNEL_ID_SWU)
-        self.tun_device = "tun%d" % TUNNEL_ID_SWU        
+        if self.netns_pool is not None:
+            self.tunnel, self.tunnel_queues = self.netns_pool.get(TUNNEL_ID_SWU)
+        else:
+            self.tunnel = self.open_tun(TUNNEL_ID_SWU, self.uplink_workers > 1)
+            self.tunnel_queues = self.open_tun_queues(TUNNEL_ID_SWU) #must be attached before moving the device to the netns
+        self.tun_device = self.tun_name(TUNNEL_ID_SWU)
         
-        if self.netns_name:
-            # create netns adn move the tun device into it
-            subprocess.call("ip netns add %s" % self.netns_name, shell=True)
-            subprocess.call("ip link set dev %s netns %s" % (self.tun_device, self.netns_name), shell=True)
-            # moving to netns brings device down again
-            self.exec_in_netns("ip link set dev %s up" % (self.tun_device))
+        ip_address = self.ip_address_list[0] if self.ip_address_list != [] else None
+        ipv6_address = self.ipv6_address_list[0] if self.ipv6_address_list != [] else None
+        self.set_routes_tun(ip_address, ipv6_address)
 
-        if self.userplane_tunnel_mtu is not None:
-            try:
-                self.exec_in_netns("ip link set dev %s mtu %s" % (self.tun_device, self.userplane_tunnel_mtu))
-            except:
-                pass
 
-        if self.ip_address_list != []:
-            self.exec_in_netns("ip addr add " + self.ip_address_list[0] + "/32 dev " + self.tun_device)
-            #set host route, only  required if no netns
-            if not self.netns_name:
-                if self.default_gateway is None:
-                    self.exec_in_netns("route add " + self.server_address[0] + "/32 gw " + self.get_default_gateway_linux()[0])
-                else:
-                    self.exec_in_netns("route add " + self.server_address[0] + "/32 gw " + self.default_gateway)
-                
-            self.exec_in_netns("route add -net 0.0.0.0/1 gw " + self.ip_address_list[0])
-            self.exec_in_netns("route add -net 128.0.0.0/1 gw " + self.ip_address_list[0])
-        
-        if self.ipv6_address_list != []:
-            ipv6_address_prefix = ':'.join(self.ipv6_address_list[0].split(':')[0:4])
-            ipv6_address_identifier = 'fe80::' + ':'.join(self.ipv6_address_list[0].split(':')[4:8])
-            self.exec_in_netns("ip -6 addr add " + ipv6_address_identifier + "/64 dev " + self.tun_device)
-            self.exec_in_netns("route -A inet6 add ::/1 dev " + self.tun_device)
-            self.exec_in_netns("route -A inet6 add 8000::/1 dev " + self.tun_device)
-        
+    def set_routes_tun(self,ip_address,ipv6_address): #userplane tun device (self.tun_device): netns, MTU, addresses, routes and DNS, with one rtnetlink batch
+        if self.netns_name and self.netns_pool is None: #already there if prepared by the netns pool
+            self.move_to_netns(self.tun_device, self.netns_name)
+
+        with rtnetlink(self.netns_name or None) as nl:
+            if self.netns_name or self.netns_pool is not None: #down after the move to the netns, or after the flush of the previous session
+                nl.set_link(self.tun_device, up=True)
+
+            if self.userplane_tunnel_mtu is not None:
+                nl.set_link(self.tun_device, mtu=self.userplane_tunnel_mtu)
+
+            if ip_address is not None:
+                nl.add_address(self.tun_device, ip_address, 32)
+                #set host route, only  required if no netns
+                if not self.netns_name:
+                    if self.default_gateway is None:
+                        nl.add_route(self.server_address[0], 32, gateway=self.get_default_gateway_linux()[0])
+                    else:
+                        nl.add_route(self.server_address[0], 32, gateway=self.default_gateway)
+                    
+                nl.add_route('0.0.0.0', 1, gateway=ip_address)
+                nl.add_route('128.0.0.0', 1, gateway=ip_address)
+            
+            if ipv6_address is not None:
+                ipv6_address_identifier = 'fe80::' + ':'.join(ipv6_address.split(':')[4:8])
+                nl.add_address(self.tun_device, ipv6_address_identifier, 64)
+                nl.add_route('::', 1, device=self.tun_device)
+                nl.add_route('8000::', 1, device=self.tun_device)
+
+            self.netlink_commit(nl)
         
         if self.dns_address_list != [] or self.dnsv6_address_list != []:
             if self.netns_name:
                 self.add_dir() #create directory for namespace if it doesn't exist
-                
-                with open("/etc/netns/%s/resolv.conf" % self.netns_name, "w") as file_obj:
-                    for i in self.dns_address_list:
-                        file_obj.write("nameserver %s\n" % i)
-                    for i in self.dnsv6_address_list:
-                        file_obj.write("nameserver %s\n" % i)
+                resolv_conf = "/etc/netns/%s/resolv.conf" % self.netns_name
             else:
-                subprocess.call("cp /etc/resolv.conf /etc/resolv.backup.conf", shell=True)  
-                subprocess.call("echo > /etc/resolv.conf", shell=True) 
-                for i in self.dns_address_list:
-                    subprocess.call("echo 'nameserver " + i +"' >> /etc/resolv.conf", shell=True)  
-                for i in self.dnsv6_address_list:
-                    subprocess.call("echo 'nameserver " + i +"' >> /etc/resolv.conf", shell=True)    
+                shutil.copyfile("/etc/resolv.conf", "/etc/resolv.backup.conf")
+                resolv_conf = "/etc/resolv.conf"
+            with open(resolv_conf, "w") as file_obj:
+                for i in self.dns_address_list + self.dnsv6_address_list:
+                    file_obj.write("nameserver %s\n" % i)
 
 
     def set_routes_nwu_tcp(self):
     
-        self.tunnel_userplane = self.open_tun(TUNNEL_ID_NWU_USERPLANE_DATA)  
-        self.tunnel = self.open_tun(TUNNEL_ID_NWU_TCP)
+        if self.userplane_switch is not None: #downlink is written to the shared tun device, uplink is read from the switch socket
+            self.tunnel_userplane, self.tunnel_userplane_queues = self.userplane_switch.tunnel, []
+        elif self.netns_pool is not None:
+            self.tunnel_userplane, self.tunnel_userplane_queues = self.netns_pool.get(TUNNEL_ID_NWU_USERPLANE_DATA)
+        else:
+            self.tunnel_userplane = self.open_tun(TUNNEL_ID_NWU_USERPLANE_DATA, self.uplink_workers > 1)  
+            self.tunnel_userplane_queues = self.open_tun_queues(TUNNEL_ID_NWU_USERPLANE_DATA) #must be attached before moving the device to the netns
+        if self.netns_pool is not None:
+            self.tunnel = self.netns_pool.get(TUNNEL_ID_NWU_TCP)[0]
+        else:
+            self.tunnel = self.open_tun(TUNNEL_ID_NWU_TCP)
        
-        self.tun_device_tcp = "tun%d" % TUNNEL_ID_NWU_TCP
+        self.tun_device_tcp = self.tun_name(TUNNEL_ID_NWU_TCP)
      
-        subprocess.call("ip netns add %s" % DEFAULT_TCP_SOCKET_NAMESPACE, shell=True)
-        subprocess.call("ip link set dev %s netns %s" % (self.tun_device_tcp, DEFAULT_TCP_SOCKET_NAMESPACE), shell=True)
-        # moving to netns brings device down again
-        self.exec_in_netns("ip link set dev %s up" % (self.tun_device_tcp), signalling = True)
-        self.exec_in_netns("ip addr add " + self.tunnel_ipv4_address + "/32 dev " + self.tun_device_tcp, signalling = True)
-        self.exec_in_netns("route add -net 0.0.0.0/0 gw " + self.tunnel_ipv4_address, signalling = True )
+        if self.netns_pool is None:
+            self.move_to_netns(self.tun_device_tcp, self.tcp_socket_namespace)
+        with rtnetlink(self.tcp_socket_namespace) as nl:
+            nl.set_link(self.tun_device_tcp, up=True)
+            nl.add_address(self.tun_device_tcp, self.tunnel_ipv4_address, 32)
+            nl.add_route('0.0.0.0', 0, gateway=self.tunnel_ipv4_address)
+            self.netlink_commit(nl)
     
         return        
 
@@ -1879,78 +2158,73 @@ class nwu_swu():
         else:
             userplane_ipv6_address = None
 
-        self.tun_device = "tun%d" % TUNNEL_ID_NWU_USERPLANE_DATA        
-        
-        if self.netns_name:
-            # create netns adn move the tun device into it
-            subprocess.call("ip netns add %s" % self.netns_name, shell=True)
-            subprocess.call("ip link set dev %s netns %s" % (self.tun_device, self.netns_name), shell=True)
-            # moving to netns brings device down again
-            self.exec_in_netns("ip link set dev %s up" % (self.tun_device))
+        if self.userplane_switch is not None:
+            self.set_routes_userplane_switch(userplane_ip_address, userplane_ipv6_address)
+            return
+        self.tun_device = self.tun_name(TUNNEL_ID_NWU_USERPLANE_DATA)
+        self.set_routes_tun(userplane_ip_address, userplane_ipv6_address)
 
-        if self.userplane_tunnel_mtu is not None:
-            try:
-                self.exec_in_netns("ip link set dev %s mtu %s" % (self.tun_device, self.userplane_tunnel_mtu))
-            except:
-                pass
 
-        if userplane_ip_address is not None:
-            self.exec_in_netns("ip addr add " + userplane_ip_address + "/32 dev " + self.tun_device)
+    def userplane_switch_addresses(self,ip_address,ipv6_address): #(address, prefix length) of this UE in the shared tun device
+        address_list = []
+        if ip_address is not None: address_list.append((ip_address, 32))
+        if ipv6_address is not None: address_list.append((ipv6_address, 128))
+        return address_list
 
-            #set host route, only  required if no netns
-            if not self.netns_name:
-                if self.default_gateway is None:
-                    self.exec_in_netns("route add " + self.server_address[0] + "/32 gw " + self.get_default_gateway_linux()[0])
-                else:
-                    self.exec_in_netns("route add " + self.server_address[0] + "/32 gw " + self.default_gateway)
-                
-            self.exec_in_netns("route add -net 0.0.0.0/1 gw " + userplane_ip_address)
-            self.exec_in_netns("route add -net 128.0.0.0/1 gw " + userplane_ip_address)
-        
-        if userplane_ipv6_address is not None:
-            ipv6_address_prefix = ':'.join(userplane_ipv6_address.split(':')[0:4])
-            ipv6_address_identifier = 'fe80::' + ':'.join(userplane_ipv6_address.split(':')[4:8])
-            self.exec_in_netns("ip -6 addr add " + ipv6_address_identifier + "/64 dev " + self.tun_device)
-            self.exec_in_netns("route -A inet6 add ::/1 dev " + self.tun_device)
-            self.exec_in_netns("route -A inet6 add 8000::/1 dev " + self.tun_device)
-               
-        if self.dns_address_list != [] or self.dnsv6_address_list != []:
-            if self.netns_name:
-                self.add_dir() #create directory for namespace if it doesn't exist
-                
-                with open("/etc/netns/%s/resolv.conf" % self.netns_name, "w") as file_obj:
-                    for i in self.dns_address_list:
-                        file_obj.write("nameserver %s\n" % i)
-                    for i in self.dnsv6_address_list:
-                        file_obj.write("nameserver %s\n" % i)
-            else:
-                subprocess.call("cp /etc/resolv.conf /etc/resolv.backup.conf", shell=True)  
-                subprocess.call("echo > /etc/resolv.conf", shell=True) 
-                for i in self.dns_address_list:
-                    subprocess.call("echo 'nameserver " + i +"' >> /etc/resolv.conf", shell=True)  
-                for i in self.dnsv6_address_list:
-                    subprocess.call("echo 'nameserver " + i +"' >> /etc/resolv.conf", shell=True)    
 
+    def set_routes_userplane_switch(self,ip_address,ipv6_address):
+        # the UE addresses are added to the shared tun device. Traffic from them uses the switch table, with the default
+        # routes via the shared tun device, so that applications select the UE by binding to its address
+        self.userplane_switch_address_list = self.userplane_switch_addresses(ip_address, ipv6_address)
+        with rtnetlink() as nl:
+            for address, prefix_length in self.userplane_switch_address_list:
+                nl.add_address(DEFAULT_USERPLANE_SWITCH_DEVICE, address, prefix_length)
+                nl.add_rule(address, prefix_length, DEFAULT_USERPLANE_SWITCH_TABLE)
+            self.netlink_commit(nl)
+        self.userplane_switch.register([socket.inet_pton(address_family(address), address) for address, prefix_length in self.userplane_switch_address_list])
 
 
     def delete_routes(self):
+        if self.userplane_switch is not None and self.interface_type == NWU: #the shared tun device is kept, only the addresses of this UE are removed
+            self.userplane_switch.register([])
+            with rtnetlink() as nl:
+                for address, prefix_length in getattr(self, 'userplane_switch_address_list', []):
+                    nl.delete_rule(address, prefix_length, DEFAULT_USERPLANE_SWITCH_TABLE)
+                    nl.delete_address(DEFAULT_USERPLANE_SWITCH_DEVICE, address, prefix_length)
+                self.netlink_commit(nl)
+            self.userplane_switch_address_list = []
+        if self.netns_pool is not None: #tun devices and namespaces are kept for the next session, without addresses and routes
+            for description, error in self.netns_pool.flush():
+                print('netlink error: ' + description + ': ' + os.strerror(error))
+            if not self.netns_name:
+                if self.interface_type == SWU:
+                    with rtnetlink() as nl:
+                        nl.delete_route(self.server_address[0], 32)
+                        self.netlink_commit(nl)
+                if self.dns_address_list != []:
+                    shutil.copyfile("/etc/resolv.backup.conf", "/etc/resolv.conf")
+            return
         if self.interface_type == SWU:    
             if self.netns_name:
-                subprocess.call("ip netns del %s" % self.netns_name, shell=True)
+                self.delete_netns(self.netns_name)
             else:
-                self.exec_in_netns("route del " + self.server_address[0] + "/32", shell=True)  
+                with rtnetlink() as nl:
+                    nl.delete_route(self.server_address[0], 32)
+                    self.netlink_commit(nl)
                 os.close(self.tunnel) 
+                for fd in self.tunnel_queues: os.close(fd)
                 if self.dns_address_list != []:
-                    subprocess.call("cp /etc/resolv.backup.conf /etc/resolv.conf", shell=True)             
+                    shutil.copyfile("/etc/resolv.backup.conf", "/etc/resolv.conf")
         else:
-            subprocess.call("ip netns del %s" % DEFAULT_TCP_SOCKET_NAMESPACE, shell=True)
+            self.delete_netns(self.tcp_socket_namespace)
             os.close(self.tunnel)      
             if self.netns_name:
-                subprocess.call("ip netns del %s" % self.netns_name, shell=True)
+                self.delete_netns(self.netns_name)
             else:
-                os.close(self.tunnel_userplane)
+                if self.userplane_switch is None: os.close(self.tunnel_userplane)
+                for fd in self.tunnel_userplane_queues: os.close(fd)
                 if self.dns_address_list != []:
-                    subprocess.call("cp /etc/resolv.backup.conf /etc/resolv.conf", shell=True)          
+                    shutil.copyfile("/etc/resolv.backup.conf", "/etc/resolv.conf")
 
 
     def get_default_source_address(self):   
@@ -1974,23 +2248,85 @@ class nwu_swu():
                 return socket.inet_ntoa(struct.pack("<L", int(fields[2], 16))), fields[0]
 
 
-    def open_tun(self,n):
-        TUNSETIFF = 0x400454ca
-        IFF_TUN   = 0x0001
-        IFF_TAP   = 0x0002
-        IFF_NO_PI = 0x1000 # No Packet Information - to avoid 4 extra bytes
-    
-        TUNMODE = IFF_TUN | IFF_NO_PI
-        MODE = 0
-        DEBUG = 0
-
-        f = os.open("/dev/net/tun", os.O_RDWR)
-        ifs = fcntl.ioctl(f, TUNSETIFF, struct.pack("16sH", bytes("tun%d" % n, "utf-8"), TUNMODE))
-        subprocess.call("ifconfig tun%d up" % n, shell=True) 
+    def open_tun(self,n,multi_queue=False):
+        f = open_tun_device(self.tun_name(n), multi_queue)
+        with rtnetlink() as nl:
+            nl.set_link(self.tun_name(n), up=True)
+            self.netlink_commit(nl)
     	   
         return f
 
 
+    def open_tun_queues(self,n): #additional queues of a multi queue tun device, one per extra uplink worker
+        return [self.open_tun(n, multi_queue=True) for i in range(self.uplink_workers-1)]
+
+
+    def start_sa_database(self): #before the ESP workers are started, so that they inherit the shared memory
+        self.sa_database = sa_database(DEFAULT_SA_DATABASE_SLOTS)
+        self.sa_database_spi = {}
+
+
+    def install_sa(self,direction,inter_process_list): #writes the SA of an INTER_PROCESS_CREATE/UPDATE_SA(_USERPLANE) list in the SA database. Returns the list without algorithms and keys, for the encoders
+        userplane = inter_process_list[0] in (INTER_PROCESS_CREATE_SA_USERPLANE, INTER_PROCESS_UPDATE_SA_USERPLANE)
+        ie = dict(inter_process_list[1])
+        spi = ie[INTER_PROCESS_IE_SPI_INIT]
+        self.sa_database.remove_expired()
+        if self.sa_database.write(spi, direction, userplane, ie[INTER_PROCESS_IE_ENCR_ALG], ie.get(INTER_PROCESS_IE_ENCR_KEY) or b'', ie[INTER_PROCESS_IE_INTEG_ALG], ie.get(INTER_PROCESS_IE_INTEG_KEY) or b'', ie.get(INTER_PROCESS_IE_ESN, ESN_NO_ESN)) == False:
+            print('SA database full: SA', toHex(spi), 'not installed')
+        
+        previous_spi = self.sa_database_spi.get((direction, userplane))
+        self.sa_database_spi[(direction, userplane)] = spi
+        if previous_spi is not None and previous_spi != spi:
+            if self.rekey_drain_window > 0: #rekey: the old SA is kept till it is deleted or the drain window ends
+                self.sa_database.set_expiry(previous_spi, direction, time.monotonic() + self.rekey_drain_window)
+            else:
+                self.sa_database.remove(previous_spi, direction)
+        self.register_esp_demux()
+        return [inter_process_list[0], [i for i in inter_process_list[1] if i[0] not in (INTER_PROCESS_IE_ENCR_ALG, INTER_PROCESS_IE_ENCR_KEY, INTER_PROCESS_IE_INTEG_ALG, INTER_PROCESS_IE_INTEG_KEY, INTER_PROCESS_IE_ESN)]]
+
+
+    def register_esp_demux(self): #inbound SPIs of the SA database are sent to the ESP demultiplexer
+        if self.esp_demux is not None:
+            self.esp_demux.register([spi for spi, direction in self.sa_database.slot_of if direction == SA_INBOUND])
+
+
+    def start_ipsec_encoders(self):
+        # first encoder handles tunnel and tunnel_userplane (as in single worker mode). The others handle one extra queue
+        # of the userplane tun device (tunnel in SWU, tunnel_userplane in NWU), sharing the ESP sequence numbers of each SA.
+        # Each SA child has two counters used alternately by consecutive SAs, since during a rekey the old SA is still used
+        self.ike_to_ipsec_encoder_list = []
+        shared_sqn, shared_sqn_userplane = None, None
+        if self.uplink_workers > 1:
+            shared_sqn = [multiprocessing.Value('Q', 1), multiprocessing.Value('Q', 1)]
+            shared_sqn_userplane = [multiprocessing.Value('Q', 1), multiprocessing.Value('Q', 1)]
+        self.shared_sqn, self.shared_sqn_userplane = shared_sqn, shared_sqn_userplane
+            
+        for i in range(self.uplink_workers):
+            ike_to_ipsec_encoder, ipsec_encoder_to_ike = ring_pipe()
+            if i == 0:
+                tunnel, tunnel_userplane = self.tunnel, self.tunnel_userplane
+                if self.userplane_switch is not None: tunnel_userplane = self.userplane_switch.fileno()
+            elif self.interface_type == NWU:
+                tunnel, tunnel_userplane = None, self.tunnel_userplane_queues[i-1]
+            else:
+                tunnel, tunnel_userplane = self.tunnel_queues[i-1], None
+            ipsec_input_worker = multiprocessing.Process(target = self.encapsulate_ipsec, args=([ipsec_encoder_to_ike, tunnel, tunnel_userplane, shared_sqn, shared_sqn_userplane],))
+            ipsec_input_worker.start()
+            self.ike_to_ipsec_encoder_list.append(ike_to_ipsec_encoder)
+
+
+    def send_to_ipsec_encoders(self,packet):
+        #new or rekeyed SA: sequence numbers start again at 1 (the encoders also restart their sqn_allocator)
+        if packet[0] in (INTER_PROCESS_CREATE_SA, INTER_PROCESS_UPDATE_SA) and self.shared_sqn is not None:
+            self.shared_sqn_index ^= 1 #counter not used by the current SA
+            self.shared_sqn[self.shared_sqn_index].value = 1
+        elif packet[0] in (INTER_PROCESS_CREATE_SA_USERPLANE, INTER_PROCESS_UPDATE_SA_USERPLANE) and self.shared_sqn_userplane is not None:
+            self.shared_sqn_userplane_index ^= 1 #counter not used by the current userplane SA
+            self.shared_sqn_userplane[self.shared_sqn_userplane_index].value = 1
+        for pipe in self.ike_to_ipsec_encoder_list:
+            pipe.send(packet)
+
+
     def tcp_process(self,args):
         pipe_ike = args[0]
         nas_ip_address = args[1]
@@ -1999,7 +2335,7 @@ class nwu_swu():
      
         try:
 
-            socket_tcp = nssocket(DEFAULT_TCP_SOCKET_NAMESPACE,socket.AF_INET, socket.SOCK_STREAM)
+            socket_tcp = nssocket(self.tcp_socket_namespace,socket.AF_INET, socket.SOCK_STREAM)
             
             socket_tcp.bind((source_ip_address,0))   
             socket_tcp.settimeout(2)            
@@ -2045,6 +2381,51 @@ class nwu_swu():
             print('Exiting TCP process. Process terminated.')
         
 
+    def read_tun_packets(self,fd): #in batched mode the tun fd is non blocking and is drained till EAGAIN (or batch_size packets)
+        if self.batch_size is None:
+            return [os.read(fd, 1514)]
+        packet_list = []
+        try:
+            while len(packet_list) < self.batch_size:
+                packet_list.append(os.read(fd, 1514))
+        except BlockingIOError:
+            pass
+        return packet_list
+
+
+    def read_tun_packets_into(self,fd): #zero copy mode. returns list of (buffer, length), packet is at buffer[ESP_BUFFER_HEADROOM:ESP_BUFFER_HEADROOM+length]
+        packet_list = []
+        try:
+            for buffer in self.tun_buffers: #one buffer per packet of the batch (kept till sendmmsg)
+                length = os.readv(fd, [memoryview(buffer)[ESP_BUFFER_HEADROOM:ESP_BUFFER_HEADROOM+1514]])
+                packet_list.append((buffer, length))
+                if self.batch_size is None: break
+        except BlockingIOError:
+            pass
+        return packet_list
+
+
+    def receive_packets(self,sock,receiver): #receiver is a mmsg_receiver in batched mode, or udp_gro_receiver
+        if receiver is None:
+            if self.receive_buffer is not None: #zero copy mode
+                length, address = sock.recvfrom_into(self.receive_buffer)
+                return [memoryview(self.receive_buffer)[0:length]]
+            packet, address = sock.recvfrom(2000)
+            return [packet]
+        return receiver.drain()
+
+
+    def send_esp_packets(self,packet_list):
+        if self.esp_sender is not None:
+            self.esp_sender.send(packet_list)
+        elif self.userplane_mode == ESP_PROTOCOL:
+            for packet in packet_list:
+                self.socket_esp.sendto(packet, self.server_address_esp)
+        else:
+            for packet in packet_list:
+                self.socket_nat.sendto(packet, self.server_address_nat)
+
+
     def esp_padding(self,length):
         padding = b''
         for i in range(length):
@@ -2052,16 +2433,64 @@ class nwu_swu():
         return padding
 
 
-    def encapsulate_esp_packet(self,packet,encr_alg,encr_key,integ_alg,integ_key,spi_resp,sqn):
-        hash_size = self.integ_key_truncated_len_bytes.get(integ_alg)
+    def usage_report_interval(self): #ESP workers only report SA usage if there are lifetimes in bytes or packets
+        if self.child_lifetime_bytes > 0 or self.child_lifetime_packets > 0:
+            return DEFAULT_USAGE_REPORT_INTERVAL
+        return None
+
+
+    def worker_select_timeout(self,report_interval,deadline_list): #select timeout of the ESP workers: next usage report or next deadline (None: not set)
+        timeout = report_interval
+        for deadline in deadline_list:
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+                if timeout is None or remaining < timeout: timeout = remaining
+        return timeout
+
+
+    def confirm_sa(self,pipe,spi): #decoder: first packet authenticated with an SA
+        pipe.send(self.encode_inter_process_protocol([INTER_PROCESS_SA_CONFIRMED,[(INTER_PROCESS_IE_SPI_INIT, spi)]]))
+
+
+    def report_sa_usage(self,pipe,sa_list): #sa_list: (sa, spi) pairs. Sends the counters of the SAs that processed packets since the last report
+        for sa, spi in sa_list:
+            if sa is not None and sa.packets != sa.reported_packets:
+                sa.reported_packets = sa.packets
+                inter_process_list_sa_usage = [INTER_PROCESS_SA_USAGE,[(INTER_PROCESS_IE_SPI_INIT, spi), (INTER_PROCESS_IE_BYTES, struct.pack("!Q", sa.bytes)), (INTER_PROCESS_IE_PACKETS, struct.pack("!Q", sa.packets))]]
+                pipe.send(self.encode_inter_process_protocol(inter_process_list_sa_usage))
+
+
+    def create_sa_context(self,encr_alg,encr_key,integ_alg,integ_key,esn=False):
+        return sa_context(encr_alg,encr_key,integ_alg,integ_key,self.integ_function.get(integ_alg),self.integ_key_truncated_len_bytes.get(integ_alg),esn)
+
+
+    def create_inbound_sa_context(self,record): #decoder: sa_context of an sa_record of the SA database, with anti-replay window
+        sa = self.create_sa_context(record.encr_alg,record.encr_key,record.integ_alg,record.integ_key,record.esn == ESN_ESN)
+        sa.userplane = record.userplane
+        if self.replay_window_size > 0 or sa.esn == True: sa.replay_window = replay_window(self.replay_window_size or DEFAULT_REPLAY_WINDOW_SIZE)
+        return sa
+
+
+    def create_outbound_sa_context(self,spi): #encoders: sa_context of an outbound SA of the SA database, or None
+        record = self.sa_database.lookup(spi, SA_OUTBOUND)
+        if record is None:
+            print('SA', toHex(spi), 'not found in SA database')
+            return None
+        return self.create_sa_context(record.encr_alg,record.encr_key,record.integ_alg,record.integ_key,record.esn == ESN_ESN)
+
+
+    def encapsulate_esp_packet(self,packet,sa,spi_resp,sqn):
         if packet[0] // 16 == 4: #ipv4
             packet_type = 4
         elif packet[0] // 16 == 6: #ipv6
             packet_type = 41
         else:
             return None
+        if sa.esn == False and sqn > 0xFFFFFFFF: return None #sequence number would cycle: the SA must be rekeyed (RFC 4303 section 3.3.3)
+        sa.packets += 1
+        sa.bytes += len(packet)
         
-        if encr_alg in (ENCR_AES_CBC,):
+        if sa.encr_alg in (ENCR_AES_CBC,):
             vector = self.return_random_bytes(16)
             data_to_encrypt = packet
             
@@ -2071,29 +2500,15 @@ class nwu_swu():
             else:
                 data_to_encrypt += self.esp_padding(14+res) + bytes([14+res]) + bytes([packet_type])
                    
-            cipher = Cipher(algorithms.AES(encr_key), modes.CBC(vector))
-            encryptor = cipher.encryptor()          
-            cipher_data = encryptor.update(data_to_encrypt) + encryptor.finalize()
+            cipher_data = sa.cbc_encrypt(vector, data_to_encrypt)
                       
-            new_ike_packet = spi_resp + struct.pack("!I",sqn) + vector + cipher_data         
-            
-            if hash_size != 0:          
-                hash = self.integ_function.get(integ_alg) 
-                h = hmac.HMAC(integ_key,hash)
-                h.update(new_ike_packet)
-                hash = h.finalize()[0:hash_size]         
-            else:
-                hash = b''
+            new_ike_packet = spi_resp + struct.pack("!I",sqn & 0xFFFFFFFF) + vector + cipher_data         
                 
-            return new_ike_packet + hash
+            return new_ike_packet + sa.integrity(new_ike_packet, sa.seq_hi(sqn))
 
-        elif encr_alg in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16):
-            
-            if encr_alg == ENCR_AES_GCM_8: mac_length = 8
-            if encr_alg == ENCR_AES_GCM_12: mac_length = 12
-            if encr_alg == ENCR_AES_GCM_16: mac_length = 16        
+        elif sa.encr_alg in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16, ENCR_CHACHA20_POLY1305):
         
-            aad = spi_resp + struct.pack("!I",sqn) 
+            aad = sa.aad(spi_resp, sqn)
             vector = self.return_random_bytes(8)
           
             data_to_encrypt = packet
@@ -2104,86 +2519,184 @@ class nwu_swu():
             else:
                 data_to_encrypt += self.esp_padding(4-res) + bytes([4-res]) + bytes([packet_type])                  
                         
-            cipher = AES.new(encr_key[:-4], AES.MODE_GCM, nonce=encr_key[-4:] + vector, mac_len=mac_length)
-            cipher.update(aad)
-            
-            cipher_data, tag = cipher.encrypt_and_digest(data_to_encrypt)
+            cipher_data_and_tag = sa.aead_encrypt(vector, data_to_encrypt, aad)
                                            
-            new_ike_packet = spi_resp + struct.pack("!I",sqn) + vector + cipher_data + tag
+            new_ike_packet = spi_resp + struct.pack("!I",sqn & 0xFFFFFFFF) + vector + cipher_data_and_tag
           
             return new_ike_packet
 
-        elif encr_alg in (ENCR_NULL,):
+        elif sa.encr_alg in (ENCR_NULL,):
             
-            new_ike_packet = spi_resp + struct.pack("!I",sqn) + packet + bytes([0]) + bytes([packet_type])
-            
-            if hash_size !=0:            
-                hash = self.integ_function.get(integ_alg) 
-                h = hmac.HMAC(integ_key,hash)
-                h.update(new_ike_packet)
-                hash = h.finalize()[0:hash_size]         
-            else:
-                hash = b''
+            new_ike_packet = spi_resp + struct.pack("!I",sqn & 0xFFFFFFFF) + packet + bytes([0]) + bytes([packet_type])
                 
-            return new_ike_packet + hash            
+            return new_ike_packet + sa.integrity(new_ike_packet, sa.seq_hi(sqn))            
         
         return None
 
 
+    def gre_encapsulate_into(self,buffer,start,end,gre_template): #writes outer IPv4 + GRE headers before buffer[start:end]. returns new start
+        gre_template.write_into(buffer, start-28, end-start)
+        return start-28
+
+
+    def encapsulate_esp_packet_into(self,buffer,start,end,sa,spi_resp,sqn): #zero copy version of encapsulate_esp_packet. returns memoryview of the ESP packet
+        if buffer[start] // 16 == 4: #ipv4
+            packet_type = 4
+        elif buffer[start] // 16 == 6: #ipv6
+            packet_type = 41
+        else:
+            return None
+        if sa.esn == False and sqn > 0xFFFFFFFF: return None
+        sa.packets += 1
+        sa.bytes += end - start
+        view = memoryview(buffer)
+        
+        if sa.encr_alg in (ENCR_AES_CBC,):
+            res = 16 - ((end-start) % 16)
+            if res>1:
+                padding_length = res-2
+            else:
+                padding_length = 14+res
+            buffer[end:end+padding_length] = ESP_PADDING[0:padding_length]
+            buffer[end+padding_length] = padding_length
+            buffer[end+padding_length+1] = packet_type
+            end += padding_length + 2
+            
+            esp_start = start - 24
+            vector = self.return_random_bytes(16)
+            struct.pack_into('!4sI16s', buffer, esp_start, spi_resp, sqn & 0xFFFFFFFF, vector)
+            sa.cbc_encrypt_into(vector, view[start:end], view[start:end+15])
+            
+            buffer[end:end+sa.hash_size] = sa.integrity(view[esp_start:end], sa.seq_hi(sqn))
+            return view[esp_start:end+sa.hash_size]
+
+        elif sa.encr_alg in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16, ENCR_CHACHA20_POLY1305):
+            res = (end-start+2) % 4
+            if res == 0:
+                padding_length = 0
+            else:
+                padding_length = 4-res
+            buffer[end:end+padding_length] = ESP_PADDING[0:padding_length]
+            buffer[end+padding_length] = padding_length
+            buffer[end+padding_length+1] = packet_type
+            end += padding_length + 2
+
+            esp_start = start - 16
+            vector = self.return_random_bytes(8)
+            struct.pack_into('!4sI8s', buffer, esp_start, spi_resp, sqn & 0xFFFFFFFF, vector)
+            buffer[end:end+sa.mac_length] = sa.aead_encrypt_into(vector, view[start:end], view[start:end+15], sa.aad(spi_resp, sqn))
+            return view[esp_start:end+sa.mac_length]
+
+        elif sa.encr_alg in (ENCR_NULL,):
+            buffer[end] = 0
+            buffer[end+1] = packet_type
+            end += 2
+
+            esp_start = start - 8
+            struct.pack_into('!4sI', buffer, esp_start, spi_resp, sqn & 0xFFFFFFFF)
+            buffer[end:end+sa.hash_size] = sa.integrity(view[esp_start:end], sa.seq_hi(sqn))
+            return view[esp_start:end+sa.hash_size]
+
+        return None
+
+
     def encapsulate_ipsec(self,args):  
         pipe_ike = args[0]
-        socket_list = [self.tunnel, pipe_ike, self.socket_esp]
+        tunnel = args[1]           #None if this worker does not read the tun device of the first SA child
+        tunnel_userplane = args[2] #None in SWU, or if this worker does not read the userplane tun device (NWU)
+        socket_list = [pipe_ike]
        
-        if  self.interface_type == NWU: socket_list.append(self.tunnel_userplane)
-        
-        encr_alg = None
-        integ_alg = None
-        sqn = 1
-
-        encr_alg_userplane = None
-        integ_alg_userplane = None
-        sqn_userplane = 1        
+        if tunnel is not None: socket_list.append(tunnel)
+        if tunnel_userplane is not None: socket_list.append(tunnel_userplane)
+        
+        # algorithms and keys of the SAs are read from the SA database, the messages of the IKE process only have the SPI
+        sa = None
+        spi_resp = None
+        shared_sqn_index = 0 #args[3]: None, or the two shared counters used alternately by consecutive SAs
+        sqn = sqn_allocator(args[3][0] if args[3] is not None else None, DEFAULT_SQN_BLOCK_SIZE)
+        tunnel_mtu = None #SWU only: MSS clamping of the userplane in the first SA child
+
+        sa_userplane = None
+        spi_resp_userplane = None
+        shared_sqn_userplane_index = 0 #args[4]: None, or the two shared counters used alternately by consecutive userplane SAs
+        sqn_userplane = sqn_allocator(args[4][0] if args[4] is not None else None, DEFAULT_SQN_BLOCK_SIZE)
+        tunnel_mtu_userplane = None
+        pending_userplane = None #new userplane SA (sa, spi, gre template, sqn) waiting for confirmation, while the old one is used
+        pending_userplane_deadline = None
+
+        self.esp_sender = None
+        if self.batch_size is not None:
+            for fd in socket_list:
+                if type(fd) is int: os.set_blocking(fd, False) #tun devices
+            if self.userplane_mode == ESP_PROTOCOL:
+                self.esp_sender = mmsg_sender(self.socket_esp, self.server_address_esp, self.batch_size)
+            else:
+                self.esp_sender = mmsg_sender(self.socket_nat, self.server_address_nat, self.batch_size)
+        if self.udp_offload == True and self.userplane_mode == NAT_TRAVERSAL:
+            if udp_gso_supported(self.socket_nat):
+                self.esp_sender = udp_gso_sender(self.socket_nat, self.server_address_nat, fallback=self.esp_sender)
+            else:
+                print('UDP_SEGMENT not supported. Using sendto/sendmmsg')
+        if self.zero_copy == True:
+            self.tun_buffers = [bytearray(ESP_BUFFER_SIZE) for i in range(self.batch_size or 1)]
+        report_interval = self.usage_report_interval()
+        next_report = time.monotonic()
         
         while True:           
-            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [])           
+            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [], self.worker_select_timeout(report_interval, [pending_userplane_deadline]))           
             for sock in read_sockets:    
-                if sock == self.tunnel:
-                    tap_packet = os.read(self.tunnel, 1514)
+                if sock == tunnel and self.zero_copy == True:
+                    tap_packet_list = self.read_tun_packets_into(tunnel)
                     
-                    if encr_alg is not None:                                                
-                        encrypted_packet = self.encapsulate_esp_packet(tap_packet,encr_alg,encr_key,integ_alg,integ_key,spi_resp,sqn)
-                        if encrypted_packet is not None:
-                            sqn += 1
-                            if self.userplane_mode == ESP_PROTOCOL:
-                                self.socket_esp.sendto(encrypted_packet, self.server_address_esp)
-                            else:
-                                self.socket_nat.sendto(encrypted_packet, self.server_address_nat)
-
-                elif sock == self.tunnel_userplane:
-                    tap_packet = os.read(self.tunnel_userplane, 1514)
+                    if sa is not None:
+                        encrypted_packet_list = []
+                        for buffer, length in tap_packet_list:
+                            if tunnel_mtu is not None: clamp_tcp_mss(memoryview(buffer)[ESP_BUFFER_HEADROOM:ESP_BUFFER_HEADROOM+length], tunnel_mtu)
+                            encrypted_packet = self.encapsulate_esp_packet_into(buffer,ESP_BUFFER_HEADROOM,ESP_BUFFER_HEADROOM+length,sa,spi_resp,sqn.next_sqn())
+                            if encrypted_packet is not None:
+                                encrypted_packet_list.append(encrypted_packet)
+                        self.send_esp_packets(encrypted_packet_list)
+
+                elif sock == tunnel_userplane and self.zero_copy == True:
+                    tap_packet_list = self.read_tun_packets_into(tunnel_userplane)
                    
-                    if encr_alg_userplane is not None:
+                    if sa_userplane is not None:
+                        encrypted_packet_list = []
+                        for buffer, length in tap_packet_list:
+                            if tunnel_mtu_userplane is not None: clamp_tcp_mss(memoryview(buffer)[ESP_BUFFER_HEADROOM:ESP_BUFFER_HEADROOM+length], tunnel_mtu_userplane)
+                            start = self.gre_encapsulate_into(buffer,ESP_BUFFER_HEADROOM,ESP_BUFFER_HEADROOM+length,gre_template_userplane)
+                            encrypted_packet = self.encapsulate_esp_packet_into(buffer,start,ESP_BUFFER_HEADROOM+length,sa_userplane,spi_resp_userplane,sqn_userplane.next_sqn())
+                            if encrypted_packet is not None:
+                                encrypted_packet_list.append(encrypted_packet)
+                        self.send_esp_packets(encrypted_packet_list)
+
+                elif sock == tunnel:
+                    tap_packet_list = self.read_tun_packets(tunnel)
+                    
+                    if sa is not None:                                                
+                        encrypted_packet_list = []
+                        for tap_packet in tap_packet_list:
+                            if tunnel_mtu is not None: tap_packet = clamp_tcp_mss(tap_packet, tunnel_mtu)
+                            encrypted_packet = self.encapsulate_esp_packet(tap_packet,sa,spi_resp,sqn.next_sqn())
+                            if encrypted_packet is not None:
+                                encrypted_packet_list.append(encrypted_packet)
+                        self.send_esp_packets(encrypted_packet_list)
+
+                elif sock == tunnel_userplane:
+                    tap_packet_list = self.read_tun_packets(tunnel_userplane)
+                   
+                    if sa_userplane is not None:
+                        encrypted_packet_list = []
+                        for tap_packet in tap_packet_list:
+                            if tunnel_mtu_userplane is not None: tap_packet = clamp_tcp_mss(tap_packet, tunnel_mtu_userplane)
                         
-                        # 24.502, section 9.3.3:
-                        ip_header = get_ip_header_with_checksum(tunnel_ipv4_address, up_ipv4_address, 0x2F, len(tap_packet)+8)
-                        # The following code is not needed, because according to 24.502 9.3.3 "protocol type should be set to zero, and receiving entity 
-                        # shall ignore value of protocol type field". Since these bytes are to be ignored by the receiving entity, 
-                        # I set them according to the payload packet type (ipv4 or ipv6), so that these packets are decoded in wireshark.
-                        if tap_packet[0]//16 == 4: #ipv4
-                            gre_header_protocol = fromHex('0800')
-                        else: #ipv6
-                            gre_header_protocol = fromHex('86dd')
-                        gre_header = fromHex('2000') + gre_header_protocol + bytes([qfi_userplane]) + fromHex('000000') #no RQI in uplink packets
-                                                 
-                        tap_packet = ip_header + gre_header + tap_packet
-                            
-                        encrypted_packet = self.encapsulate_esp_packet(tap_packet,encr_alg_userplane,encr_key_userplane,integ_alg_userplane,integ_key_userplane,spi_resp_userplane,sqn_userplane)
-                        if encrypted_packet is not None:
-                            sqn_userplane += 1
-                            if self.userplane_mode == ESP_PROTOCOL:
-                                self.socket_esp.sendto(encrypted_packet, self.server_address_esp)
-                            else:
-                                self.socket_nat.sendto(encrypted_packet, self.server_address_nat)
+                            # 24.502, section 9.3.3: outer ip header + gre header from the template of this SA/QFI
+                            tap_packet = gre_template_userplane.header(tap_packet) + tap_packet
+                                
+                            encrypted_packet = self.encapsulate_esp_packet(tap_packet,sa_userplane,spi_resp_userplane,sqn_userplane.next_sqn())
+                            if encrypted_packet is not None:
+                                encrypted_packet_list.append(encrypted_packet)
+                        self.send_esp_packets(encrypted_packet_list)
                                 
                 elif sock == pipe_ike:
                     pipe_packet = pipe_ike.recv()                     
@@ -2192,26 +2705,51 @@ class nwu_swu():
                         sys.exit()
                     elif decode_list[0] in (INTER_PROCESS_CREATE_SA, INTER_PROCESS_UPDATE_SA):
                         for i in decode_list[1]:
-                            if i[0] == INTER_PROCESS_IE_ENCR_ALG: encr_alg = i[1]
-                            if i[0] == INTER_PROCESS_IE_INTEG_ALG: integ_alg = i[1]
-                            if i[0] == INTER_PROCESS_IE_ENCR_KEY: encr_key = i[1]
-                            if i[0] == INTER_PROCESS_IE_INTEG_KEY: integ_key = i[1]                            
                             if i[0] == INTER_PROCESS_IE_SPI_RESP: spi_resp = i[1]
+                            if i[0] == INTER_PROCESS_IE_TUNNEL_MTU: tunnel_mtu = struct.unpack("!H", i[1])[0]
+                        sa = self.create_outbound_sa_context(spi_resp)
+                        shared_sqn_index ^= 1
+                        sqn = sqn_allocator(args[3][shared_sqn_index] if args[3] is not None else None, DEFAULT_SQN_BLOCK_SIZE)
                             
                     elif decode_list[0] in (INTER_PROCESS_CREATE_SA_USERPLANE, INTER_PROCESS_UPDATE_SA_USERPLANE):
+                        if pending_userplane is not None: #new rekey before the previous switch
+                            sa_userplane, spi_resp_userplane, gre_template_userplane, sqn_userplane = pending_userplane
+                            pending_userplane, pending_userplane_deadline = None, None
+                        wait_confirmation = 0
                         for i in decode_list[1]:
-                            if i[0] == INTER_PROCESS_IE_ENCR_ALG: encr_alg_userplane = i[1]
-                            if i[0] == INTER_PROCESS_IE_INTEG_ALG: integ_alg_userplane = i[1]
-                            if i[0] == INTER_PROCESS_IE_ENCR_KEY: encr_key_userplane = i[1]
-                            if i[0] == INTER_PROCESS_IE_INTEG_KEY: integ_key_userplane = i[1]                            
-                            if i[0] == INTER_PROCESS_IE_SPI_RESP: spi_resp_userplane = i[1]                            
+                            if i[0] == INTER_PROCESS_IE_SPI_RESP: spi_resp_new = i[1]                            
                             if i[0] == INTER_PROCESS_IE_QFI: qfi_userplane = i[1] 
                             if i[0] == INTER_PROCESS_IE_TUNNEL_IP_ADDRESS: tunnel_ipv4_address = i[1] 
                             if i[0] == INTER_PROCESS_IE_USERPLANE_IP_ADDRESS: up_ipv4_address = i[1]                             
+                            if i[0] == INTER_PROCESS_IE_TUNNEL_MTU: tunnel_mtu_userplane = struct.unpack("!H", i[1])[0]
+                            if i[0] == INTER_PROCESS_IE_WAIT_CONFIRMATION: wait_confirmation = i[1]
+                        shared_sqn_userplane_index ^= 1
+                        sa_new = self.create_outbound_sa_context(spi_resp_new)
+                        sqn_new = sqn_allocator(args[4][shared_sqn_userplane_index] if args[4] is not None else None, DEFAULT_SQN_BLOCK_SIZE)
+                        gre_template_new = gre_header_template(tunnel_ipv4_address, up_ipv4_address, qfi_userplane)
+                        if sa_userplane is not None and wait_confirmation == 1 and self.rekey_drain_window > 0:
+                            #rekey started by the peer: the old SA is used till the peer sends with the new one, the old one is deleted or the drain window ends
+                            pending_userplane = [sa_new, spi_resp_new, gre_template_new, sqn_new]
+                            pending_userplane_deadline = time.monotonic() + self.rekey_drain_window
+                        else:
+                            sa_userplane, spi_resp_userplane, gre_template_userplane, sqn_userplane = sa_new, spi_resp_new, gre_template_new, sqn_new
+
+                    elif decode_list[0] in (INTER_PROCESS_SA_CONFIRMED, INTER_PROCESS_RETIRE_SA):
+                        for i in decode_list[1]:
+                            if i[0] == INTER_PROCESS_IE_SPI_RESP and pending_userplane is not None and i[1] in (pending_userplane[1], spi_resp_userplane):
+                                pending_userplane_deadline = 0 #new SA confirmed or old SA deleted: switch now
                             
                     elif decode_list[0] == INTER_PROCESS_IKE and decode_list[1][0] == INTER_PROCESS_IE_IKE_MESSAGE: #not used for now. check 4 bytes zero if nat transversal
                         ike_message = decode_list[1][1]                    
                         self.socket_nat.sendto(ike_message, self.server_address_nat)
+
+            if pending_userplane_deadline is not None and time.monotonic() >= pending_userplane_deadline:
+                sa_userplane, spi_resp_userplane, gre_template_userplane, sqn_userplane = pending_userplane
+                pending_userplane, pending_userplane_deadline = None, None
+
+            if report_interval is not None and time.monotonic() >= next_report:
+                self.report_sa_usage(pipe_ike, [(sa, spi_resp), (sa_userplane, spi_resp_userplane)])
+                next_report = time.monotonic() + report_interval
              
         return 0
     
@@ -2219,45 +2757,62 @@ class nwu_swu():
     def decapsulate_ipsec(self,args):       
         pipe_ike = args[0]
                 
-        socket_list = [self.socket_nat, pipe_ike, self.socket_esp]
-        encr_alg = None
-        integ_alg = None
-
-        encr_alg_userplane = None
-        integ_alg_userplane = None
-        spi_init_userplane = None
-        
-        # dict with ip packet id as key, and paylad as value. When the last fragment for a packet ide is received, that key is removed from the dict.
-        # not protected! if last fragment does not come, the first fragments are keepted in memory till the end...
-        fragment_buffer = {} 
+        # ESP without NAT traversal comes from the raw ESP socket, or from the ESP demultiplexer (same packets, with ip header)
+        socket_esp = self.socket_esp if self.esp_demux is None else self.esp_demux.sock
+        # ESP in udp 4500 comes with IKE in socket_nat, or alone in socket_nat_esp if the kernel splits them
+        socket_nat = self.socket_nat if self.socket_nat_esp is None else self.socket_nat_esp
+        socket_list = [socket_nat, pipe_ike, socket_esp]
+        # inbound SAs are found by SPI in the SA database. After a rekey the old SA stays there till it is deleted or the drain window ends
+        sa_database = self.sa_database
+        
+        # fragments of userplane packets (outer ip, before GRE decapsulation). Incomplete packets expire after DEFAULT_FRAGMENT_TIMEOUT,
+        # and the least recently used are evicted above DEFAULT_FRAGMENT_MEMORY bytes
+        fragment_buffer = fragment_reassembly(DEFAULT_FRAGMENT_TIMEOUT, DEFAULT_FRAGMENT_MEMORY)
         fragmentation_detected = False
+
+        nat_receiver = None
+        esp_receiver = None
+        if self.batch_size is not None:
+            nat_receiver = mmsg_receiver(socket_nat, self.batch_size, zero_copy=self.zero_copy)
+            esp_receiver = mmsg_receiver(socket_esp, self.batch_size, zero_copy=self.zero_copy)
+        if self.udp_offload == True and self.userplane_mode == NAT_TRAVERSAL:
+            if enable_udp_gro(socket_nat):
+                nat_receiver = udp_gro_receiver(socket_nat, zero_copy=self.zero_copy)
+            else:
+                print('UDP_GRO not supported. Using recvfrom/recvmmsg')
+        if self.zero_copy == True: #received packets and decrypted packets are memoryviews of these buffers, valid till the next packet
+            self.receive_buffer = bytearray(ESP_BUFFER_SIZE)
+            self.decrypt_buffer = bytearray(ESP_BUFFER_SIZE)
+        report_interval = self.usage_report_interval()
+        next_report = time.monotonic()
         
         while True:
-            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [])
+            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [], report_interval)
             for sock in read_sockets:
-                if sock == self.socket_nat:
-                    packet, address = self.socket_nat.recvfrom(2000)
+                if sock == socket_nat:
+                    for packet in self.receive_packets(socket_nat, nat_receiver):
                     
-                    if encr_alg is not None or integ_alg is not None:
-                        if packet[0:4] == b'\x00\x00\x00\x00': #is ike message
-                            inter_process_list_ike_message = [INTER_PROCESS_IKE,[(INTER_PROCESS_IE_IKE_MESSAGE, packet)]]
-                            pipe_ike.send(self.encode_inter_process_protocol(inter_process_list_ike_message))
+                        if sa_database.version() != 0: #at least one SA installed
+                            if packet[0:4] == b'\x00\x00\x00\x00': #is ike message
+                                inter_process_list_ike_message = [INTER_PROCESS_IKE,[(INTER_PROCESS_IE_IKE_MESSAGE, bytes(packet))]]
+                                pipe_ike.send(self.encode_inter_process_protocol(inter_process_list_ike_message))
                             
-                        elif packet[0:4] == spi_init: #signaling SA CHILD for NWU or userplane for SWU
-                           
-                            if encr_alg is not None:
-                                decrypted_packet = self.decapsulate_esp_packet(packet,encr_alg,encr_key,integ_alg,integ_key)
-                                if decrypted_packet is not None:
+                            else:
+                                spi = bytes(packet[0:4])
+                                sa_in = sa_database.get(spi, SA_INBOUND, self.create_inbound_sa_context) #None: unknown SPI, or old SA of a rekey removed
+                                decrypted_packet = self.decapsulate_esp_packet(packet,sa_in) if sa_in is not None else None
+                                if decrypted_packet is not None and sa_in.packets == 1: self.confirm_sa(pipe_ike, spi)
+
+                                if decrypted_packet is None:
+                                    pass
+
+                                elif sa_in.userplane == False: #signaling SA CHILD for NWU or userplane for SWU
                                     os.write(self.tunnel,decrypted_packet)
 
-                        elif packet[0:4] == spi_init_userplane:
-                           
-                            if encr_alg_userplane is not None:
-                                decrypted_packet = self.decapsulate_esp_packet(packet,encr_alg_userplane,encr_key_userplane,integ_alg_userplane,integ_key_userplane)
-                                if decrypted_packet is not None:
+                                else: #userplane SA CHILD (NWU)
                                     #only processes GRE packets:                                                                        
                                     ip_flag_more_fragments = (decrypted_packet[6]//32) % 2
-                                    
+                                
                                     if decrypted_packet[9] == 0x2F:
                                         if fragmentation_detected == False: #fast path when there is no fragmentation detected
 
@@ -2269,157 +2824,150 @@ class nwu_swu():
                                             elif ip_flag_more_fragments == 1:
                                                 fragmentation_detected = True
                                                 print('Fragmentation detected in Userplane SA Child!')
-                                                                                                             
+                                                                                                         
                                         if fragmentation_detected == True:                                     
-                                     
+                                 
                                             ip_fragment_offset = (decrypted_packet[6] % 32) * 256 + decrypted_packet[7]
-                                        
+                                    
                                             if ip_flag_more_fragments == 0 and ip_fragment_offset == 0: #not fragment #first check fast path
                                                 if (decrypted_packet[20] // 32) % 2 == 0:
                                                     os.write(self.tunnel_userplane,decrypted_packet[24:])                                               
                                                 else:
                                                     os.write(self.tunnel_userplane,decrypted_packet[28:])                                              
                                             else:
-                                                ip_identification = decrypted_packet[4:6]                                              
-                                                if ip_flag_more_fragments == 1 and ip_fragment_offset == 0: #first fragment
-                                                    fragment_buffer[ip_identification] = decrypted_packet[20:]
-                                                elif ip_flag_more_fragments == 1 and ip_fragment_offset != 0: #more fragments to come
-                                                    fragment_buffer[ip_identification] += decrypted_packet[20:]
-                                                elif ip_flag_more_fragments == 0 and ip_fragment_offset != 0: #last fragment   
-                                                    try:                                        
-                                                        complete_packet = fragment_buffer[ip_identification] + decrypted_packet[20:]
-                                                        #complete packet starts with GRE header                                       
-                                                        if (complete_packet[0] // 32) % 2 == 0:
-                                                            os.write(self.tunnel_userplane,complete_packet[4:])                                               
-                                                        else:
-                                                            os.write(self.tunnel_userplane,complete_packet[8:]) 
-                                                        del fragment_buffer[ip_identification]
-                                                    except:
-                                                        pass
-                                     
-                                        
-                        
-                elif sock == self.socket_esp:
-                    packet, address = self.socket_esp.recvfrom(2000)
-                    if encr_alg is not None or integ_alg is not None:
-                        if packet[20:24] == spi_init: #signaling SA CHILD for NWU or userplane for SWU
-                            
-                            if encr_alg is not None:
-                                decrypted_packet = self.decapsulate_esp_packet(packet[20:],encr_alg,encr_key,integ_alg,integ_key)
-                                if decrypted_packet is not None:                                     
-                                    os.write(self.tunnel,decrypted_packet)
-                                        
-                        elif packet[20:24] == spi_init_userplane:
+                                                #fragments of the same packet: same source, destination and identification
+                                                fragment_key = bytes(decrypted_packet[12:20]) + bytes(decrypted_packet[4:6])
+                                                ip_header_length = (decrypted_packet[0] % 16) * 4
+                                                complete_packet = fragment_buffer.add(fragment_key, ip_fragment_offset*8, ip_flag_more_fragments, decrypted_packet[ip_header_length:])
+                                                if complete_packet is not None:
+                                                    #complete packet starts with GRE header                                       
+                                                    if (complete_packet[0] // 32) % 2 == 0:
+                                                        os.write(self.tunnel_userplane,complete_packet[4:])                                               
+                                                    else:
+                                                        os.write(self.tunnel_userplane,complete_packet[8:]) 
+
+                elif sock == socket_esp:
+                    for packet in self.receive_packets(socket_esp, esp_receiver):
+                        if sa_database.version() != 0: #at least one SA installed
+                            spi = bytes(packet[20:24])
+                            sa_in = sa_database.get(spi, SA_INBOUND, self.create_inbound_sa_context) #None: unknown SPI, or old SA of a rekey removed
+                            decrypted_packet = self.decapsulate_esp_packet(packet[20:],sa_in) if sa_in is not None else None
+                            if decrypted_packet is not None and sa_in.packets == 1: self.confirm_sa(pipe_ike, spi)
+
+                            if decrypted_packet is None:
+                                pass
+
+                            elif sa_in.userplane == False: #signaling SA CHILD for NWU or userplane for SWU
+                                os.write(self.tunnel,decrypted_packet)
+
+                            else: #userplane SA CHILD (NWU)
+                                #only processes GRE packets:                                                                        
+                                ip_flag_more_fragments = (decrypted_packet[6]//32) % 2
                             
-                            if encr_alg_userplane is not None:
-                                decrypted_packet = self.decapsulate_esp_packet(packet[20:],encr_alg_userplane,encr_key_userplane,integ_alg_userplane,integ_key_userplane)
-                                if decrypted_packet is not None:
-                                    #only processes GRE packets:                                                                        
-                                    ip_flag_more_fragments = (decrypted_packet[6]//32) % 2
-                                    
-                                    if decrypted_packet[9] == 0x2F:
-
-                                        if fragmentation_detected == False: #fast path when there is no fragmentation detected
-                                            if ip_flag_more_fragments == 0:                                    
-                                                if (decrypted_packet[20] // 32) % 2 == 0:                                                   
-                                                    os.write(self.tunnel_userplane,decrypted_packet[24:])                                               
-                                                else:                                                                                                   
-                                                    os.write(self.tunnel_userplane,decrypted_packet[28:])                                     
-                                            elif ip_flag_more_fragments == 1:
-                                                fragmentation_detected = True
-                                                print('Fragmentation detected in Userplane SA Child!')
-                                                                                                             
-                                        if fragmentation_detected == True:                                                                         
-                                            ip_fragment_offset = (decrypted_packet[6] % 32) * 256 + decrypted_packet[7]
-                                        
-                                            if ip_flag_more_fragments == 0 and ip_fragment_offset == 0: #not fragment #first check fast path
-                                                if (decrypted_packet[20] // 32) % 2 == 0:
-                                                    os.write(self.tunnel_userplane,decrypted_packet[24:])                                               
-                                                else:
-                                                    os.write(self.tunnel_userplane,decrypted_packet[28:])                                              
+                                if decrypted_packet[9] == 0x2F:
+
+                                    if fragmentation_detected == False: #fast path when there is no fragmentation detected
+                                        if ip_flag_more_fragments == 0:                                    
+                                            if (decrypted_packet[20] // 32) % 2 == 0:                                                   
+                                                os.write(self.tunnel_userplane,decrypted_packet[24:])                                               
+                                            else:                                                                                                   
+                                                os.write(self.tunnel_userplane,decrypted_packet[28:])                                     
+                                        elif ip_flag_more_fragments == 1:
+                                            fragmentation_detected = True
+                                            print('Fragmentation detected in Userplane SA Child!')
+                                                                                                     
+                                    if fragmentation_detected == True:                                                                         
+                                        ip_fragment_offset = (decrypted_packet[6] % 32) * 256 + decrypted_packet[7]
+                                
+                                        if ip_flag_more_fragments == 0 and ip_fragment_offset == 0: #not fragment #first check fast path
+                                            if (decrypted_packet[20] // 32) % 2 == 0:
+                                                os.write(self.tunnel_userplane,decrypted_packet[24:])                                               
                                             else:
-                                                ip_identification = decrypted_packet[4:6]                                              
-                                                if ip_flag_more_fragments == 1 and ip_fragment_offset == 0: #first fragment
-                                                    fragment_buffer[ip_identification] = decrypted_packet[20:]
-                                                elif ip_flag_more_fragments == 1 and ip_fragment_offset != 0: #more fragments to come
-                                                    fragment_buffer[ip_identification] += decrypted_packet[20:]
-                                                elif ip_flag_more_fragments == 0 and ip_fragment_offset != 0: #last fragment   
-                                                    try:                                        
-                                                        complete_packet = fragment_buffer[ip_identification] + decrypted_packet[20:]
-                                                        #complete packet starts with GRE header                                       
-                                                        if (complete_packet[0] // 32) % 2 == 0:
-                                                            os.write(self.tunnel_userplane,complete_packet[4:])                                               
-                                                        else:
-                                                            os.write(self.tunnel_userplane,complete_packet[8:]) 
-                                                        del fragment_buffer[ip_identification]
-                                                    except:
-                                                        pass
-                                                
-               
+                                                os.write(self.tunnel_userplane,decrypted_packet[28:])                                              
+                                        else:
+                                            #fragments of the same packet: same source, destination and identification
+                                            fragment_key = bytes(decrypted_packet[12:20]) + bytes(decrypted_packet[4:6])
+                                            ip_header_length = (decrypted_packet[0] % 16) * 4
+                                            complete_packet = fragment_buffer.add(fragment_key, ip_fragment_offset*8, ip_flag_more_fragments, decrypted_packet[ip_header_length:])
+                                            if complete_packet is not None:
+                                                #complete packet starts with GRE header                                       
+                                                if (complete_packet[0] // 32) % 2 == 0:
+                                                    os.write(self.tunnel_userplane,complete_packet[4:])                                               
+                                                else:
+                                                    os.write(self.tunnel_userplane,complete_packet[8:]) 
+
                 elif sock == pipe_ike:
                     pipe_packet = pipe_ike.recv()                     
                     decode_list = self.decode_inter_process_protocol(pipe_packet)
                     if decode_list[0] == INTER_PROCESS_DELETE_SA:
+                        for sa, spi in sa_database.cached_sa_list():
+                            print('SA Child', toHex(spi) + ': auth failures', sa.auth_failures)
+                            if sa.replay_window is not None: print('Anti-replay SA Child', toHex(spi) + ':', sa.replay_window.statistics())
+                        if fragmentation_detected == True: print('Fragment reassembly Userplane SA Child:', fragment_buffer.statistics())
                         sys.exit()
-                    elif decode_list[0] in (INTER_PROCESS_CREATE_SA, INTER_PROCESS_UPDATE_SA):
-                        for i in decode_list[1]:
-                            if i[0] == INTER_PROCESS_IE_ENCR_ALG: encr_alg = i[1]
-                            if i[0] == INTER_PROCESS_IE_INTEG_ALG: integ_alg = i[1]
-                            if i[0] == INTER_PROCESS_IE_ENCR_KEY: encr_key = i[1]
-                            if i[0] == INTER_PROCESS_IE_INTEG_KEY: integ_key = i[1]                            
-                            if i[0] == INTER_PROCESS_IE_SPI_INIT: spi_init = i[1]
 
-                    elif decode_list[0] in (INTER_PROCESS_CREATE_SA_USERPLANE, INTER_PROCESS_UPDATE_SA_USERPLANE):
-                        for i in decode_list[1]:
-                            if i[0] == INTER_PROCESS_IE_ENCR_ALG: encr_alg_userplane = i[1]
-                            if i[0] == INTER_PROCESS_IE_INTEG_ALG: integ_alg_userplane = i[1]
-                            if i[0] == INTER_PROCESS_IE_ENCR_KEY: encr_key_userplane = i[1]
-                            if i[0] == INTER_PROCESS_IE_INTEG_KEY: integ_key_userplane = i[1]                            
-                            if i[0] == INTER_PROCESS_IE_SPI_INIT: spi_init_userplane = i[1]
-                            if i[0] == INTER_PROCESS_IE_QFI: qfi_userplane = i[1]     
-                            if i[0] == INTER_PROCESS_IE_TUNNEL_IP_ADDRESS: tunnel_ipv4_address = i[1] 
-                            if i[0] == INTER_PROCESS_IE_USERPLANE_IP_ADDRESS: up_ipv4_address = i[1]                              
+            if report_interval is not None and time.monotonic() >= next_report:
+                self.report_sa_usage(pipe_ike, sa_database.cached_sa_list())
+                next_report = time.monotonic() + report_interval
 
         return 0
 
 
-    def decapsulate_esp_packet(self,packet,encr_alg,encr_key,integ_alg,integ_key):           
-        if encr_alg in (ENCR_AES_CBC,):
+    def decapsulate_esp_packet(self,packet,sa):
+        if sa.replay_window is None:
+            uncipher_packet = self.decapsulate_esp_payload(packet,sa)
+        else:
+            sqn = struct.unpack('!I', packet[4:8])[0]
+            if sa.esn == True: sqn = sa.replay_window.estimate_sqn(sqn) #ESN: high order 32 bits inferred from the window
+            if sa.replay_window.check(sqn) == False: return None #replayed or too old: dropped before decryption
+            uncipher_packet = self.decapsulate_esp_payload(packet,sa,sqn)
+            if uncipher_packet is not None:
+                sa.replay_window.update(sqn) #window only moves with authenticated packets
+        if uncipher_packet is not None:
+            sa.packets += 1
+            sa.bytes += len(uncipher_packet)
+        return uncipher_packet
+
+
+    def decapsulate_esp_payload(self,packet,sa,sqn=None): #sqn: 64 bit sequence number when ESN is used
+        if sa.encr_alg in (ENCR_AES_CBC,):
             vector = packet[8:24]
-            hash_size = self.integ_key_truncated_len_bytes.get(integ_alg)
-            hash_data = packet[-hash_size:]
+            hash_data = packet[-sa.hash_size:]
+            if sa.verify_integrity(packet[0:len(packet)-sa.hash_size], hash_data, sa.seq_hi(sqn)) == False: return None #dropped before decryption
         
-            encrypted_data = packet[24:len(packet)-hash_size]
+            encrypted_data = packet[24:len(packet)-sa.hash_size]
         
-            cipher = Cipher(algorithms.AES(encr_key), modes.CBC(vector))            
-            decryptor = cipher.decryptor()
-            
-            uncipher_data = decryptor.update(encrypted_data) + decryptor.finalize()
+            if self.decrypt_buffer is not None: #zero copy mode
+                uncipher_data = sa.cbc_decrypt_into(vector, encrypted_data, self.decrypt_buffer)
+            else:
+                uncipher_data = sa.cbc_decrypt(vector, encrypted_data)
+            if uncipher_data is None: return None
             padding_length = uncipher_data[-2]
             uncipher_packet = uncipher_data[0:-padding_length-2]
 
             return uncipher_packet
             
-        elif encr_alg in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16):
-            if encr_alg == ENCR_AES_GCM_8: mac_length = 8
-            if encr_alg == ENCR_AES_GCM_12: mac_length = 12
-            if encr_alg == ENCR_AES_GCM_16: mac_length = 16
+        elif sa.encr_alg in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16, ENCR_CHACHA20_POLY1305):
+            aad = packet[0:8]
+            if sa.esn == True: aad = sa.aad(bytes(packet[0:4]), sqn)
             
-            aad = packet[0:8]            
-            cipher = AES.new(encr_key[:-4], AES.MODE_GCM, nonce=encr_key[-4:] + packet[8:16],mac_len=mac_length)
-            cipher.update(aad)
-
-            uncipher_data = cipher.decrypt_and_verify(packet[16:-mac_length],packet[-mac_length:])                      
+            if self.decrypt_buffer is not None: #zero copy mode
+                uncipher_data = sa.aead_decrypt_into(packet[8:16], packet[16:-sa.mac_length], packet[-sa.mac_length:], aad, self.decrypt_buffer)
+            else:
+                uncipher_data = sa.aead_decrypt(packet[8:16], packet[16:-sa.mac_length], packet[-sa.mac_length:], aad)
+            if uncipher_data is None:
+                sa.auth_failures += 1
+                return None
             padding_length = uncipher_data[-2]
             uncipher_packet = uncipher_data[0:-padding_length-2]                               
                      
             return uncipher_packet
 
-        elif encr_alg in (ENCR_NULL,):
-            hash_size = self.integ_key_truncated_len_bytes.get(integ_alg)
-            hash_data = packet[-hash_size:]
+        elif sa.encr_alg in (ENCR_NULL,):
+            hash_data = packet[-sa.hash_size:]
+            if sa.verify_integrity(packet[0:len(packet)-sa.hash_size], hash_data, sa.seq_hi(sqn)) == False: return None
         
-            uncipher_data = packet[8:len(packet)-hash_size]
+            uncipher_data = packet[8:len(packet)-sa.hash_size]
             padding_length = uncipher_data[-2]
             uncipher_packet = uncipher_data[0:-padding_length-2]
 
@@ -2445,15 +2993,16 @@ class nwu_swu():
 
 
     def encode_inter_process_protocol(self,message):
-        packet = b''
+        ie_list = []
         for i in message[1]: 
             if type(i[1]) is int:
-                packet += bytes([i[0]]) + b'\x00\x01' + bytes([i[1]])
+                ie_list.append(bytes([i[0], 0, 1, i[1]]))
             else:
-                packet += bytes([i[0]]) + struct.pack("!H",len(i[1])) + i[1]
+                ie_list.append(struct.pack("!BH",i[0],len(i[1])))
+                ie_list.append(i[1])
                 
-        packet = bytes([message[0]]) + struct.pack("!H",len(packet)) + packet        
-        return packet
+        packet = b''.join(ie_list)
+        return struct.pack("!BH",message[0],len(packet)) + packet
        
        
        
@@ -2502,7 +3051,7 @@ class nwu_swu():
         self.sa_list = new_sa_list
         
 
-    def set_sa_negotiated_child(self,num,user_plane=False):
+    def set_sa_negotiated_child(self,num,user_plane=False,esn=None): #esn: ESN transform chosen by the responder, if our proposal had both
         sa_negotiated = self.sa_list_child[num-1]
         if user_plane == False:
             self.spi_init_child = self.sa_spi_list[num-1]
@@ -2513,15 +3062,19 @@ class nwu_swu():
         self.negotiated_encryption_algorithm_child = ENCR_NULL
         self.negotiated_encryption_algorithm_key_size_child = 0
         self.negotiated_diffie_hellman_group_child = None
+        self.negotiated_esn_child = ESN_NO_ESN
         
         for i in sa_negotiated[1:]:
             if i[0] == ENCR: 
                 self.negotiated_encryption_algorithm_child = i[1]
-                if self.negotiated_encryption_algorithm_child != ENCR_NULL:                
+                if self.negotiated_encryption_algorithm_child == ENCR_CHACHA20_POLY1305: #fixed key size, no key length attribute (RFC 7634)
+                    self.negotiated_encryption_algorithm_key_size_child = 256
+                elif self.negotiated_encryption_algorithm_child != ENCR_NULL:                
                     self.negotiated_encryption_algorithm_key_size_child = i[2][1]
             if i[0] == ESN: self.negotiated_esn_child = i[1]
             if i[0] == INTEG: self.negotiated_integrity_algorithm_child = i[1]            
             if i[0] == D_H: self.negotiated_diffie_hellman_group_child = i[1]            
+        if esn is not None: self.negotiated_esn_child = esn
    
 
     def generate_keying_material_child(self, reverse = False):
@@ -2533,8 +3086,8 @@ class nwu_swu():
         AUTH_KEY_SIZE = self.integ_key_len_bytes.get(self.negotiated_integrity_algorithm_child) 
         ENCR_KEY_SIZE = self.negotiated_encryption_algorithm_key_size_child//8
         
-        #exception for GCM since we need extra 4 bytes for SALT
-        if self.negotiated_encryption_algorithm_child in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16):
+        #exception for GCM and ChaCha20-Poly1305 since we need extra 4 bytes for SALT
+        if self.negotiated_encryption_algorithm_child in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16, ENCR_CHACHA20_POLY1305):
             ENCR_KEY_SIZE += 4    
         
         KEY_LENGHT_TOTAL = 2*AUTH_KEY_SIZE + 2*ENCR_KEY_SIZE
@@ -2568,6 +3121,8 @@ class nwu_swu():
         PRF_KEY_SIZE = self.prf_key_len_bytes.get(self.negotiated_prf)
         AUTH_KEY_SIZE = self.integ_key_len_bytes.get(self.negotiated_integrity_algorithm) 
         ENCR_KEY_SIZE = self.negotiated_encryption_algorithm_key_size//8
+        if self.negotiated_encryption_algorithm in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16):
+            ENCR_KEY_SIZE += 4 #salt (RFC 5282)
         
         KEY_LENGHT_TOTAL = 3*PRF_KEY_SIZE + 2*AUTH_KEY_SIZE + 2*ENCR_KEY_SIZE
 
@@ -2589,6 +3144,7 @@ class nwu_swu():
         print('SK_PI',toHex(self.SK_PI))
         print('SK_PR',toHex(self.SK_PR))
 
+        self.ike_sa_context = self.create_ike_sa_context()
         self.print_ikev2_decryption_table()        
         
 
@@ -2601,6 +3157,7 @@ class nwu_swu():
         self.SK_ER_old = self.SK_ER
         self.SK_PI_old = self.SK_PI
         self.SK_PR_old = self.SK_PR
+        self.ike_sa_context_old = self.ike_sa_context
 
         hash = self.prf_function.get(self.negotiated_prf) 
         h = hmac.HMAC(self.SK_D,hash)
@@ -2614,6 +3171,8 @@ class nwu_swu():
         PRF_KEY_SIZE = self.prf_key_len_bytes.get(self.negotiated_prf)
         AUTH_KEY_SIZE = self.integ_key_len_bytes.get(self.negotiated_integrity_algorithm) 
         ENCR_KEY_SIZE = self.negotiated_encryption_algorithm_key_size//8
+        if self.negotiated_encryption_algorithm in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16):
+            ENCR_KEY_SIZE += 4 #salt (RFC 5282)
         
         KEY_LENGHT_TOTAL = PRF_KEY_SIZE + 2*AUTH_KEY_SIZE + 2*ENCR_KEY_SIZE
 
@@ -2631,9 +3190,23 @@ class nwu_swu():
         print('SK_EI',toHex(self.SK_EI))
         print('SK_ER',toHex(self.SK_ER))
 
+        self.ike_sa_context = self.create_ike_sa_context()
         self.print_ikev2_decryption_table() 
         
 
+    def create_ike_sa_context(self): #indexed by the initiator flag of the message
+        return {
+            ROLE_INITIATOR: self.create_sa_context(self.negotiated_encryption_algorithm,self.SK_EI,self.negotiated_integrity_algorithm,self.SK_AI),
+            ROLE_RESPONDER: self.create_sa_context(self.negotiated_encryption_algorithm,self.SK_ER,self.negotiated_integrity_algorithm,self.SK_AR)
+        }
+        
+
+    def get_ike_sa_context(self,role):
+        if self.old_ike_message_received == True:
+            return self.ike_sa_context_old[role]
+        return self.ike_sa_context[role]
+
+
     def prf_plus(self,algorithm,key,stream,size):
         hash = self.prf_function.get(algorithm)  
         t = b''
@@ -2897,7 +3470,26 @@ class nwu_swu():
 
 # STATE 1 COMMON FOR SWU and NWU
 
+    def receive_ike_response(self): #answer to the last request, decoded. Returns the IKE message, or None after the socket timeout
+        try:
+            while True:
+                if self.userplane_mode == ESP_PROTOCOL:
+                    packet, address = self.socket.recvfrom(2000)
+                else:
+                    packet, address = self.socket_nat.recvfrom(2000)
+                    packet = packet[4:]
+                self.decode_ike(packet)
+                if self.ike_decoded_ok == True: return packet
+        except: #timeout
+            return None
+
+
     def state_1(self, retry = False, cookie = False): #Send IKE_SA_INIT and process answer
+        self.state_1_send(retry, cookie)
+        if self.receive_ike_response() is None: return TIMEOUT,'TIMEOUT'
+        return self.state_1_process()
+
+    def state_1_send(self, retry = False, cookie = False):
         self.message_id_request = 0
         packet = self.create_IKE_SA_INIT(retry, cookie)
         
@@ -2905,24 +3497,10 @@ class nwu_swu():
         
         self.send_data(packet)
         print('sending IKE_SA_INIT')
-        
-        try:
-        #if True:
-            while True:
-                if self.userplane_mode == ESP_PROTOCOL:
-                    packet, address = self.socket.recvfrom(2000)  
-                    self.AUTH_SA_INIT_received_packet = packet #needed for AUTH check in state 4
-                    self.decode_ike(packet)
-                    if self.ike_decoded_ok == True: break                
-                else:                 
-                    packet, address = self.socket_nat.recvfrom(2000)    
-                    self.AUTH_SA_INIT_received_packet = packet[4:] #needed for AUTH check in state 4                    
-                    self.decode_ike(packet[4:])
-                    if self.ike_decoded_ok == True: break                     
-                
-        except: #timeout          
-            return TIMEOUT,'TIMEOUT'       
-        
+
+    def state_1_process(self):
+        self.AUTH_SA_INIT_received_packet = self.current_packet_received #needed for AUTH check in state 4
+
         if self.ike_decoded_header['exchange_type'] == IKE_SA_INIT:
             print('received IKE_SA_INIT')        
             for i in self.decoded_payload:
@@ -3377,7 +3955,7 @@ class nwu_swu():
                     protocol_id = i[1][1]
                     self.spi_resp_child = i[1][2]
                     if protocol_id == ESP:
-                        self.set_sa_negotiated_child(proposal)
+                        self.set_sa_negotiated_child(proposal, esn=self.decode_sa_child_proposal_esn(i[1][3]))
                         print('IPSEC RESP SPI',toHex(self.spi_resp_child))
                         print('IPSEC INIT SPI',toHex(self.spi_init_child))
                     else:
@@ -3404,7 +3982,7 @@ class nwu_swu():
                 self.send_data(packet)
                 print('sending INFORMATIONAL (delete IKE)')
                 
-            self.ike_to_ipsec_encoder.send(bytes([INTER_PROCESS_DELETE_SA]))
+            self.send_to_ipsec_encoders(bytes([INTER_PROCESS_DELETE_SA]))
             self.ike_to_ipsec_decoder.send(bytes([INTER_PROCESS_DELETE_SA])) 
             self.delete_routes()   
             if kill == True:
@@ -3424,7 +4002,7 @@ class nwu_swu():
                         self.send_data(packet)
                         print('answering INFORMATIONAL (DELETE IKE)')
                         if self.old_ike_message_received == False:
-                            self.ike_to_ipsec_encoder.send(bytes([INTER_PROCESS_DELETE_SA]))
+                            self.send_to_ipsec_encoders(bytes([INTER_PROCESS_DELETE_SA]))
                             self.ike_to_ipsec_decoder.send(bytes([INTER_PROCESS_DELETE_SA])) 
                             self.delete_routes()
                             exit(1)    
@@ -3435,6 +4013,30 @@ class nwu_swu():
                         packet = self.answer_INFORMATIONAL_delete_CHILD(ESP,spi_list)
                         self.send_data(packet)
                         print('answering INFORMATIONAL (DELETE SA CHILD)')
+                        if self.spi_resp_child_old in spi_list or self.spi_init_child_old in spi_list:
+                            self.retire_child_sa()
+
+
+    def state_delete_response(self): #INFORMATIONAL response: the old child SA of a rekey can be removed once its delete is answered
+        if self.child_delete_pending == True:
+            self.child_delete_pending = False
+            print('received INFORMATIONAL (DELETE SA CHILD) response')
+            self.retire_child_sa()
+
+
+    def retire_child_sa(self): #old child SA deleted: removed from the SA database, and the encoders switch to the new SA if they were waiting
+        if self.spi_init_child_old is None: return
+        self.sa_database.remove(self.spi_init_child_old, SA_INBOUND)
+        self.sa_database.remove(self.spi_resp_child_old, SA_OUTBOUND)
+        self.register_esp_demux()
+        self.send_to_ipsec_encoders(self.encode_inter_process_protocol([INTER_PROCESS_RETIRE_SA,[(INTER_PROCESS_IE_SPI_RESP, self.spi_resp_child_old)]]))
+        self.spi_init_child_old, self.spi_resp_child_old = None, None
+
+
+    def confirm_child_sa(self,decode_list): #INTER_PROCESS_SA_CONFIRMED from the decoder: the peer sends with the new child SA, so the encoders can use it
+        for i in decode_list[1]:
+            if i[0] == INTER_PROCESS_IE_SPI_INIT and i[1] == self.spi_init_child:
+                self.send_to_ipsec_encoders(self.encode_inter_process_protocol([INTER_PROCESS_SA_CONFIRMED,[(INTER_PROCESS_IE_SPI_RESP, self.spi_resp_child)]]))
                         
                         
     def state_epdg_create_sa(self):
@@ -3512,6 +4114,8 @@ class nwu_swu():
                     isIKE = True
                 elif protocol_id == ESP:
                     isESP = True               
+                    esn = self.decode_sa_child_proposal_esn(i[1][3])
+                    if esn is not None: self.negotiated_esn_child = esn
                     
             elif i[0] == KE:
                 dh_peer_group = i[1][0]
@@ -3538,6 +4142,7 @@ class nwu_swu():
             
             self.generate_new_ike_keying_material()
             self.message_id_request = -1
+            self.start_ike_sa_lifetime()
             
             #send request
             self.send_data(packet)
@@ -3549,6 +4154,7 @@ class nwu_swu():
             self.spi_init_child_old = self.spi_init_child
             self.spi_resp_child_old = self.spi_resp_child
             packet = self.create_INFORMATIONAL_delete(ESP,[self.spi_init_child_old])
+            self.child_delete_pending = True
 
             self.spi_init_child = self.sa_spi_list[0] #only one proposal was made
             self.spi_resp_child = spi
@@ -3557,6 +4163,7 @@ class nwu_swu():
             print('NEW CHILD SPI RESPONDER',toHex(self.spi_resp_child))
             
             self.generate_keying_material_child()
+            self.start_child_sa_lifetime()
             inter_process_list_start_encoder = [
                 INTER_PROCESS_UPDATE_SA,
                 [
@@ -3564,6 +4171,7 @@ class nwu_swu():
                     (INTER_PROCESS_IE_ENCR_KEY, self.SK_IPSEC_EI),
                     (INTER_PROCESS_IE_INTEG_ALG, self.negotiated_integrity_algorithm_child),
                     (INTER_PROCESS_IE_INTEG_KEY, self.SK_IPSEC_AI),
+                    (INTER_PROCESS_IE_ESN, self.negotiated_esn_child),
                     (INTER_PROCESS_IE_SPI_RESP, self.spi_resp_child)         
                 ]
             ]
@@ -3575,12 +4183,14 @@ class nwu_swu():
                     (INTER_PROCESS_IE_ENCR_KEY, self.SK_IPSEC_ER),
                     (INTER_PROCESS_IE_INTEG_ALG, self.negotiated_integrity_algorithm_child),
                     (INTER_PROCESS_IE_INTEG_KEY, self.SK_IPSEC_AR),
+                    (INTER_PROCESS_IE_ESN, self.negotiated_esn_child),
                     (INTER_PROCESS_IE_SPI_INIT, self.spi_init_child)
                 ]
             ]
                         
-            self.ike_to_ipsec_encoder.send(self.encode_inter_process_protocol(inter_process_list_start_encoder))
-            self.ike_to_ipsec_decoder.send(self.encode_inter_process_protocol(inter_process_list_start_decoder))            
+            if self.interface_type == SWU: self.add_tunnel_mtu_ie(inter_process_list_start_encoder)
+            self.send_to_ipsec_encoders(self.encode_inter_process_protocol(self.install_sa(SA_OUTBOUND, inter_process_list_start_encoder)))
+            self.install_sa(SA_INBOUND, inter_process_list_start_decoder)            
             
             #send request
             self.send_data(packet)        
@@ -3592,11 +4202,10 @@ class nwu_swu():
         self.set_routes()
     
         #set ipsec tunnel handlers
-        self.ike_to_ipsec_encoder, self.ipsec_encoder_to_ike = multiprocessing.Pipe()
-        self.ike_to_ipsec_decoder, self.ipsec_decoder_to_ike = multiprocessing.Pipe()
+        self.ike_to_ipsec_decoder, self.ipsec_decoder_to_ike = ring_pipe()
            
-        ipsec_input_worker = multiprocessing.Process(target = self.encapsulate_ipsec, args=([self.ipsec_encoder_to_ike],))
-        ipsec_input_worker.start()
+        self.start_sa_database()
+        self.start_ipsec_encoders()
         ipsec_output_worker = multiprocessing.Process(target = self.decapsulate_ipsec, args=([self.ipsec_decoder_to_ike],))
         ipsec_output_worker.start()
         
@@ -3607,6 +4216,7 @@ class nwu_swu():
                 (INTER_PROCESS_IE_ENCR_KEY, self.SK_IPSEC_EI),
                 (INTER_PROCESS_IE_INTEG_ALG, self.negotiated_integrity_algorithm_child),
                 (INTER_PROCESS_IE_INTEG_KEY, self.SK_IPSEC_AI),
+                (INTER_PROCESS_IE_ESN, self.negotiated_esn_child),
                 (INTER_PROCESS_IE_SPI_RESP, self.spi_resp_child)         
             ]
         ]
@@ -3618,18 +4228,23 @@ class nwu_swu():
                 (INTER_PROCESS_IE_ENCR_KEY, self.SK_IPSEC_ER),
                 (INTER_PROCESS_IE_INTEG_ALG, self.negotiated_integrity_algorithm_child),
                 (INTER_PROCESS_IE_INTEG_KEY, self.SK_IPSEC_AR),
+                (INTER_PROCESS_IE_ESN, self.negotiated_esn_child),
                 (INTER_PROCESS_IE_SPI_INIT, self.spi_init_child)         
             ]
         ]
              
-        self.ike_to_ipsec_encoder.send(self.encode_inter_process_protocol(inter_process_list_start_encoder))
-        self.ike_to_ipsec_decoder.send(self.encode_inter_process_protocol(inter_process_list_start_decoder))       
+        self.add_tunnel_mtu_ie(inter_process_list_start_encoder)
+        self.send_to_ipsec_encoders(self.encode_inter_process_protocol(self.install_sa(SA_OUTBOUND, inter_process_list_start_encoder)))
+        self.install_sa(SA_INBOUND, inter_process_list_start_decoder)       
        
-        socket_list = [sys.stdin , self.socket, self.ike_to_ipsec_decoder]
+        self.start_ike_sa_lifetime()
+        self.start_child_sa_lifetime()
+        socket_list = [sys.stdin , self.socket, self.ike_to_ipsec_decoder] + self.ike_to_ipsec_encoder_list
+        if self.socket_nat_esp is not None: socket_list.append(self.socket_nat)
         
         while True:
             
-            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [])
+            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [], self.lifetime_timeout())
             
             for sock in read_sockets:
      
@@ -3642,6 +4257,8 @@ class nwu_swu():
                 
                             if self.ike_decoded_header['exchange_type'] == INFORMATIONAL and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 0:
                                 self.state_delete(False)
+                            elif self.ike_decoded_header['exchange_type'] == INFORMATIONAL and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 1:
+                                self.state_delete_response()
                                
                             elif self.ike_decoded_header['exchange_type'] == CREATE_CHILD_SA and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 0:
                                 self.state_epdg_create_sa()
@@ -3652,9 +4269,13 @@ class nwu_swu():
                         if self.old_ike_message_received == True:
                             self.old_ike_message_received = False
 
-                elif sock == self.ike_to_ipsec_decoder:
-                    pipe_packet = self.ike_to_ipsec_decoder.recv()
-                    decode_list = self.decode_inter_process_protocol(pipe_packet)
+                elif sock == self.socket_nat or sock == self.ike_to_ipsec_decoder:
+                    if sock == self.socket_nat: #IKE in udp 4500 split from ESP by the kernel (set_ike_esp_split), instead of forwarded by the decoder
+                        packet, server_address = self.socket_nat.recvfrom(2000)
+                        decode_list = [INTER_PROCESS_IKE,[(INTER_PROCESS_IE_IKE_MESSAGE, packet)]]
+                    else:
+                        pipe_packet = self.ike_to_ipsec_decoder.recv()
+                        decode_list = self.decode_inter_process_protocol(pipe_packet)
                     if decode_list[0] == INTER_PROCESS_IKE:
 
                         packet = decode_list[1][0][1]
@@ -3666,6 +4287,8 @@ class nwu_swu():
                             
                             if self.ike_decoded_header['exchange_type'] == INFORMATIONAL and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 0:
                                 self.state_delete(False)
+                            elif self.ike_decoded_header['exchange_type'] == INFORMATIONAL and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 1:
+                                self.state_delete_response()
                             
                             elif self.ike_decoded_header['exchange_type'] == CREATE_CHILD_SA and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 0:
                                 self.state_epdg_create_sa()                        
@@ -3676,6 +4299,18 @@ class nwu_swu():
                         if self.old_ike_message_received == True:
                             self.old_ike_message_received = False
 
+                    elif decode_list[0] == INTER_PROCESS_SA_USAGE:
+                        self.update_sa_usage(sock, decode_list)
+
+                    elif decode_list[0] == INTER_PROCESS_SA_CONFIRMED:
+                        self.confirm_child_sa(decode_list)
+
+                elif sock in self.ike_to_ipsec_encoder_list:
+                    pipe_packet = sock.recv()
+                    decode_list = self.decode_inter_process_protocol(pipe_packet)
+                    if decode_list[0] == INTER_PROCESS_SA_USAGE:
+                        self.update_sa_usage(sock, decode_list)
+
                 else:
                     msg = sys.stdin.readline()
                     if msg == "q\n":  #quit
@@ -3697,6 +4332,8 @@ class nwu_swu():
                     else:
                         print('\nPress q to quit, i to rekey ike, c to rekey child sa, r to reauth.\n')
 
+            self.check_lifetimes()
+
 
 
 ################################## STATES FOR NWU ##################################
@@ -3705,26 +4342,17 @@ class nwu_swu():
 
 
     def state_2_nwu(self):
+        self.state_2_nwu_send()
+        if self.receive_ike_response() is None: return TIMEOUT,'TIMEOUT'
+        return self.state_2_nwu_process()
+
+    def state_2_nwu_send(self):
         self.message_id_request += 1
         packet = self.create_IKE_AUTH_1_NWU()
         self.send_data(packet)
         print('sending IKE_AUTH (1)')        
 
-        try:
-        
-            while True:
-                if self.userplane_mode == ESP_PROTOCOL:
-                    packet, address = self.socket.recvfrom(2000)  
-                    self.decode_ike(packet)
-                    if self.ike_decoded_ok == True: break
-                else:
-                    packet, address = self.socket_nat.recvfrom(2000)  
-                    self.decode_ike(packet[4:])
-                    if self.ike_decoded_ok == True: break
-                
-        except: #timeout
-            return TIMEOUT,'TIMEOUT'        
-        
+    def state_2_nwu_process(self):
         eap_received = False
         if self.ike_decoded_header['exchange_type'] == IKE_AUTH and self.decoded_payload[0][0] == SK:
             print('received IKE_AUTH (1)')             
@@ -3796,26 +4424,17 @@ class nwu_swu():
             return DECODING_ERROR,'DECODING_ERROR'
 
     def state_3_nwu(self):
+        self.state_3_nwu_send()
+        if self.receive_ike_response() is None: return TIMEOUT,'TIMEOUT'
+        return self.state_3_nwu_process()
+
+    def state_3_nwu_send(self):
         self.message_id_request += 1
         packet = self.create_IKE_AUTH_2_NWU()
         self.send_data(packet)
         print('sending IKE_SA_AUTH (2)')        
 
-        try:
-        #if True:
-            while True:
-                if self.userplane_mode == ESP_PROTOCOL:
-                    packet, address = self.socket.recvfrom(2000)  
-                    self.decode_ike(packet)
-                    if self.ike_decoded_ok == True: break
-                else:
-                    packet, address = self.socket_nat.recvfrom(2000)  
-                    self.decode_ike(packet[4:])
-                    if self.ike_decoded_ok == True: break
-                
-        except: #timeout
-            return TIMEOUT,'TIMEOUT'
-
+    def state_3_nwu_process(self):
         eap_received = False
         nas_received = False
         if self.ike_decoded_header['exchange_type'] == IKE_AUTH and self.decoded_payload[0][0] == SK:
@@ -3992,26 +4611,17 @@ class nwu_swu():
 
 
     def state_4_nwu(self):
+        self.state_4_nwu_send()
+        if self.receive_ike_response() is None: return TIMEOUT,'TIMEOUT'
+        return self.state_4_nwu_process()
+
+    def state_4_nwu_send(self):
         self.message_id_request += 1
         packet = self.create_IKE_AUTH_2_NWU()
         self.send_data(packet)
         print('sending IKE_SA_AUTH (3)')
 
-        try:
-        #if True:
-            while True:
-                if self.userplane_mode == ESP_PROTOCOL:
-                    packet, address = self.socket.recvfrom(2000)
-                    self.decode_ike(packet)
-                    if self.ike_decoded_ok == True: break
-                else:
-                    packet, address = self.socket_nat.recvfrom(2000)  
-                    self.decode_ike(packet[4:])
-                    if self.ike_decoded_ok == True: break
-                
-        except: #timeout
-            return TIMEOUT,'TIMEOUT' 
-
+    def state_4_nwu_process(self):
         eap_received = False
         nas_received = False
         if self.ike_decoded_header['exchange_type'] == IKE_AUTH and self.decoded_payload[0][0] == SK:
@@ -4096,26 +4706,17 @@ class nwu_swu():
 
 
     def state_5_nwu(self):
+        self.state_5_nwu_send()
+        if self.receive_ike_response() is None: return TIMEOUT,'TIMEOUT'
+        return self.state_5_nwu_process()
+
+    def state_5_nwu_send(self):
         self.message_id_request += 1
         packet = self.create_IKE_AUTH_2_NWU()
         self.send_data(packet)
         print('sending IKE_SA_AUTH (4)')
 
-        try:
-        #if True:
-            while True:
-                if self.userplane_mode == ESP_PROTOCOL:
-                    packet, address = self.socket.recvfrom(2000)
-                    self.decode_ike(packet)
-                    if self.ike_decoded_ok == True: break
-                else:
-                    packet, address = self.socket_nat.recvfrom(2000)  
-                    self.decode_ike(packet[4:])
-                    if self.ike_decoded_ok == True: break
-                
-        except: #timeout
-            return TIMEOUT,'TIMEOUT' 
-
+    def state_5_nwu_process(self):
         eap_received = False              
         if self.ike_decoded_header['exchange_type'] == IKE_AUTH and self.decoded_payload[0][0] == SK:
             print('received IKE_AUTH (4)')              
@@ -4148,27 +4749,17 @@ class nwu_swu():
 
 
     def state_6_nwu(self):
+        self.state_6_nwu_send()
+        if self.receive_ike_response() is None: return TIMEOUT,'TIMEOUT'
+        return self.state_6_nwu_process()
+
+    def state_6_nwu_send(self):
         self.message_id_request += 1
         packet = self.create_IKE_AUTH_3_NWU()
         self.send_data(packet)
         print('sending IKE_SA_AUTH (5)')
 
-        try:
-        #if True:
-            while True:
-                if self.userplane_mode == ESP_PROTOCOL:
-                    packet, address = self.socket.recvfrom(2000)  
-                    self.decode_ike(packet)
-                    if self.ike_decoded_ok == True: break
-                else:
-                    packet, address = self.socket_nat.recvfrom(2000)  
-                    self.decode_ike(packet[4:])
-                    if self.ike_decoded_ok == True: break
-                
-        except: #timeout
-            return TIMEOUT,'TIMEOUT' 
-
-
+    def state_6_nwu_process(self):
         if self.ike_decoded_header['exchange_type'] == IKE_AUTH and self.decoded_payload[0][0] == SK:
             print('received IKE_AUTH (5)')
             for i in self.decoded_payload[0][1]:
@@ -4208,7 +4799,7 @@ class nwu_swu():
                     protocol_id = i[1][1]
                     self.spi_resp_child = i[1][2]
                     if protocol_id == ESP:
-                        self.set_sa_negotiated_child(proposal)
+                        self.set_sa_negotiated_child(proposal, esn=self.decode_sa_child_proposal_esn(i[1][3]))
                         print('IPSEC RESP SPI',toHex(self.spi_resp_child))
                         print('IPSEC INIT SPI',toHex(self.spi_init_child))
                         print('IPSEC PROPOSAL', proposal)
@@ -4328,12 +4919,11 @@ class nwu_swu():
         self.set_routes_nwu_tcp()
 
         #set ipsec tunnel handlers
-        self.ike_to_ipsec_encoder, self.ipsec_encoder_to_ike = multiprocessing.Pipe()
-        self.ike_to_ipsec_decoder, self.ipsec_decoder_to_ike = multiprocessing.Pipe()
+        self.ike_to_ipsec_decoder, self.ipsec_decoder_to_ike = ring_pipe()
 
         #first SA child - signalling SA Child   
-        ipsec_input_worker = multiprocessing.Process(target = self.encapsulate_ipsec, args=([self.ipsec_encoder_to_ike],))
-        ipsec_input_worker.start()
+        self.start_sa_database()
+        self.start_ipsec_encoders()
         ipsec_output_worker = multiprocessing.Process(target = self.decapsulate_ipsec, args=([self.ipsec_decoder_to_ike],))
         ipsec_output_worker.start()
         
@@ -4344,6 +4934,7 @@ class nwu_swu():
                 (INTER_PROCESS_IE_ENCR_KEY, self.SK_IPSEC_EI),
                 (INTER_PROCESS_IE_INTEG_ALG, self.negotiated_integrity_algorithm_child),
                 (INTER_PROCESS_IE_INTEG_KEY, self.SK_IPSEC_AI),
+                (INTER_PROCESS_IE_ESN, self.negotiated_esn_child),
                 (INTER_PROCESS_IE_SPI_RESP, self.spi_resp_child)         
             ]
         ]
@@ -4355,21 +4946,24 @@ class nwu_swu():
                 (INTER_PROCESS_IE_ENCR_KEY, self.SK_IPSEC_ER),
                 (INTER_PROCESS_IE_INTEG_ALG, self.negotiated_integrity_algorithm_child),
                 (INTER_PROCESS_IE_INTEG_KEY, self.SK_IPSEC_AR),
+                (INTER_PROCESS_IE_ESN, self.negotiated_esn_child),
                 (INTER_PROCESS_IE_SPI_INIT, self.spi_init_child)         
             ]
         ]
              
-        self.ike_to_ipsec_encoder.send(self.encode_inter_process_protocol(inter_process_list_start_encoder))
-        self.ike_to_ipsec_decoder.send(self.encode_inter_process_protocol(inter_process_list_start_decoder))       
+        self.send_to_ipsec_encoders(self.encode_inter_process_protocol(self.install_sa(SA_OUTBOUND, inter_process_list_start_encoder)))
+        self.install_sa(SA_INBOUND, inter_process_list_start_decoder)       
 
-        self.ike_to_tcp_process, self.tcp_process_to_ike = multiprocessing.Pipe()
+        self.ike_to_tcp_process, self.tcp_process_to_ike = ring_pipe()
         tcp_worker = multiprocessing.Process(target = self.tcp_process, args=([self.tcp_process_to_ike, self.nas_ip_address, self.nas_tcp_port, self.tunnel_ipv4_address],))
         tcp_worker.start()
         
-        socket_list = [sys.stdin , self.socket, self.ike_to_ipsec_decoder, self.ike_to_tcp_process]
+        self.start_ike_sa_lifetime()
+        socket_list = [sys.stdin , self.socket, self.ike_to_ipsec_decoder, self.ike_to_tcp_process] + self.ike_to_ipsec_encoder_list
+        if self.socket_nat_esp is not None: socket_list.append(self.socket_nat)
         
         while True:            
-            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [])
+            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [], self.lifetime_timeout())
             
             for sock in read_sockets:
      
@@ -4380,16 +4974,24 @@ class nwu_swu():
                         self.decode_ike(packet) 
                         if self.ike_decoded_ok == True:                
                             if self.ike_decoded_header['exchange_type'] == INFORMATIONAL and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 0:
-                                self.state_delete(False)                            
+                                self.state_delete(False)
+                            elif self.ike_decoded_header['exchange_type'] == INFORMATIONAL and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 1:
+                                self.state_delete_response()                            
                             elif self.ike_decoded_header['exchange_type'] == CREATE_CHILD_SA and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 0:
                                 self.state_n3iwf_create_sa_child_nwu()                            
+                            elif self.ike_decoded_header['exchange_type'] == CREATE_CHILD_SA and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 1:
+                                self.state_epdg_create_sa_response()
       
                         if self.old_ike_message_received == True:
                             self.old_ike_message_received = False                                                                                                                 
 
-                elif sock == self.ike_to_ipsec_decoder:
-                    pipe_packet = self.ike_to_ipsec_decoder.recv()                     
-                    decode_list = self.decode_inter_process_protocol(pipe_packet)
+                elif sock == self.socket_nat or sock == self.ike_to_ipsec_decoder:
+                    if sock == self.socket_nat: #IKE in udp 4500 split from ESP by the kernel (set_ike_esp_split), instead of forwarded by the decoder
+                        packet, server_address = self.socket_nat.recvfrom(2000)
+                        decode_list = [INTER_PROCESS_IKE,[(INTER_PROCESS_IE_IKE_MESSAGE, packet)]]
+                    else:
+                        pipe_packet = self.ike_to_ipsec_decoder.recv()                     
+                        decode_list = self.decode_inter_process_protocol(pipe_packet)
                     if decode_list[0] == INTER_PROCESS_IKE:
 
                         packet = decode_list[1][0][1]
@@ -4399,12 +5001,28 @@ class nwu_swu():
 
                         if self.ike_decoded_ok == True:                               
                             if self.ike_decoded_header['exchange_type'] == INFORMATIONAL and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 0:
-                                self.state_delete(False)                      
+                                self.state_delete(False)
+                            elif self.ike_decoded_header['exchange_type'] == INFORMATIONAL and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 1:
+                                self.state_delete_response()                      
                             elif self.ike_decoded_header['exchange_type'] == CREATE_CHILD_SA and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 0:
                                 self.state_n3iwf_create_sa_child_nwu()                                              
+                            elif self.ike_decoded_header['exchange_type'] == CREATE_CHILD_SA and self.decoded_payload[0][0] == SK and self.ike_decoded_header['flags'][0] == 1:
+                                self.state_epdg_create_sa_response()
                         
                         if self.old_ike_message_received == True:
                             self.old_ike_message_received = False
+
+                    elif decode_list[0] == INTER_PROCESS_SA_USAGE:
+                        self.update_sa_usage(sock, decode_list)
+
+                    elif decode_list[0] == INTER_PROCESS_SA_CONFIRMED:
+                        self.confirm_child_sa(decode_list)
+
+                elif sock in self.ike_to_ipsec_encoder_list:
+                    pipe_packet = sock.recv()
+                    decode_list = self.decode_inter_process_protocol(pipe_packet)
+                    if decode_list[0] == INTER_PROCESS_SA_USAGE:
+                        self.update_sa_usage(sock, decode_list)
                 
                 elif sock == self.ike_to_tcp_process:
                     pipe_packet = self.ike_to_tcp_process.recv()                     
@@ -4440,6 +5058,8 @@ class nwu_swu():
                     else:
                         print('\nPress q to quit.\n')
 
+            self.check_lifetimes()
+
 
     def state_delete_pdu_session_release_request(self):
         nas_pdu_session_release_request = nas_5gs_sm_pdu_session_release_request(self.nas_pdu_session_id,self.nas_pti,IE_5GSM_CAUSE__REGULAR_DEACTIVATION,None)
@@ -4516,6 +5136,9 @@ class nwu_swu():
             else:
                 packet = self.answer_CREATE_CHILD_SA_CHILD_nwu(proposal_bytes=response_proposal_bytes,ke=True)            
                         
+            if self.sa_database_spi.get((SA_INBOUND, True)) is not None: #rekey of the userplane SA: previous SA kept by the ESP workers till the N3IWF deletes it
+                self.spi_init_child_old = self.sa_database_spi[(SA_INBOUND, True)]
+                self.spi_resp_child_old = self.sa_database_spi.get((SA_OUTBOUND, True))
             self.spi_init_child = spi
             self.spi_resp_child = spi
 
@@ -4526,6 +5149,7 @@ class nwu_swu():
             self.nounce_received, self.nounce = self.nounce, self.nounce_received
                        
             self.generate_keying_material_child(reverse=True)            
+            self.set_userplane_tunnel_mtu()
             
             #invert keys to send to each process since N3IWF is the initiator of the CREATE_CHILD_SA            
             inter_process_list_start_decoder = [
@@ -4535,6 +5159,7 @@ class nwu_swu():
                     (INTER_PROCESS_IE_ENCR_KEY, self.SK_IPSEC_EI),
                     (INTER_PROCESS_IE_INTEG_ALG, self.negotiated_integrity_algorithm_child),
                     (INTER_PROCESS_IE_INTEG_KEY, self.SK_IPSEC_AI),
+                    (INTER_PROCESS_IE_ESN, self.negotiated_esn_child),
                     (INTER_PROCESS_IE_SPI_RESP, self.spi_resp_child),
                     (INTER_PROCESS_IE_QFI, self.userplane_qfi),
                     (INTER_PROCESS_IE_USERPLANE_IP_ADDRESS, socket.inet_aton(self.up_ipv4_address)), 
@@ -4549,16 +5174,19 @@ class nwu_swu():
                     (INTER_PROCESS_IE_ENCR_KEY, self.SK_IPSEC_ER),
                     (INTER_PROCESS_IE_INTEG_ALG, self.negotiated_integrity_algorithm_child),
                     (INTER_PROCESS_IE_INTEG_KEY, self.SK_IPSEC_AR),
+                    (INTER_PROCESS_IE_ESN, self.negotiated_esn_child),
                     (INTER_PROCESS_IE_SPI_INIT, self.spi_init_child),
+                    (INTER_PROCESS_IE_WAIT_CONFIRMATION, 1),
                     (INTER_PROCESS_IE_QFI, self.userplane_qfi),     
                     (INTER_PROCESS_IE_USERPLANE_IP_ADDRESS, socket.inet_aton(self.up_ipv4_address)), 
                     (INTER_PROCESS_IE_TUNNEL_IP_ADDRESS, socket.inet_aton(self.tunnel_ipv4_address))
                 ]
             ]
                 
+            self.add_tunnel_mtu_ie(inter_process_list_start_encoder)
                                                 
-            self.ike_to_ipsec_encoder.send(self.encode_inter_process_protocol(inter_process_list_start_encoder))
-            self.ike_to_ipsec_decoder.send(self.encode_inter_process_protocol(inter_process_list_start_decoder))            
+            self.send_to_ipsec_encoders(self.encode_inter_process_protocol(self.install_sa(SA_OUTBOUND, inter_process_list_start_encoder)))
+            self.install_sa(SA_INBOUND, inter_process_list_start_decoder)            
             
             #send request
             self.send_data(packet)        
@@ -4574,6 +5202,7 @@ class nwu_swu():
 
     def start_ike(self):
         print('INTERFACE_TYPE',self.interface_type)
+        self.prepare_netns_pool()
         if self.interface_type == SWU: self.start_ike_swu()    
         if self.interface_type == NWU: self.start_ike_nwu()
         
@@ -4737,6 +5366,905 @@ class nwu_swu():
 #######################################################################################################################
 #######################################################################################################################
 
+# Crypto state of one SA (IKE SA direction or ESP SA), built once when the SA is created or updated,
+# so that each packet only does the per packet work (no key expansion or HMAC key setup per packet).
+class sa_context():
+
+    def __init__(self,encr_alg,encr_key,integ_alg,integ_key,integ_hash,hash_size,esn=False):
+        self.encr_alg = encr_alg
+        self.integ_alg = integ_alg
+        self.esn = esn #64 bit sequence numbers (RFC 4303): only the low order 32 bits are sent
+        self.hash_size = hash_size
+        self.mac_length = 0
+        self.replay_window = None #set only for inbound SAs
+        self.userplane = False #inbound SAs: userplane SA (GRE) of NWU
+        self.auth_failures = 0 #inbound packets dropped due to wrong ICV
+        self.packets = 0 #processed packets and bytes (before encryption/after decryption), reported for SA lifetimes
+        self.bytes = 0
+        self.reported_packets = 0
+        
+        self.hmac = None
+        if integ_hash is not None and hash_size != 0:
+            self.hmac = hmac.HMAC(integ_key,integ_hash) #copied for each packet
+        
+        if encr_alg in (ENCR_AES_CBC,):
+            self.aes = algorithms.AES(encr_key)
+            # CBC encryption and decryption continue long lived CBC contexts, chained to the last cipher block of the previous packet:
+            # the first block of each packet is corrected with vector xor that block, so the result is the one of a new context.
+            # Encryption: C(1) = E(P(1) xor vector). Decryption: P(1) = D(C(1)) xor vector
+            self.cbc_encryptor = Cipher(self.aes, modes.CBC(bytes(16))).encryptor()
+            self.cbc_chaining = bytes(16)
+            self.cbc_decryptor = Cipher(self.aes, modes.CBC(bytes(16))).decryptor()
+            self.cbc_decrypt_chaining = bytes(16)
+            
+        elif encr_alg in (ENCR_AES_GCM_8, ENCR_AES_GCM_12, ENCR_AES_GCM_16):
+            if encr_alg == ENCR_AES_GCM_8: self.mac_length = 8
+            if encr_alg == ENCR_AES_GCM_12: self.mac_length = 12
+            if encr_alg == ENCR_AES_GCM_16: self.mac_length = 16        
+            #last 4 bytes of keying material are the salt (RFC 4106)
+            self.salt = encr_key[-4:]
+            self.aes = algorithms.AES(encr_key[:-4])
+            self.aead = AESGCM(encr_key[:-4])
+
+        elif encr_alg in (ENCR_CHACHA20_POLY1305,):
+            #same ESP format as GCM: 8 bytes IV, nonce = salt (last 4 bytes of keying material) + IV, 16 bytes ICV (RFC 7634)
+            self.mac_length = 16
+            self.salt = encr_key[-4:]
+            self.aead = ChaCha20Poly1305(encr_key[:-4])
+
+
+    def integrity(self,data,seq_hi=b''):
+        if self.hmac is None: return b''
+        h = self.hmac.copy()
+        h.update(data)
+        if seq_hi: h.update(seq_hi)
+        return h.finalize()[0:self.hash_size]
+
+
+    def verify_integrity(self,data,icv,seq_hi=b''): #constant time compare of the (truncated) ICV
+        if self.hmac is None: return True
+        if len(icv) != self.hash_size or constant_time.bytes_eq(self.integrity(data,seq_hi), bytes(icv)) == False:
+            self.auth_failures += 1
+            return False
+        return True
+        
+
+    def seq_hi(self,sqn): #high order 32 bits of the ESN, appended to the ICV input but not sent (RFC 4303 section 2.2.1)
+        if self.esn == False: return b''
+        return struct.pack("!I", sqn >> 32)
+
+
+    def aad(self,spi,sqn): #AEAD associated data: SPI + sequence number, or SPI + 64 bit ESN (RFC 4106 section 5, RFC 7634 section 3)
+        if self.esn == False: return spi + struct.pack("!I", sqn)
+        return spi + struct.pack("!Q", sqn)
+
+
+    def xor_block(self,a,b,c): #a xor b xor c, 16 bytes
+        return (int.from_bytes(a,'big') ^ int.from_bytes(b,'big') ^ int.from_bytes(c,'big')).to_bytes(16,'big')
+
+
+    def cbc_encrypt(self,vector,data): #data is padded to the block size
+        cipher_data = self.cbc_encryptor.update(self.xor_block(data[0:16], vector, self.cbc_chaining) + data[16:])
+        self.cbc_chaining = cipher_data[-16:]
+        return cipher_data
+
+
+    def cbc_decrypt(self,vector,data):
+        if len(data) == 0 or len(data) % 16 != 0: return None #would leave bytes in the CBC context
+        uncipher_data = self.cbc_decryptor.update(data)
+        first_block = self.xor_block(uncipher_data[0:16], vector, self.cbc_decrypt_chaining)
+        self.cbc_decrypt_chaining = bytes(data[-16:])
+        return first_block + uncipher_data[16:]
+
+
+    def cbc_encrypt_into(self,vector,data,out): #out is data extended by 15 bytes (update_into needs room for one more block), so encryption is in place
+        data[0:16] = self.xor_block(data[0:16], vector, self.cbc_chaining)
+        length = self.cbc_encryptor.update_into(data, out)
+        self.cbc_chaining = bytes(out[length-16:length])
+
+
+    def cbc_decrypt_into(self,vector,data,buffer): #returns memoryview of buffer with the plain data
+        if len(data) == 0 or len(data) % 16 != 0: return None
+        length = self.cbc_decryptor.update_into(data, buffer)
+        buffer[0:16] = self.xor_block(buffer[0:16], vector, self.cbc_decrypt_chaining)
+        self.cbc_decrypt_chaining = bytes(data[-16:])
+        return memoryview(buffer)[0:length]
+
+
+    def aead_encrypt(self,vector,data,aad): #AES-GCM or ChaCha20-Poly1305. returns cipher data + tag (truncated to mac_length)
+        return self.aead.encrypt(self.salt + vector, data, aad)[0:len(data)+self.mac_length]
+
+
+    def aead_encrypt_into(self,vector,data,out,aad): #out as in cbc_encrypt_into. returns tag (truncated to mac_length)
+        # the AEAD object is built once, while a GCM context of cryptography is bound to its nonce: copying the data is cheaper than
+        # a new context per packet
+        cipher_data_and_tag = self.aead.encrypt(self.salt + vector, bytes(data), bytes(aad))
+        out[0:len(data)] = cipher_data_and_tag[0:len(data)]
+        return cipher_data_and_tag[len(data):len(data)+self.mac_length]
+
+
+    def aead_decrypt_into(self,vector,data,tag,aad,buffer): #returns memoryview of buffer with the plain data, or None if tag is wrong
+        try:
+            if self.mac_length == 16:
+                uncipher_data = self.aead.decrypt(self.salt + bytes(vector), bytes(data) + bytes(tag), bytes(aad))
+                buffer[0:len(uncipher_data)] = uncipher_data
+                return memoryview(buffer)[0:len(uncipher_data)]
+            #truncated ICV: AESGCM only checks 16 byte tags, and a GCM context is bound to its nonce, so one is made per packet
+            decryptor = Cipher(self.aes, modes.GCM(self.salt + vector, bytes(tag), min_tag_length=self.mac_length)).decryptor()
+            decryptor.authenticate_additional_data(aad)
+            length = decryptor.update_into(data, buffer)
+            decryptor.finalize()
+            return memoryview(buffer)[0:length]
+        except exceptions.InvalidTag:
+            return None
+
+
+    def aead_decrypt(self,vector,data,tag,aad):
+        try:
+            if self.mac_length == 16:
+                return self.aead.decrypt(self.salt + vector, data + tag, aad)
+            #truncated ICV: AESGCM only checks 16 byte tags, and a GCM context is bound to its nonce, so one is made per packet
+            decryptor = Cipher(self.aes, modes.GCM(self.salt + vector, tag, min_tag_length=self.mac_length)).decryptor()
+            decryptor.authenticate_additional_data(aad)
+            return decryptor.update(data) + decryptor.finalize()
+        except exceptions.InvalidTag:
+            return None
+
+
+# RFC 4303 anti-replay window of an inbound SA. The bitmap is a ring of size bits indexed by sequence number (as in RFC 6479),
+# so moving the window only clears the slots being reused instead of shifting the whole bitmap.
+# gaps counts sequence numbers skipped when the window moves forward, reorders counts the ones that arrived later inside the window
+# (gaps - reorders ~ downlink loss), duplicates and too_old count dropped packets.
+class replay_window():
+
+    def __init__(self,size):
+        self.size = size
+        self.bitmap = bytearray(size)
+        self.top = 0 #highest authenticated sequence number
+        self.received = 0
+        self.gaps = 0
+        self.reorders = 0
+        self.duplicates = 0
+        self.too_old = 0
+
+
+    def estimate_sqn(self,sqn_low): #ESN: 64 bit sequence number from the received low order 32 bits (RFC 4303 appendix A2.2)
+        top_low = self.top & 0xFFFFFFFF
+        top_high = self.top >> 32
+        bottom_low = (top_low - self.size + 1) & 0xFFFFFFFF
+        if top_low >= self.size - 1: #window inside one 2^32 subspace
+            if sqn_low < bottom_low: top_high += 1
+        else: #window spans two subspaces
+            if sqn_low >= bottom_low and top_high > 0: top_high -= 1
+        return (top_high << 32) + sqn_low
+
+
+    def check(self,sqn):
+        if sqn > self.top: return True
+        if sqn == 0 or sqn + self.size <= self.top:
+            self.too_old += 1
+            return False
+        if self.bitmap[sqn % self.size] == 1:
+            self.duplicates += 1
+            return False
+        return True
+
+
+    def update(self,sqn): #called after check() and a successful integrity check
+        self.received += 1
+        if sqn > self.top:
+            diff = sqn - self.top
+            if diff > 1: self.gaps += diff - 1
+            if diff >= self.size:
+                self.bitmap[:] = bytes(self.size)
+            else:
+                start, end = (self.top + 1) % self.size, (sqn + 1) % self.size
+                if start < end:
+                    self.bitmap[start:end] = bytes(diff)
+                else:
+                    self.bitmap[start:] = bytes(self.size - start)
+                    self.bitmap[:end] = bytes(end)
+            self.top = sqn
+        else:
+            self.reorders += 1
+        self.bitmap[sqn % self.size] = 1
+
+
+    def statistics(self):
+        return {'received': self.received, 'highest sqn': self.top, 'gaps': self.gaps, 'reorders': self.reorders, 'duplicates': self.duplicates, 'too old': self.too_old}
+
+
+# IPv4 fragment reassembly with bounded memory. Each incomplete packet has a buffer where fragments are copied at their offset
+# (so they can arrive in any order), sized with the total length once the last fragment is known. Entries are kept in LRU order:
+# the ones without fragments for timeout seconds expire, and the least recently used are evicted while above max_memory bytes.
+FRAGMENT_HOLE_END = 1 << 32 #end of the last hole till the last fragment is received (bigger than any fragment end)
+
+class fragment_reassembly():
+
+    def __init__(self,timeout,max_memory):
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.entries = collections.OrderedDict() #key -> [last update, buffer, total length (None till last fragment), holes]
+        self.memory = 0
+        self.reassembled = 0
+        self.timeouts = 0
+        self.evictions = 0
+        self.duplicates = 0
+
+
+    def add(self,key,offset,more_fragments,data): #returns the reassembled payload when complete, else None
+        now = time.monotonic()
+        self.expire(now)
+        
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = [now, bytearray(), None, [[0, FRAGMENT_HOLE_END]]]
+            self.entries[key] = entry
+        else:
+            entry[0] = now
+            self.entries.move_to_end(key)
+        buffer = entry[1]
+        
+        # hole list (RFC 815): [first, end) ranges not received yet. The datagram is complete when the last fragment was
+        # received and no hole is left, so overlapping fragments are not counted twice
+        end = offset + len(data)
+        if more_fragments == 0:
+            entry[2] = end
+        hole_list = []
+        filled = False
+        for first, last in entry[3]:
+            if end <= first or offset >= last:
+                hole_list.append([first, last])
+                continue
+            filled = True
+            if first < offset: hole_list.append([first, offset])
+            if end < last: hole_list.append([end, last])
+        if entry[2] is not None:
+            hole_list = [[first, min(last, entry[2])] for first, last in hole_list if first < entry[2]]
+        entry[3] = hole_list
+        if filled == False:
+            self.duplicates += 1
+            return None
+        if end > len(buffer):
+            size = entry[2] if entry[2] is not None and entry[2] >= end else end
+            self.memory += size - len(buffer)
+            buffer.extend(bytes(size - len(buffer)))
+        buffer[offset:end] = data
+        
+        if entry[2] is not None and entry[3] == []:
+            del self.entries[key]
+            self.memory -= len(buffer)
+            self.reassembled += 1
+            return bytes(buffer[0:entry[2]])
+
+        while self.memory > self.max_memory and len(self.entries) > 0:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.memory -= len(old_entry[1])
+            self.evictions += 1
+        return None
+
+
+    def expire(self,now):
+        while len(self.entries) > 0:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry[0] < self.timeout: return
+            del self.entries[key]
+            self.memory -= len(entry[1])
+            self.timeouts += 1
+
+
+    def statistics(self):
+        return {'reassembled': self.reassembled, 'pending': len(self.entries), 'memory': self.memory, 'timeouts': self.timeouts, 'evictions': self.evictions, 'duplicates': self.duplicates}
+
+
+# Outer IPv4 + GRE headers (24.502, section 9.3.3) of the uplink userplane packets of one SA/QFI, built once.
+# Per packet only the total length changes, so the header checksum is updated incrementally (RFC 1624, eqn. 3):
+# the templates are built with total length 0 (m = 0), so HC' = checksum_update(HC, 0, m').
+class gre_header_template():
+
+    def __init__(self,source_address,destination_address,qfi):
+        # GRE protocol type should be set to zero and ignored by the receiving entity (24.502 9.3.3), but it is set according to the
+        # payload packet type (ipv4 or ipv6), so that these packets are decoded in wireshark. No RQI in uplink packets
+        self.templates = {}
+        for version, gre_header_protocol in ((4, 0x0800), (6, 0x86dd)):
+            header = bytearray(struct.pack('!BBHHHBBH4s4sHHI', 0x45, 0, 0, 0, 0x4000, 0x40, 0x2F, 0, source_address, destination_address, 0x2000, gre_header_protocol, qfi << 24))
+            header[10:12] = ip_checksum(bytes(header[0:20]))
+            self.templates[version] = header
+        self.template_checksum = struct.unpack('!H', self.templates[4][10:12])[0] #same for both templates
+
+
+    def checksum(self,total_length):
+        return checksum_update(self.template_checksum, 0, total_length)
+
+
+    def header(self,packet): #28 bytes to prepend to packet
+        header = self.templates.get(packet[0]//16, self.templates[6])
+        total_length = len(packet) + 28
+        struct.pack_into('!H', header, 2, total_length)
+        struct.pack_into('!H', header, 10, self.checksum(total_length))
+        return bytes(header)
+
+
+    def write_into(self,buffer,start,payload_len): #zero copy version, the payload packet is at buffer[start+28:]
+        buffer[start:start+28] = self.templates.get(buffer[start+28]//16, self.templates[6])
+        total_length = payload_len + 28
+        struct.pack_into('!H', buffer, start+2, total_length)
+        struct.pack_into('!H', buffer, start+10, self.checksum(total_length))
+
+
+sa_record = collections.namedtuple('sa_record', 'spi direction userplane esn encr_alg integ_alg encr_key integ_key expiry')
+
+
+# Child SAs written by the IKE process (the only writer) and read by the ESP workers without locks, in shared memory created before
+# the workers are forked. Each slot has one SA record, found by (spi, direction) with an open addressing hash index of slot numbers
+# (0: empty). The generation of a slot is odd while the IKE process writes it (seqlock), so readers try again if it changed during
+# the read. The version in the header changes with every write: each worker keeps the sa_context of the SAs it uses, and only
+# checks their slots again when the version changes.
+# Removed SAs leave DELETED entries in the index. When they are more than half of it, the live entries are written again in a second
+# index, which then replaces the first one (the index generation in the header): readers that miss an SA while the index generation
+# changed probe again.
+class sa_database():
+
+    HEADER = struct.Struct("=QQ") #version, index generation (index in use: generation % 2)
+    COUNTER = struct.Struct("=Q")
+    INDEX_GENERATION_OFFSET = 8
+    INDEX = struct.Struct("=I")  #slot + 1, 0 (empty) or DELETED
+    RECORD = struct.Struct("=Qd4sBBBBHHBB36s64s6x") #generation, expiry, spi, direction, in use, userplane, esn, encr alg, integ alg, key lengths, keys
+    GENERATION = struct.Struct("=Q")
+    EXPIRY = struct.Struct("=d") #time.monotonic() after which the SA is no longer used (old SA of a rekey), or 0
+    EXPIRY_OFFSET = 8
+    SPI_OFFSET = 16
+    IN_USE_OFFSET = 21
+    DELETED = 0xFFFFFFFF
+
+    def __init__(self,slots):
+        self.slots = slots
+        self.index_size = 2 * slots #at most half full, so probes always end
+        self.index_offset = self.HEADER.size
+        self.slot_offset = self.index_offset + 2 * self.index_size * self.INDEX.size
+        self.memory = shared_memory.SharedMemory(create=True, size=self.slot_offset + slots * self.RECORD.size)
+        self.memory.unlink() #the forked workers inherit the mapping, and nothing is left in /dev/shm when the processes exit
+        self.buffer = self.memory.buf
+        self.free_slots = list(range(slots-1, -1, -1)) #IKE process only
+        self.slot_of = {}                               #IKE process only: (spi, direction) -> slot
+        self.deleted_entries = 0                        #IKE process only: DELETED entries in the index in use
+        self.cache = {} #workers only (a copy in each process): (spi, direction) -> [slot, generation, sa_context, expiry]
+        self.cache_version = 0
+
+
+    def version(self):
+        return self.HEADER.unpack_from(self.buffer, 0)[0]
+
+
+    def slot_position(self,slot):
+        return self.slot_offset + slot * self.RECORD.size
+
+
+    def index_position(self,spi,direction): #first index entry to probe
+        return (int.from_bytes(spi, 'big') * 2 + direction) % self.index_size
+
+
+    def index_generation(self):
+        return self.COUNTER.unpack_from(self.buffer, self.INDEX_GENERATION_OFFSET)[0]
+
+
+    def index_entry_offset(self,index_generation,position):
+        return self.index_offset + ((index_generation % 2) * self.index_size + position) * self.INDEX.size
+
+
+    def index_entry(self,index_generation,position):
+        return self.INDEX.unpack_from(self.buffer, self.index_entry_offset(index_generation, position))[0]
+
+
+    def find(self,spi,direction): #slot with (spi, direction), or None. The record must still be read with read()
+        while True:
+            index_generation = self.index_generation()
+            slot = self.probe(index_generation, spi, direction)
+            if slot is not None or self.index_generation() == index_generation: return slot
+            #index rebuilt during the probe
+
+
+    def probe(self,index_generation,spi,direction):
+        position = self.index_position(spi, direction)
+        for i in range(self.index_size):
+            entry = self.index_entry(index_generation, position)
+            if entry == 0: return None
+            if entry != self.DELETED:
+                offset = self.slot_position(entry - 1) + self.SPI_OFFSET
+                if self.buffer[offset:offset+4] == spi and self.buffer[offset+4] == direction: return entry - 1
+            position = (position + 1) % self.index_size
+        return None
+
+
+    def read(self,slot): #(generation, sa_record), with sa_record None if the slot is free
+        offset = self.slot_position(slot)
+        while True:
+            generation = self.GENERATION.unpack_from(self.buffer, offset)[0]
+            if generation % 2 == 1: continue #being written
+            fields = self.RECORD.unpack_from(self.buffer, offset)
+            if self.GENERATION.unpack_from(self.buffer, offset)[0] == generation: break
+        generation, expiry, spi, direction, in_use, userplane, esn, encr_alg, integ_alg, encr_key_length, integ_key_length, encr_key, integ_key = fields
+        if in_use == 0: return generation, None
+        return generation, sa_record(spi, direction, userplane == 1, esn, encr_alg, integ_alg, encr_key[:encr_key_length], integ_key[:integ_key_length], expiry)
+
+
+    def lookup(self,spi,direction): #sa_record of (spi, direction), or None
+        spi = bytes(spi)
+        slot = self.find(spi, direction)
+        if slot is None: return None
+        generation, record = self.read(slot)
+        if record is None or record.spi != spi or record.direction != direction: return None #slot reused meanwhile
+        return record
+
+
+    def get(self,spi,direction,create): #workers: sa_context of (spi, direction) made by create(sa_record) and cached in this process, or None
+        if self.cache_version != self.version(): self.refresh()
+        entry = self.cache.get((spi, direction))
+        if entry is None:
+            slot = self.find(spi, direction)
+            if slot is None: return None
+            generation, record = self.read(slot)
+            if record is None or record.spi != spi or record.direction != direction: return None
+            entry = [slot, generation, create(record), record.expiry]
+            self.cache[(spi, direction)] = entry
+        if entry[3] != 0 and time.monotonic() >= entry[3]: return None #old SA of a rekey after the drain window
+        return entry[2]
+
+
+    def refresh(self): #version changed: cached SAs whose slot was rewritten or freed are dropped, and the expiry of the others is read again
+        self.cache_version = self.version()
+        for key, entry in list(self.cache.items()):
+            offset = self.slot_position(entry[0])
+            if self.GENERATION.unpack_from(self.buffer, offset)[0] != entry[1]:
+                del self.cache[key]
+            else:
+                entry[3] = self.EXPIRY.unpack_from(self.buffer, offset + self.EXPIRY_OFFSET)[0]
+
+
+    def cached_sa_list(self): #workers: (sa_context, spi) of the SAs used by this process
+        return [(entry[2], key[0]) for key, entry in self.cache.items()]
+
+
+    def changed(self):
+        self.COUNTER.pack_into(self.buffer, 0, self.version() + 1)
+
+
+    def write(self,spi,direction,userplane,encr_alg,encr_key,integ_alg,integ_key,esn,expiry=0): #IKE process only. False if there is no free slot
+        spi = bytes(spi)
+        slot = self.slot_of.get((spi, direction))
+        new = slot is None
+        if new == True:
+            if len(self.free_slots) == 0: return False
+            slot = self.free_slots.pop()
+        offset = self.slot_position(slot)
+        generation = self.GENERATION.unpack_from(self.buffer, offset)[0]
+        self.GENERATION.pack_into(self.buffer, offset, generation + 1)
+        self.RECORD.pack_into(self.buffer, offset, generation + 1, expiry, spi, direction, 1, int(userplane), esn, encr_alg, integ_alg, len(encr_key), len(integ_key), encr_key, integ_key)
+        self.GENERATION.pack_into(self.buffer, offset, generation + 2)
+        if new == True: #indexed once the record is complete
+            self.slot_of[(spi, direction)] = slot
+            index_generation = self.index_generation()
+            position = self.index_position(spi, direction)
+            while self.index_entry(index_generation, position) not in (0, self.DELETED):
+                position = (position + 1) % self.index_size
+            if self.index_entry(index_generation, position) == self.DELETED: self.deleted_entries -= 1
+            self.INDEX.pack_into(self.buffer, self.index_entry_offset(index_generation, position), slot + 1)
+        self.changed()
+        return True
+
+
+    def set_expiry(self,spi,direction,expiry): #IKE process only. Single aligned field, so the generation (and the cached sa_context) does not change
+        slot = self.slot_of.get((bytes(spi), direction))
+        if slot is None: return
+        self.EXPIRY.pack_into(self.buffer, self.slot_position(slot) + self.EXPIRY_OFFSET, expiry)
+        self.changed()
+
+
+    def remove(self,spi,direction): #IKE process only
+        slot = self.slot_of.pop((bytes(spi), direction), None)
+        if slot is None: return
+        index_generation = self.index_generation()
+        position = self.index_position(spi, direction)
+        while self.index_entry(index_generation, position) != slot + 1:
+            position = (position + 1) % self.index_size
+        self.INDEX.pack_into(self.buffer, self.index_entry_offset(index_generation, position), self.DELETED)
+        self.deleted_entries += 1
+        if self.deleted_entries > self.index_size // 2: self.rebuild_index()
+        offset = self.slot_position(slot)
+        generation = self.GENERATION.unpack_from(self.buffer, offset)[0]
+        self.GENERATION.pack_into(self.buffer, offset, generation + 1)
+        self.buffer[offset + self.IN_USE_OFFSET] = 0
+        self.GENERATION.pack_into(self.buffer, offset, generation + 2)
+        self.free_slots.append(slot)
+        self.changed()
+
+
+    def rebuild_index(self): #IKE process only: the live entries are written in the index not in use, without DELETED entries, which then replaces it
+        index_generation = self.index_generation() + 1
+        start = self.index_entry_offset(index_generation, 0)
+        self.buffer[start:start + self.index_size * self.INDEX.size] = bytes(self.index_size * self.INDEX.size)
+        for (spi, direction), slot in self.slot_of.items():
+            position = self.index_position(spi, direction)
+            while self.index_entry(index_generation, position) != 0:
+                position = (position + 1) % self.index_size
+            self.INDEX.pack_into(self.buffer, self.index_entry_offset(index_generation, position), slot + 1)
+        self.COUNTER.pack_into(self.buffer, self.INDEX_GENERATION_OFFSET, index_generation)
+        self.deleted_entries = 0
+
+
+    def remove_expired(self): #IKE process only
+        now = time.monotonic()
+        for spi, direction in list(self.slot_of):
+            expiry = self.EXPIRY.unpack_from(self.buffer, self.slot_position(self.slot_of[(spi, direction)]) + self.EXPIRY_OFFSET)[0]
+            if expiry != 0 and now >= expiry: self.remove(spi, direction)
+
+
+# ESP sequence numbers of one SA in one encoder process. With several encoder processes for the same SA, each one reserves
+# blocks of block_size numbers from a shared counter (multiprocessing.Value), so numbers are unique per SA and increasing in each process.
+# The rest of a block is dropped once the other processes have moved the counter more than one block past it (this process was idle),
+# so a number is never more than about block_size behind the highest one sent, and stays inside the peer replay window.
+class sqn_allocator():
+
+    def __init__(self,shared_sqn=None,block_size=1):
+        self.shared_sqn = shared_sqn
+        self.shared_sqn_raw = shared_sqn.get_obj() if shared_sqn is not None else None #aligned 64 bit read without the lock
+        self.block_size = block_size
+        self.sqn = 1
+        self.block_end = 1
+        
+        
+    def next_sqn(self):
+        if self.shared_sqn is not None and (self.sqn == self.block_end or self.shared_sqn_raw.value - self.sqn > self.block_size):
+            with self.shared_sqn.get_lock():
+                self.sqn = self.shared_sqn.value
+                self.shared_sqn.value += self.block_size
+            self.block_end = self.sqn + self.block_size
+        sqn = self.sqn
+        self.sqn += 1
+        return sqn
+
+
+def test_sqn_allocator(): # python3 -c "import nwu_emulator; nwu_emulator.test_sqn_allocator()"
+    # two encoders of the same SA under uneven load: numbers unique, increasing per encoder, and close to the highest one sent
+    shared_sqn = multiprocessing.Value('Q', 1)
+    allocators = [sqn_allocator(shared_sqn, DEFAULT_SQN_BLOCK_SIZE), sqn_allocator(shared_sqn, DEFAULT_SQN_BLOCK_SIZE)]
+    sent, last, highest = set(), [0, 0], 0
+    for burst in range(200):
+        for n, allocator in enumerate(allocators):
+            for i in range(random.choice((1, 1, 5, 1000)) if n == 1 else 1):
+                sqn = allocator.next_sqn()
+                assert sqn not in sent and sqn > last[n]
+                assert highest - sqn < DEFAULT_SQN_BLOCK_SIZE, (highest, sqn)
+                sent.add(sqn)
+                last[n], highest = sqn, max(highest, sqn)
+    print('sqn allocator ok:', len(sent), 'numbers, highest', highest)
+
+
+# Lifetime of an SA (RFC 4301 section 4.4.2.1): hard limits in seconds, bytes and packets (0: no limit), and soft limits at which the SA
+# is rekeyed, DEFAULT_REKEY_MARGIN before the hard ones minus a random jitter. Bytes and packets are the sum of the last counters
+# reported by each ESP worker (encoders for outbound, decoder for inbound) for the SPIs of the SA.
+class sa_lifetime():
+
+    def __init__(self,seconds=0,bytes=0,packets=0,spi_list=[]):
+        self.start = time.monotonic()
+        self.hard = [seconds, bytes, packets]
+        factor = 1 - DEFAULT_REKEY_MARGIN - random.uniform(0, DEFAULT_REKEY_JITTER)
+        self.soft = [seconds*factor, int(bytes*factor), int(packets*factor)]
+        self.spi_list = spi_list
+        self.usage = {} #(worker pipe, spi) -> [bytes, packets]
+        self.soft_expired = False #rekey started
+        self.hard_expired = False
+
+
+    def update(self,worker,spi,bytes,packets):
+        if spi in self.spi_list: self.usage[(worker, spi)] = [bytes, packets]
+
+
+    def expired(self,limits): #limits: self.soft or self.hard
+        usage = [time.monotonic() - self.start, sum(i[0] for i in self.usage.values()), sum(i[1] for i in self.usage.values())]
+        for i in range(3):
+            if limits[i] > 0 and usage[i] >= limits[i]: return True
+        return False
+
+
+    def timeout(self): #seconds till the next time limit, or None
+        if self.hard[0] == 0 or self.hard_expired == True: return None
+        if self.soft_expired == True:
+            return max(0, self.start + self.hard[0] - time.monotonic())
+        return max(0, self.start + self.soft[0] - time.monotonic())
+
+
+# Tun devices prepared before the first session (option --netns-pool): each one is created with its queues, moved to its network
+# namespace and brought up once. Sessions use them as they are, and teardown only flushes their addresses and routes (link down),
+# so reauthentications do not create them again. Namespaces created by the pool are deleted at exit.
+class netns_tun_pool():
+
+    def __init__(self):
+        self.tun_of = {}     #tunnel id -> [device, netns, fd, queue fds]
+        self.netns_list = [] #namespaces created by the pool
+
+
+    def add(self,n,device,netns,fd,queues):
+        self.tun_of[n] = [device, netns, fd, queues]
+
+
+    def get(self,n): #(fd, queue fds) of tunnel n
+        return self.tun_of[n][2], self.tun_of[n][3]
+
+
+    def flush(self): #returns (description, errno) of the failed operations
+        error_list = []
+        for device, netns, fd, queues in self.tun_of.values():
+            with rtnetlink(netns) as nl:
+                nl.flush_link(device)
+                error_list += nl.commit()
+        return error_list
+
+
+    def close(self): #at exit
+        for netns in self.netns_list:
+            try:
+                delete_netns(netns)
+            except OSError:
+                pass
+
+
+def open_tun_device(name,multi_queue=False):
+    TUNSETIFF = 0x400454ca
+    IFF_TUN   = 0x0001
+    IFF_TAP   = 0x0002
+    IFF_NO_PI = 0x1000 # No Packet Information - to avoid 4 extra bytes
+    IFF_MULTI_QUEUE = 0x0100 # each TUNSETIFF on the same device adds a queue. Kernel hashes flows across queues
+
+    TUNMODE = IFF_TUN | IFF_NO_PI
+    if multi_queue == True: TUNMODE |= IFF_MULTI_QUEUE
+
+    f = os.open("/dev/net/tun", os.O_RDWR)
+    fcntl.ioctl(f, TUNSETIFF, struct.pack("16sH", bytes(name, "utf-8"), TUNMODE))
+    return f
+
+
+class userplane_switch_server():
+    # one tun device for the userplane of all the UEs of the host (one process per UE). Uplink packets are sent to the
+    # socket of the UE that registered the source address. Downlink is written by each UE directly to the tun device (fd
+    # passed with SCM_RIGHTS)
+
+    def __init__(self, path, device = DEFAULT_USERPLANE_SWITCH_DEVICE, table = DEFAULT_USERPLANE_SWITCH_TABLE):
+        self.path = path
+        self.tunnel = open_tun_device(device)
+        os.set_blocking(self.tunnel, False)
+        with rtnetlink() as nl:
+            nl.set_link(device, up=True)
+            nl.add_route('0.0.0.0', 0, device=device, table=table)
+            nl.add_route('::', 0, device=device, table=table)
+            for description, error in nl.commit():
+                print('netlink error: ' + description + ': ' + os.strerror(error))
+        self.socket_control = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if os.path.exists(path): # left by a previous server
+            os.unlink(path)
+        self.socket_control.bind(path)
+        self.socket_control.setblocking(False)
+        self.client_of = {}       # source address -> client address
+        self.address_list_of = {} # client address -> address list
+        self.unknown = 0          # packets from an address not registered
+        self.dropped = 0          # packets dropped because the queue of the UE was full
+
+
+    def update(self, client, address_list):
+        for address in self.address_list_of.pop(client, []):
+            if self.client_of.get(address) == client:
+                del self.client_of[address]
+        if len(address_list) > 0:
+            self.address_list_of[client] = address_list
+            for address in address_list:
+                self.client_of[address] = client
+
+
+    def dispatch(self, packet):
+        if packet[0] >> 4 == 4:
+            client = self.client_of.get(packet[12:16])
+        else:
+            client = self.client_of.get(packet[8:24])
+        if client is None:
+            self.unknown += 1
+            return
+        try:
+            self.socket_control.sendto(packet, client)
+        except BlockingIOError:
+            self.dropped += 1
+        except (ConnectionRefusedError, FileNotFoundError): # UE exited
+            self.update(client, [])
+
+
+    def receive_control(self):
+        while True:
+            try:
+                message, client = self.socket_control.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            if len(message) == 0: continue
+            if message[0] == USERPLANE_SWITCH_HELLO:
+                try:
+                    self.socket_control.sendmsg([bytes([USERPLANE_SWITCH_HELLO])], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack('i', self.tunnel))], 0, client)
+                except OSError:
+                    pass
+            elif message[0] == USERPLANE_SWITCH_ADDRESSES:
+                address_list = []
+                pointer = 1
+                while pointer < len(message):
+                    address_list.append(message[pointer+1:pointer+1+message[pointer]])
+                    pointer += 1 + message[pointer]
+                self.update(client, address_list)
+
+
+    def run(self):
+        print('Userplane switch listening in', self.path)
+        socket_list = [self.tunnel, self.socket_control]
+        while True:
+            read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [])
+            if self.socket_control in read_sockets:
+                self.receive_control()
+            if self.tunnel in read_sockets:
+                try:
+                    while True:
+                        self.dispatch(os.read(self.tunnel, 1514))
+                except BlockingIOError:
+                    pass
+
+
+class userplane_switch_client():
+
+    def __init__(self, path, queue_size = DEFAULT_USERPLANE_SWITCH_QUEUE_SIZE, timeout = 2):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) # uplink packets of this UE
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, queue_size)
+        self.sock.bind(USERPLANE_SWITCH_CLIENT_NAME + str(os.getpid()))
+        self.sock.sendto(bytes([USERPLANE_SWITCH_HELLO]), path)
+        self.sock.settimeout(timeout)
+        message, fds, flags, address = socket.recv_fds(self.sock, 16, 1)
+        self.sock.settimeout(None)
+        if len(fds) == 0:
+            raise OSError('tun device not received')
+        self.tunnel = fds[0] # shared tun device, for downlink
+
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+    def register(self, address_list): # addresses of this UE in bytes (4 or 16)
+        try:
+            self.sock.sendto(bytes([USERPLANE_SWITCH_ADDRESSES]) + b''.join(bytes([len(address)]) + address for address in address_list), self.path)
+        except OSError as e:
+            print('Userplane switch not reachable in', self.path + ':', e)
+
+
+class multi_ue_engine():
+    # NWu registration (states 1 to 6: IKE_SA_INIT till the signalling child SA) of many UEs in one process, as tasks of one
+    # asyncio event loop. Each UE is a copy of the configured nwu_swu, with its own IMSI, IKE SPIs, message ids, keys and
+    # NAS COUNTs, sharing its udp 500 and 4500 sockets: answers are sent to the task of the UE by initiator IKE SPI
+
+    def __init__(self, template, ue_count, start_rate = DEFAULT_UE_START_RATE, log = None, subscriber_db = None):
+        self.template = template
+        self.socket_list = [template.socket, template.socket_nat]
+        self.subscriber_db = subscriber_db # Ki and OPc of each UE. If None, the keys of the template are used
+        self.ue_list = [self.new_ue(n) for n in range(ue_count)]
+        self.start_rate = start_rate
+        self.log = log
+        self.queue_of = {} # initiator ike spi -> queue of the task of the UE
+        self.unknown = 0   # IKE messages with an initiator SPI not in use
+
+
+    def new_ue(self, n): # copy of the template with the imsi incremented by n. Sockets are not copied
+        ue = copy.deepcopy(self.template, {id(sock): sock for sock in self.socket_list + [self.template.socket_esp]})
+        ue.imsi = str(int(self.template.imsi) + n).zfill(len(self.template.imsi))
+        if self.subscriber_db is not None:
+            subscriber = self.subscriber_db.get(ue.imsi)
+            if subscriber is None:
+                print('IMSI ' + ue.imsi + ' not in subscriber database ' + self.subscriber_db.path + '. Exiting.')
+                exit(1)
+            ue.ki, ue.op, ue.opc = subscriber[0], None, subscriber[1]
+        ue.set_variables()
+        ue.cookie = False
+        return ue
+
+
+    def receive(self, sock):
+        while True:
+            try:
+                packet, address = sock.recvfrom(2000)
+            except (BlockingIOError, InterruptedError):
+                return
+            if sock == self.template.socket_nat:
+                if packet[0:4] != b'\x00'*4: continue # ESP
+                packet = packet[4:]
+            queue = self.queue_of.get(packet[0:8])
+            if queue is None:
+                self.unknown += 1
+            else:
+                queue.put_nowait(packet)
+
+
+    async def state(self, ue, queue, send, process, *args): # asyncio version of the nwu_swu states: send, wait for the answer and process it
+        send(*args)
+        self.queue_of[ue.ike_spi_initiator] = queue
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ue.timeout
+        while True:
+            try:
+                packet = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return TIMEOUT,'TIMEOUT'
+            ue.decode_ike(packet)
+            if ue.ike_decoded_ok == True: break
+        return process()
+
+
+    async def register(self, ue): # same sequence as start_ike_nwu, till the signalling child SA
+        queue = asyncio.Queue()
+        try:
+            result,info = await self.state(ue, queue, ue.state_1_send, ue.state_1_process)
+            if result in (REPEAT_STATE, TIMEOUT):
+                result,info = await self.state(ue, queue, ue.state_1_send, ue.state_1_process, True)
+            elif result in (REPEAT_STATE_COOKIE,):
+                result,info = await self.state(ue, queue, ue.state_1_send, ue.state_1_process, True, True)
+            if result in (REPEAT_STATE, TIMEOUT):
+                result,info = await self.state(ue, queue, ue.state_1_send, ue.state_1_process, True, ue.cookie)
+
+            if result == OK:
+                result,info = await self.state(ue, queue, ue.state_2_nwu_send, ue.state_2_nwu_process)
+            if result == OK:
+                result,info = await self.state(ue, queue, ue.state_3_nwu_send, ue.state_3_nwu_process)
+            if result in (SYNCH_FAILURE, REPEAT_STATE):
+                result,info = await self.state(ue, queue, ue.state_3_nwu_send, ue.state_3_nwu_process)
+            for send, process in ((ue.state_4_nwu_send, ue.state_4_nwu_process), (ue.state_5_nwu_send, ue.state_5_nwu_process), (ue.state_6_nwu_send, ue.state_6_nwu_process)):
+                if result != OK: break
+                result,info = await self.state(ue, queue, send, process)
+        except Exception as e:
+            result,info = OTHER_ERROR, repr(e)
+        for spi in (ue.ike_spi_initiator, ue.ike_spi_initiator_old):
+            self.queue_of.pop(spi, None)
+        return result,info
+
+
+    async def run_async(self):
+        loop = asyncio.get_running_loop()
+        for sock in self.socket_list:
+            sock.setblocking(False)
+            loop.add_reader(sock, self.receive, sock)
+        start = time.time()
+        task_list = []
+        for n, ue in enumerate(self.ue_list):
+            if self.start_rate > 0:
+                await asyncio.sleep(max(0, start + n / self.start_rate - time.time()))
+            task_list.append(asyncio.create_task(self.register(ue)))
+            await asyncio.sleep(0) # IKE_SA_INIT of this UE sent (DH key generated), and answers received so far processed, before the next one
+        result_list = await asyncio.gather(*task_list)
+        elapsed = time.time() - start
+        for sock in self.socket_list:
+            loop.remove_reader(sock)
+            sock.setblocking(True)
+        return result_list, elapsed
+
+
+    def run(self):
+        with open(self.log or os.devnull, 'w') as log, contextlib.redirect_stdout(log): # output of the states of all the UEs
+            result_list, elapsed = asyncio.run(self.run_async())
+            for ue, (result, info) in zip(self.ue_list, result_list):
+                if result == OK: # IKE SA deleted, no answer expected
+                    ue.message_id_request += 1
+                    ue.send_data(ue.create_INFORMATIONAL_delete(IKE))
+
+        count_of = collections.Counter()
+        for ue, (result, info) in zip(self.ue_list, result_list):
+            if result != OK: print('IMSI', ue.imsi + ':', self.template.errors.get(result), info)
+            count_of[self.template.errors.get(result)] += 1
+        print('%d of %d UEs registered in %.3f seconds (%.1f per second)' % (count_of['OK'], len(self.ue_list), elapsed, count_of['OK'] / elapsed))
+        for error, count in count_of.items():
+            if error != 'OK': print(error + ':', count)
+        if self.unknown > 0: print('IKE messages with unknown SPI:', self.unknown)
+
+
 def get_default_gateway_linux():
     """Read the default gateway directly from /proc."""
     with open("/proc/net/route") as fh:
@@ -4783,57 +6311,55 @@ def tcp_udp_checksum_correction(ip_packet):
     if ip_packet[9] ==  6: #tcp
         ip_header_length = (ip_packet[0] % 16) * 4
         tcp_packet = ip_packet[ip_header_length:]
-        len_tcp_packet = struct.pack("!H", len(tcp_packet))
-        pseudo_header_plus_tcp_packet = ip_packet[12:20] + b'\x00\x06' + len_tcp_packet + tcp_packet[0:16] + b'\x00\x00' + tcp_packet[18:]
-        tcp_checksum = ip_checksum(pseudo_header_plus_tcp_packet, tcp_udp=True)
+        tcp_packet = tcp_packet[0:16] + b'\x00\x00' + tcp_packet[18:]
+        tcp_checksum = checksum(tcp_packet, pseudo_header_sum(ip_packet[12:16], ip_packet[16:20], 6, len(tcp_packet)))
         
-        return ip_packet[0:ip_header_length] +  tcp_packet[0:16] + tcp_checksum + tcp_packet[18:]
+        return ip_packet[0:ip_header_length] +  tcp_packet[0:16] + struct.pack("!H", tcp_checksum) + tcp_packet[18:]
     
     elif ip_packet[9] ==  17: #udp
         ip_header_length = (ip_packet[0] % 16) * 4
         udp_packet = ip_packet[ip_header_length:]
-        len_udp_packet = struct.pack("!H", len(udp_packet))
-        pseudo_header_plus_udp_packet = ip_packet[12:20] + b'\x00\x11' + len_udp_packet + udp_packet[0:6] + b'\x00\x00' + udp_packet[8:]
-        udp_checksum = ip_checksum(pseudo_header_plus_udp_packet, tcp_udp=True)
+        udp_packet = udp_packet[0:6] + b'\x00\x00' + udp_packet[8:]
+        udp_checksum = checksum(udp_packet, pseudo_header_sum(ip_packet[12:16], ip_packet[16:20], 17, len(udp_packet)))
         
-        return ip_packet[0:ip_header_length] +  udp_packet[0:6] + udp_checksum + udp_packet[8:]
+        return ip_packet[0:ip_header_length] +  udp_packet[0:6] + struct.pack("!H", udp_checksum) + udp_packet[8:]
     else:
         return ip_packet
 
 
-#!/usr/bin/env python
-#-------------------------------------------------------------------------------
-# Name:        checksum.py
-#
-# Author:      Grant Curell
-#
-# Created:     16 Sept 2012
-#
-# Description: Calculates the checksum for an IP header
-#-------------------------------------------------------------------------------
-def ip_checksum(ip_header, tcp_udp = False):
-    if tcp_udp == True:
-        if len(ip_header) % 2 == 1:
-            ip_header += b'\x00'
-        
-    cksum = 0
-    pointer = 0
-    size = len(ip_header)
-    
-    #The main loop adds up each set of 2 bytes. They are first converted to strings and then concatenated
-    #together, converted to integers, and then added to the sum.
-    while size > 1:
-        cksum += int((str("%02x" % (ip_header[pointer],)) + 
-                      str("%02x" % (ip_header[pointer+1],))), 16)
-        size -= 2
-        pointer += 2
-    if size: #This accounts for a situation where the header is odd
-        cksum += ip_header[pointer]
-        
-    cksum = (cksum >> 16) + (cksum & 0xffff)
-    cksum += (cksum >>16)
+def clamp_tcp_mss(ip_packet, mtu): #lowers the MSS option of TCP SYN packets to fit the tunnel MTU. returns the packet (a bytearray copy if bytes and changed)
+    version = ip_packet[0] // 16
+    if version == 4 and ip_packet[9] == 6 and (ip_packet[6] % 32) * 256 + ip_packet[7] == 0: #tcp, first fragment
+        tcp_start = (ip_packet[0] % 16) * 4
+        mss = mtu - 40
+    elif version == 6 and len(ip_packet) > 40 and ip_packet[6] == 6: #tcp without extension headers
+        tcp_start = 40
+        mss = mtu - 60
+    else:
+        return ip_packet
     
-    return struct.pack("!H",(~cksum) & 0xFFFF)
+    if len(ip_packet) < tcp_start + 20 or ip_packet[tcp_start+13] & 0x02 == 0: return ip_packet #not SYN
+    tcp_end = min(len(ip_packet), tcp_start + (ip_packet[tcp_start+12] // 16) * 4)
+    position = tcp_start + 20
+    while position < tcp_end:
+        kind = ip_packet[position]
+        if kind == 0: break #end of options
+        if kind == 1: #nop
+            position += 1
+            continue
+        if position + 1 >= tcp_end or ip_packet[position+1] < 2: break
+        if kind == 2 and ip_packet[position+1] == 4 and position + 4 <= tcp_end: #MSS
+            old_mss = struct.unpack("!H", ip_packet[position+2:position+4])[0]
+            #MSS value must be a 16 bit word of the checksum for the incremental update (always the case in practice)
+            if old_mss <= mss or (position - tcp_start) % 2 == 1: return ip_packet
+            if type(ip_packet) is bytes: ip_packet = bytearray(ip_packet)
+            old_checksum = struct.unpack("!H", ip_packet[tcp_start+16:tcp_start+18])[0]
+            struct.pack_into("!H", ip_packet, position+2, mss)
+            struct.pack_into("!H", ip_packet, tcp_start+16, checksum_update(old_checksum, old_mss, mss))
+            return ip_packet
+        position += ip_packet[position+1]
+    return ip_packet
+
 
 def sha1_dss(data):  #for MSK
 #based on code from https://codereview.stackexchange.com/questions/37648/python-implementation-of-sha1    
@@ -4889,17 +6415,18 @@ def sha1_dss(data):  #for MSK
 
 #abstraction functions
 
+OPC_CACHE = {} #(ki, op) -> opc, so OPc is calculated once and not in every authentication
+
 def milenage_res_ck_ik(ki, op, opc, rand):
     rand = unhexlify(rand)
     ki = unhexlify(ki)
     if op == None: 
         opc = unhexlify(opc)
-        op = 16*b'\x00' #dummy since we will set opc directly
-        m = Milenage(op)
-        m.set_opc(opc)
     else:
-        op = unhexlify(op)
-        m = Milenage(op)
+        if (ki, op) not in OPC_CACHE: OPC_CACHE[(ki, op)] = make_opc(ki, unhexlify(op))
+        opc = OPC_CACHE[(ki, op)]
+    m = Milenage(16*b'\x00') #dummy op since we set opc directly
+    m.set_opc(opc)
     res, ck, ik, ak = m.f2345(ki, rand)
     return toHex(res), toHex(ck), toHex(ik)
 
@@ -5331,15 +6858,56 @@ def main():
     parser.add_option("-u", "--userplane-ip-address", dest="free5gc_userplane_ip_address", help="userplane IP address (for non compliant free5gc N3IWF)")  
 
     parser.add_option("-n", "--netns", dest="netns", help="Name of network namespace for tun device")    
-    parser.add_option("-U", "--userplane-mtu", dest="userplane_tunnel_mtu", help="userplane tunnel MTU")    
+    parser.add_option("-U", "--userplane-mtu", dest="userplane_tunnel_mtu", help="userplane tunnel MTU (by default calculated from the negotiated child SA overhead and the path MTU)")    
 
     parser.add_option("-k", "--ca-certificate-public-key", dest="ca_certificate_pubkey", help="CA Certificate SubjectPublicKeyInfo bytes (in hex digits)") 
     
     parser.add_option("-H", "--handover", action="store_true", dest="handover", default=False, help="to test handover from 3gpp to non-3gpp")
     parser.add_option("-G", "--guti", dest="guti", help="5G-GUTI in the following format: <MCCMNC>-<AMF Region ID>-<AMF Set ID>-<AMF pointer>-<5G-TMSI>")  
+
+    parser.add_option("--ike-aes-gcm", action="store_true", dest="ike_aes_gcm", default=False, help="propose AES-GCM-256 with 16 octet ICV (RFC 5282) as first IKE SA transform (for GCM only N3IWF/ePDG)")
+    parser.add_option("--chacha20", action="store_true", dest="chacha20", default=False, help="propose ChaCha20-Poly1305 (RFC 7634) as first child SA transform (for hosts without AES-NI)")
+    parser.add_option("--esn", action="store_true", dest="esn", default=False, help="offer Extended Sequence Numbers (64 bit, RFC 4303) in child SA proposals, and accept them when proposed by the N3IWF")
+    parser.add_option("--ike-lifetime", dest="ike_lifetime", type="int", default=0, help="IKE SA hard lifetime in seconds. The IKE SA is rekeyed before it, with random jitter. Default is 0 (no limit)")
+    parser.add_option("--child-lifetime", dest="child_lifetime", type="int", default=0, help="child SA hard lifetime in seconds (SWu). The child SA is rekeyed before it, with random jitter. Default is 0 (no limit)")
+    parser.add_option("--child-lifetime-bytes", dest="child_lifetime_bytes", type="int", default=0, help="child SA hard lifetime in bytes, inbound + outbound (SWu). Default is 0 (no limit)")
+    parser.add_option("--child-lifetime-packets", dest="child_lifetime_packets", type="int", default=0, help="child SA hard lifetime in packets, inbound + outbound (SWu). Default is 0 (no limit)")
+    parser.add_option("--rekey-drain", dest="rekey_drain_window", type="int", default=DEFAULT_REKEY_DRAIN_WINDOW, help="seconds the ESP workers keep the old child SA after a rekey, if it is not deleted before: inbound packets are routed by SPI, and for userplane rekeys started by the N3IWF the uplink switches when the new SA is confirmed. 0 replaces it at once. Default is 5")
+    parser.add_option("--batch-size", dest="batch_size", type="int", help="batched I/O in the ESP encoder/decoder: max packets per recvmmsg/sendmmsg (tun and sockets are drained till EAGAIN)")
+    parser.add_option("--replay-window", dest="replay_window_size", type="int", default=DEFAULT_REPLAY_WINDOW_SIZE, help="anti-replay window size of inbound ESP SAs (64 to 4096, 0 to disable). Default is 64")
+    parser.add_option("--udp-offload", action="store_true", dest="udp_offload", default=False, help="UDP GSO (UDP_SEGMENT) for uplink and UDP GRO for downlink ESP in the NAT-T socket (falls back if not supported by the kernel)")
+    parser.add_option("--zero-copy", action="store_true", dest="zero_copy", default=False, help="ESP encoder/decoder use preallocated buffers: tun packets read with headroom, headers packed and data encrypted in place, recvfrom_into")
+    parser.add_option("--ike-esp-split", action="store_true", dest="ike_esp_split", default=False, help="two SO_REUSEPORT sockets in udp 4500 with a BPF program that sends IKE (non-ESP marker) to the IKE process and ESP to the decoder (falls back if not supported by the kernel)")
+    parser.add_option("--netns-pool", action="store_true", dest="netns_pool", default=False, help="tun devices and namespaces created before the session, with names unique to this process (tun<N>_<pid>, tcp_socket_signalling_<pid>, userplane_<pid> or <-n netns>_<pid>), and kept for reauthentications (only their addresses and routes are flushed)")
+    parser.add_option("--esp-demux", dest="esp_demux", help="unix socket path of a running --esp-demux-server: inbound ESP (without NAT traversal) is received from it, instead of from a raw ESP socket per UE")
+    parser.add_option("--userplane-switch", dest="userplane_switch", help="NWU only. unix socket path of a running --userplane-switch-server: the userplane uses the tun device " + DEFAULT_USERPLANE_SWITCH_DEVICE + " shared by the UEs of this host, where the PDU session addresses are added (with a rule to routing table " + str(DEFAULT_USERPLANE_SWITCH_TABLE) + "). Bind to the UE address to use its session")
+    parser.add_option("--userplane-switch-server", dest="userplane_switch_server", help="only run the userplane switch for the UEs of this host in this unix socket path: uplink packets of the shared tun device are sent to the UE that registered the source address")
+    parser.add_option("--esp-demux-server", dest="esp_demux_server", help="only run the ESP demultiplexer for the UEs of this host in this unix socket path: ESP is read once and sent to the UE that registered its SPI")
+    parser.add_option("--ues", dest="ues", type="int", default=1, help="NWU only. number of UEs registered concurrently in this process (asyncio), with IMSIs incremented from -I and the same -K/-P/-C. Each UE stops at the signalling child SA, and its IKE SA is deleted at the end. Default is 1 (single UE mode)")
+    parser.add_option("--ue-start-rate", dest="ue_start_rate", type="float", default=DEFAULT_UE_START_RATE, help="UEs started per second with --ues. Default is 0 (all at once)")
+    parser.add_option("--ue-log", dest="ue_log", help="file for the output of the UEs with --ues (discarded by default)")
+    parser.add_option("--subscriber-db", dest="subscriber_db", help="SQLite subscriber database (IMSI, Ki, OPc): Ki and OPc of the UE (or of each UE with --ues) are read from it by IMSI, instead of -K/-P/-C")
+    parser.add_option("--subscriber-db-generate", dest="subscriber_db_generate", type="int", help="only add this number of subscribers to --subscriber-db, with IMSIs incremented from -I, Ki from -K (or derived with --ki-seed) and OPc from -C (or calculated from -P)")
+    parser.add_option("--ki-seed", dest="ki_seed", help="with --subscriber-db-generate: the Ki of each IMSI is the first 16 bytes of HMAC-SHA256(KI_SEED, IMSI), instead of -K. Needs -P")
+    parser.add_option("--uplink-workers", dest="uplink_workers", type="int", default=1, help="number of uplink encoder processes. If >1 the userplane tun device is opened with IFF_MULTI_QUEUE, one queue per process")
     
     (options, args) = parser.parse_args()
     
+    if options.esp_demux_server is not None:
+        esp_demux_server(options.esp_demux_server).run()
+        return
+    if options.userplane_switch_server is not None:
+        userplane_switch_server(options.userplane_switch_server).run()
+        return
+    if options.subscriber_db_generate is not None:
+        if options.subscriber_db is None or (options.ki is None) == (options.ki_seed is None) or (options.op is None and (options.opc is None or options.ki_seed is not None)):
+            print('Option --subscriber-db-generate needs --subscriber-db, -K or --ki-seed, and -P or -C (-P with --ki-seed). Exiting.')
+            exit(1)
+        with subscriber_database(options.subscriber_db) as db:
+            count = db.add_range(options.imsi, options.subscriber_db_generate, options.ki, options.op, options.opc if options.op is None else None, options.ki_seed)
+            print(str(count) + ' subscribers added to ' + options.subscriber_db + ' (' + str(db.count()) + ' in total)')
+        return
+
     if options.source_addr is None:
         try:
             options.source_addr = get_default_source_address()
@@ -5353,6 +6921,30 @@ def main():
             print('Please specify gateway IP address with option -g. Exiting.')
             exit(1)
             
+    subscriber_db = None
+    if options.subscriber_db is not None:
+        subscriber_db = subscriber_database(options.subscriber_db)
+        if options.ues == 1:
+            subscriber = subscriber_db.get(options.imsi)
+            if subscriber is None:
+                print('IMSI ' + options.imsi + ' not in subscriber database ' + options.subscriber_db + '. Exiting.')
+                exit(1)
+            options.ki, options.op, options.opc = subscriber[0], None, subscriber[1]
+
+    if options.ues > 1 and (options.interface_type != 'NWU' or (options.ki is None and subscriber_db is None)):
+        print('Option --ues needs NWU interface type and Milenage keys (-K with -P or -C, or --subscriber-db). Exiting.')
+        exit(1)
+
+    if options.replay_window_size != 0 and not MIN_REPLAY_WINDOW_SIZE <= options.replay_window_size <= MAX_REPLAY_WINDOW_SIZE:
+        print('Replay window size must be between ' + str(MIN_REPLAY_WINDOW_SIZE) + ' and ' + str(MAX_REPLAY_WINDOW_SIZE) + ', or 0. Exiting.')
+        exit(1)
+    if options.uplink_workers < 1:
+        print('Number of uplink workers must be at least 1. Exiting.')
+        exit(1)
+    if options.batch_size is not None and options.batch_size <= 0:
+        print('Batch size must be greater than 0. Exiting.')
+        exit(1)
+            
     try:
         destination_addr = socket.gethostbyname(options.destination_addr)
     except:
@@ -5367,11 +6959,35 @@ def main():
         options.guti)
 
     if options.imsi == DEFAULT_IMSI: a.get_identity()
+    if options.ike_aes_gcm == True:
+        sa_list = [[[IKE,0],[ENCR,ENCR_AES_GCM_16,[KEY_LENGTH,256]],[PRF,PRF_HMAC_SHA2_256],[D_H,MODP_2048_bit]]] + sa_list
     a.set_sa_list(sa_list)
+    if options.chacha20 == True:
+        sa_list_child = [[[ESP,4],[ENCR,ENCR_CHACHA20_POLY1305],[INTEG,NONE],[ESN,ESN_NO_ESN]]] + sa_list_child
+    if options.esn == True: #ESN_ESN before ESN_NO_ESN in each proposal, the responder chooses one
+        for proposal in sa_list_child:
+            if [ESN,ESN_NO_ESN] in proposal: proposal.insert(proposal.index([ESN,ESN_NO_ESN]), [ESN,ESN_ESN])
     a.set_sa_list_child(sa_list_child)
     a.set_ts_list(TSI, ts_list_initiator)
     a.set_ts_list(TSR, ts_list_responder)
     a.set_cp_list(cp_list)
+    a.set_batch_size(options.batch_size)
+    a.set_replay_window_size(options.replay_window_size)
+    a.set_udp_offload(options.udp_offload)
+    a.set_zero_copy(options.zero_copy)
+    a.set_uplink_workers(options.uplink_workers)
+    a.set_esn(options.esn)
+    a.set_ike_lifetime(options.ike_lifetime)
+    a.set_child_lifetime(options.child_lifetime, options.child_lifetime_bytes, options.child_lifetime_packets)
+    a.set_rekey_drain_window(options.rekey_drain_window)
+    a.set_ike_esp_split(options.ike_esp_split)
+    if options.esp_demux is not None: a.set_esp_demux(options.esp_demux)
+    if options.userplane_switch is not None: a.set_userplane_switch(options.userplane_switch)
+    a.set_netns_pool(options.netns_pool) #after the userplane switch, that keeps the userplane in the default netns
+
+    if options.ues > 1:
+        multi_ue_engine(a, options.ues, options.ue_start_rate, options.ue_log, subscriber_db).run()
+        return
 
     a.start_ike()
     